@@ -5,6 +5,7 @@
 # ./GPLv3-LICENSE.txt in the source distribution
 
 import base64
+from collections import defaultdict
 import cStringIO
 import datetime
 import errno
@@ -17,18 +18,19 @@ import signal
 from subprocess import Popen, PIPE
 import sys
 import tarfile
-import tempfile
 import threading
 import time
 import traceback
 
 from magi.daemon.externalAgentsThread import ExternalAgentsThread, PipeTuple
+from magi.daemon.threadInterface import DockTable
 from magi.messaging.api import *
 import magi.modules
 import magi.modules.dataman
 from magi.util import config, helpers, database
 from magi.util.agent import agentmethod
-from magi.util.calls import doMessageAction
+from magi.util.blobs import BlobCache, BlobError, BlobFetch
+from magi.util.calls import doMessageAction, loadMessageData
 from magi.util.software import requireSoftware
 
 
@@ -41,6 +43,10 @@ class Daemon(threading.Thread):
 		messages such as 'exec'.
 	"""
 
+	CODEDIGEST = '.magidigest'  # digest of the blob an agent code directory was extracted from
+	BLOB_RETRY = 30  # seconds to wait for a requested blob before asking again
+	BLOB_RETRIES = 3
+
 	def __init__(self, hostname, transports):
 		threading.Thread.__init__(self, name='daemon')
 		# 9/16/2013 hostname is passed in from the magi_daemon script correctly 
@@ -51,6 +57,10 @@ class Daemon(threading.Thread):
 		self.staticAgents = list()  # statically loaded thread agents
 		self.threadAgents = list()  # dynamically loaded thread agents
 		self.pAgentPids = dict() # process agent's process ids
+		self.docktable = DockTable()  # dock -> thread agents listening on it
+		self.dockStats = defaultdict(int)  # dock -> messages handed off
+		self.blobCache = BlobCache(os.path.join(config.getTempDir(), 'blobs'))
+		self.blobFetches = dict()  # digest -> BlobFetch for agent code being fetched
 		
 		#starting the external/process agents control thread
 		self.extAgentsThread = ExternalAgentsThread(self.messaging)
@@ -115,6 +125,8 @@ class Daemon(threading.Thread):
 		
 		while not self.done:
 			try:
+				if self.blobFetches:
+					self.checkFetches()
 				try:
 					#infinitely blocked calls will not respond to signals also
 					msg = self.messaging.nextMessage(block=True, timeout=1)
@@ -127,25 +139,26 @@ class Daemon(threading.Thread):
 				#if type(msg) is str and msg == 'PoisinPill': # don't cause conversion to string for every message
 				#	break
 
-				progress = False
 				for dock in msg.dstdocks:
+					delivered = 0
 					if dock == 'daemon':
 						log.log(5, "Handling message for dock daemon with local call")
-						progress = True
+						delivered += 1
 						doMessageAction(self, msg, self.messaging)
 		
-					for tAgent in self.staticAgents + self.threadAgents:
-						if dock in tAgent.docklist:
-							log.log(5, "Handing message for dock %s off to threaded agent %s", dock, tAgent)
-							progress = True
-							tAgent.rxqueue.put(msg)
+					for tAgent in self.docktable.subscribers(dock):
+						log.log(5, "Handing message for dock %s off to threaded agent %s", dock, tAgent)
+						delivered += 1
+						tAgent.rxqueue.put(msg)
 		
 					if self.extAgentsThread.wantsDock(dock):
 						log.log(5, "Handing message for dock %s off to external agents thread", dock)
-						progress = True
+						delivered += 1
 						self.extAgentsThread.fromNetwork.put(msg)
 
-					if not progress:
+					if delivered:
+						self.dockStats[dock] += delivered
+					else:
 						log.debug("Unknown dock %s, nobody processed.", dock)
 
 			except Exception, e:
@@ -191,18 +204,19 @@ class Daemon(threading.Thread):
 
 		
 	@agentmethod()
-	def loadAgent(self, msg, code, name, dock, tardata=None, path=None, execargs=None, idl=None):
+	def loadAgent(self, msg, code, name, dock, tardata=None, path=None, execargs=None, idl=None, digest=None):
 		"""
-			Primary use daemon method call to start agents as a thread or process
+			Primary use daemon method call to start agents as a thread or process.
+			The code is given as a digest, base64 tardata, a path or the name of an already extracted agent.
+			Code given by digest that isn't in the blob cache is fetched first, the agent starts once it arrives.
 		"""
 		# Safety check, don't overload dock from loadAgent
-		for tAgent in self.staticAgents + self.threadAgents:
-			if dock in tAgent.docklist:
-				log.info("Agent %s already loaded on dock %s. Returning successful \"load\".", tAgent, dock)
-				# Send complete anyhow, perhaps a flag to indicate already loaded, but don't stop event flow process
-				# 9/14: changed testbed.nodename to self.hostname to support desktop daemos 
-				self.messaging.trigger(event='AgentLoadDone', agent=name, nodes=[self.hostname])
-				return
+		if dock in self.docktable:
+			log.info("Agent %s already loaded on dock %s. Returning successful \"load\".", self.docktable.subscribers(dock)[0], dock)
+			# Send complete anyhow, perhaps a flag to indicate already loaded, but don't stop event flow process
+			# 9/14: changed testbed.nodename to self.hostname to support desktop daemos 
+			self.messaging.trigger(event='AgentLoadDone', agent=name, nodes=[self.hostname])
+			return
 
 		if self.extAgentsThread.wantsDock(dock):
 			log.info("Agent already loaded on dock %s. Returning successful \"load\".", dock)
@@ -229,7 +243,16 @@ class Daemon(threading.Thread):
 			cachepath = cachepath + "_" + self.hostname
 		
 		if tardata is not None:
-			self.extractTarBuffer(cachepath, tardata)
+			digest = self.blobCache.put(base64.b64decode(tardata))
+		
+		if digest is not None:
+			if self.codeDigest(cachepath) == digest:
+				log.debug("%s already holds blob %s", cachepath, digest)
+			elif self.blobCache.has(digest):
+				self.extractBlob(cachepath, digest)
+			else:
+				self.fetchBlob(digest, msg, dict(code=code, name=name, dock=dock, execargs=execargs, idl=idl, digest=digest))
+				return  # loaded when the blob arrives
 		elif path is not None:
 			self.extractTarPath(cachepath, path)
 		elif os.path.exists(code):
@@ -264,13 +287,15 @@ class Daemon(threading.Thread):
 				unloaded.append(i)
 		
 		if len(unloaded):
+			for i in unloaded:
+				self.docktable.removeAgent(self.threadAgents[i])
 			self.threadAgents[:] = [a for a in self.threadAgents if a.agentname != name]
 
 		# now check for process agents. If we find a dock, send the unload message to the 
 		# agent. If it is well behaving, it'll commit harikari after cleaning up its
 		# resources. 
 		if not len(unloaded):
-			data = yaml.load(msg.data)
+			data = loadMessageData(msg)
 			log.debug('message data: %s (%s)', data, type(data))
 			if not 'args' in data or not 'dock' in data['args']:
 				log.warning('No dock given in agentUnload. I do not know how to contact the'
@@ -379,10 +404,10 @@ class Daemon(threading.Thread):
 	
 	
 	@agentmethod()
-	def getStatus(self, msg, groupMembership=False, agentInfo=False):
+	def getStatus(self, msg, groupMembership=False, agentInfo=False, dockStats=False):
 		"""
 			gives the group membership and agent information: 
-			pid, agentname, threadId
+			pid, agentname, threadId, and the count of messages handed off per dock
         """ 
 		functionName = self.getStatus.__name__
 		helpers.entrylog(log, functionName, locals())
@@ -405,6 +430,9 @@ class Daemon(threading.Thread):
 								  "processId": self.pAgentPids[name]})
 			result['agentInfo'] = agentInfo
 		
+		if dockStats:
+			result['dockStats'] = dict(self.dockStats)
+		
 		self.messaging.send(MAGIMessage(nodes=msg.src, docks=msg.srcdock, 
 									    contenttype=MAGIMessage.YAML, 
 									    data=yaml.safe_dump(result)))	
@@ -531,7 +559,7 @@ class Daemon(threading.Thread):
 			if execstyle == 'thread':
 				# A agent should know the hostname and its own name  
 				from magi.daemon.threadInterface import ThreadedAgent
-				agent = ThreadedAgent(self.hostname, name, mainfile, dock, execargs, self.messaging)
+				agent = ThreadedAgent(self.hostname, name, mainfile, dock, execargs, self.messaging, self.docktable)
 				agent.start()
 				log.info("Started threaded agent %s", agent)
 				if static:
@@ -595,6 +623,7 @@ class Daemon(threading.Thread):
 		"""
 			Internal function to extract a tar file
 		"""
+		self.setCodeDigest(cachepath, None)
 		if os.path.isdir(path):
 			# Copy all files to cache
 			# TODO: make our own recursive copy that overwrites
@@ -614,27 +643,109 @@ class Daemon(threading.Thread):
 			tar.close()
 
 
-	def extractTarBuffer(self, cachepath, tardata):
+	def extractBlob(self, cachepath, digest):
 		"""
-			Internal function to extract files to disk from a tar data buffer
+			Internal function to extract files to disk from a cached tar blob
 		"""
-		# cache data to file
-		log.debug("Extracting source to %s", cachepath)
+		log.debug("Extracting blob %s to %s", digest, cachepath)
 		if os.path.exists(cachepath):
 			log.warning("%s already exists, overwriting", cachepath)
+			self.setCodeDigest(cachepath, None)
 		else:
 			os.mkdir(cachepath)
 
-		# decode tardata into a temp file
-		scratch = tempfile.TemporaryFile()
-		sp = cStringIO.StringIO(tardata)
-		base64.decode(sp, scratch)
-		sp.close()
-
-		# now untar that into the selected modules directory
-		scratch.seek(0)
-		tar = tarfile.open(fileobj=scratch, mode="r:") # don't allow tests for compression, broken on p24 w/ fileobj
+		tar = tarfile.open(name=self.blobCache.path(digest), mode="r:") # don't allow tests for compression, broken on p24 w/ fileobj
 		for m in tar.getmembers():
 			tar.extract(m, cachepath)
 		tar.close()
+		self.setCodeDigest(cachepath, digest)
+
+	def codeDigest(self, cachepath):
+		""" Digest of the blob the code directory was extracted from, None if not known """
+		try:
+			with open(os.path.join(cachepath, Daemon.CODEDIGEST)) as fp:
+				return fp.read().strip()
+		except IOError:
+			return None
+
+	def setCodeDigest(self, cachepath, digest):
+		marker = os.path.join(cachepath, Daemon.CODEDIGEST)
+		if digest is None:
+			if os.path.exists(marker):
+				os.remove(marker)
+			return
+		with open(marker, 'w') as fp:
+			fp.write(digest)
+
+	def fetchBlob(self, digest, msg, load):
+		""" Ask for a blob we don't have, load is called with loadAgent once it arrives """
+		fetch = self.blobFetches.get(digest)
+		if fetch is None:
+			fetch = self.blobFetches[digest] = BlobFetch(digest)
+			groups = list(msg.dstgroups) if msg is not None else []
+			self.requestBlob(fetch, groups)
+		fetch.waiting.append((msg, load))
+
+	def requestBlob(self, fetch, groups):
+		"""
+			Ask the orchestrator for the blob.  The first request asks for it to be sent to the groups the load 
+			went to, so it crosses each link once however many nodes need it.  Retries only ask for this node.
+		"""
+		fetch.requested = time.time()
+		fetch.tries += 1
+		args = {'digest': fetch.digest}
+		if groups:
+			args['groups'] = groups
+		else:
+			args['nodes'] = [self.hostname]
+		log.info("Requesting blob %s (try %d)", fetch.digest, fetch.tries)
+		call = {'version': 1.0, 'method': 'getBlob', 'args': args}
+		self.messaging.send(MAGIMessage(groups="control", docks="control", contenttype=MAGIMessage.YAML, 
+									    data=yaml.safe_dump(call)))
+
+	def checkFetches(self):
+		""" Ask again for blobs that haven't arrived, give up after BLOB_RETRIES """
+		now = time.time()
+		for digest, fetch in self.blobFetches.items():
+			if now - fetch.requested < Daemon.BLOB_RETRY:
+				continue
+			if fetch.tries < Daemon.BLOB_RETRIES:
+				self.requestBlob(fetch, None)
+				continue
+			del self.blobFetches[digest]
+			log.error("Blob %s never arrived", digest)
+			for msg, load in fetch.waiting:
+				self.messaging.trigger(event='RuntimeException', type='IOError', error="agent code %s never arrived" % digest,
+									   nodes=[self.hostname], agent=load['name'], func_name='loadAgent')
+
+	@agentmethod()
+	def putBlob(self, msg, digest, index, count, data):
+		"""
+			A chunk of a blob, sent to every node that may need it.  Once all the chunks have arrived
+			the blob is cached and the agents waiting for it are loaded.
+		"""
+		fetch = self.blobFetches.get(digest)
+		if fetch is None:
+			return  # not waiting for this one
+		if not fetch.add(index, count, data):
+			return
+		del self.blobFetches[digest]
+		try:
+			self.blobCache.put(fetch.data(), digest)
+		except BlobError, e:
+			log.error("Bad blob: %s, asking again", e)
+			retry = BlobFetch(digest)
+			retry.tries = fetch.tries
+			retry.waiting = fetch.waiting
+			self.blobFetches[digest] = retry
+			self.requestBlob(retry, None)
+			return
+		
+		for loadmsg, load in fetch.waiting:
+			try:
+				self.loadAgent(loadmsg, **load)
+			except Exception, e:
+				log.error("Loading agent %s from blob %s failed: %s", load['name'], digest, e, exc_info=1)
+				self.messaging.trigger(event='RuntimeException', type=e.__class__.__name__, error=str(e),
+									   nodes=[self.hostname], agent=load['name'], func_name='loadAgent')
 
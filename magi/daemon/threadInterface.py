@@ -14,13 +14,57 @@ import yaml
 
 log = logging.getLogger(__name__)
 
+
+class DockTable(object):
+	"""
+		Index of dock -> threaded agents listening on it, used by the daemon thread to hand off messages
+		without scanning every agent.  Agents listen and unlisten from their own threads, so changes take
+		a lock and replace the subscriber tuple, lookups on the daemon thread don't lock.
+	"""
+
+	EMPTY = ()
+
+	def __init__(self):
+		self.docks = dict()  # dock -> tuple of agents in listen order
+		self.lock = threading.Lock()
+
+	def add(self, dock, agent):
+		with self.lock:
+			subscribers = self.docks.get(dock, DockTable.EMPTY)
+			if agent not in subscribers:
+				self.docks[dock] = subscribers + (agent,)
+
+	def discard(self, dock, agent):
+		with self.lock:
+			subscribers = self.docks.get(dock, DockTable.EMPTY)
+			if agent in subscribers:
+				subscribers = tuple([a for a in subscribers if a is not agent])
+				if subscribers:
+					self.docks[dock] = subscribers
+				else:
+					del self.docks[dock]
+
+	def removeAgent(self, agent):
+		""" Agent was unloaded, drop it from every dock """
+		for dock in list(agent.docklist):
+			self.discard(dock, agent)
+
+	def subscribers(self, dock):
+		return self.docks.get(dock, DockTable.EMPTY)
+
+	def __contains__(self, dock):
+		return dock in self.docks
+
+
 class MessagingWrapper(object):
 	""" Wraps other components to provide a common interface to threaded agents """
-	def __init__(self, name, messaging, inqueue, docklist):
+	def __init__(self, name, messaging, inqueue, docklist, docktable=None, agent=None):
 		self.name = name
 		self.messaging = messaging
 		self.inqueue = inqueue
 		self.docklist = docklist
+		self.docktable = docktable
+		self.agent = agent  # the ThreadedAgent registered in docktable
 
 	def next(self, block=True, timeout=None):
 		""" Received the next message or a string "PoisinPill" if someone wants to wake up the waiting thread """
@@ -41,10 +85,14 @@ class MessagingWrapper(object):
 	def listenDock(self, dock):
 		""" Start listening for messages destined for 'dock' """
 		self.docklist.add(dock)
+		if self.docktable is not None:
+			self.docktable.add(dock, self.agent)
 
 	def unlistenDock(self, dock):
 		""" Stop listening for messages destined for 'dock' """
 		self.docklist.discard(dock)
+		if self.docktable is not None:
+			self.docktable.discard(dock, self.agent)
 
 	def trigger(self, **kwargs):
 		self.send(MAGIMessage(groups="control", docks="daemon", data=yaml.dump(kwargs), contenttype=MAGIMessage.YAML))
@@ -60,7 +108,7 @@ class ThreadedAgent(threading.Thread):
 		when the thread itself is started and *stop* when an external force requests that it stop.  Note that
 		*stop* will be called from a different thread than the one running the agent.
 	"""
-	def __init__(self, hostname, name, sourcepath, dock, args, messaging):
+	def __init__(self, hostname, name, sourcepath, dock, args, messaging, docktable=None):
 		threading.Thread.__init__(self, name=name)
 		self.daemon = True
 		log.debug("Loading source from %s with name %s", sourcepath, name)
@@ -80,6 +128,7 @@ class ThreadedAgent(threading.Thread):
 		self.docklist = set([dock])
 		self.rxqueue = Queue.Queue()
 		self.messaging = messaging
+		self.docktable = docktable
 		self.args = args
 		
 		if not self.args:
@@ -90,6 +139,8 @@ class ThreadedAgent(threading.Thread):
 		
 		# create the agent here, it may install software which is time consuming
 		self.agent = self.getAgent(**self.args)
+		if self.docktable is not None:
+			self.docktable.add(dock, self)
 
 		#send the load complete event to listeners
 		#9/16: Moved AgentLoadDone trigger to the daemon loadAgent call  
@@ -108,7 +159,7 @@ class ThreadedAgent(threading.Thread):
 				#self.agent.name = self.agentname
 				#self.agent.hostname = self.hostname
 				self.agent.docklist = self.docklist
-				self.agent.messenger = MessagingWrapper(self.agentname, self.messaging, self.rxqueue, self.docklist)
+				self.agent.messenger = MessagingWrapper(self.agentname, self.messaging, self.rxqueue, self.docklist, self.docktable, self)
 				self.agent.run()
 			except Exception, e:
 				log.error("Agent %s on %s threw an exception %s during main loop", self.agentname, self.hostname, e, exc_info=1)
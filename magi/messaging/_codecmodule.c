@@ -0,0 +1,322 @@
+/*
+ * Optional C accelerator for magi.messaging.magimessage.DefaultCodec.
+ *
+ * Mirrors encodeMagiMessage/decodeMagiMessage in magiCLib/MAGIMessage.c but works directly
+ * on the Python MAGIMessage object.  The wire format is described there:
+ *
+ * |TotalLength - 4B | HeaderLength - 2B | MsgID - 4B | Flags - 1B | ContentType - 1B| Options (TLV) |
+ *
+ * If this module is not built, DefaultCodec falls back to its pure python version.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+typedef enum {
+	SEQUENCE = 1,
+	TIMESTAMP = 2,
+	SEQUENCEID = 3,
+	HOSTTIME = 4,
+	SRC = 20,
+	SRCDOCK = 21,
+	HMAC = 22,
+	DSTNODES = 50,
+	DSTGROUPS = 51,
+	DSTDOCKS = 52
+} options_t;
+
+typedef struct {
+	options_t type;
+	const char *name;
+} option_t;
+
+/* Scalar options encoded here, destination options come in prebuilt from the caller */
+static const option_t scalarOptions[] = {
+	{ SEQUENCE, "sequence" },
+	{ TIMESTAMP, "timestamp" },
+	{ SEQUENCEID, "sequenceid" },
+	{ HOSTTIME, "hosttime" },
+	{ SRC, "src" },
+	{ SRCDOCK, "srcdock" },
+	{ HMAC, "hmac" },
+};
+#define NSCALAR (sizeof(scalarOptions) / sizeof(scalarOptions[0]))
+
+static const option_t setOptions[] = {
+	{ DSTNODES, "dstnodes" },
+	{ DSTGROUPS, "dstgroups" },
+	{ DSTDOCKS, "dstdocks" },
+};
+#define NSET (sizeof(setOptions) / sizeof(setOptions[0]))
+
+static void putU32(unsigned char *p, unsigned long v) {
+	p[0] = (v >> 24) & 0xFF;
+	p[1] = (v >> 16) & 0xFF;
+	p[2] = (v >> 8) & 0xFF;
+	p[3] = v & 0xFF;
+}
+
+static unsigned long getU32(const unsigned char *p) {
+	return ((unsigned long)p[0] << 24) | ((unsigned long)p[1] << 16) | ((unsigned long)p[2] << 8) | p[3];
+}
+
+/* Same as struct.unpack, int when it fits */
+static PyObject *u32Object(unsigned long v) {
+	if (v <= LONG_MAX)
+		return PyInt_FromLong((long)v);
+	return PyLong_FromUnsignedLong(v);
+}
+
+static int getU32Attr(PyObject *obj, const char *name, unsigned long *out) {
+	PyObject *val = PyObject_GetAttrString(obj, name);
+	unsigned long v;
+	if (val == NULL)
+		return -1;
+	v = PyInt_AsUnsignedLongMask(val);
+	Py_DECREF(val);
+	if (v == (unsigned long)-1 && PyErr_Occurred())
+		return -1;
+	if (v > 0xFFFFFFFFUL) {
+		PyErr_Format(PyExc_ValueError, "%s does not fit in 4 bytes", name);
+		return -1;
+	}
+	*out = v;
+	return 0;
+}
+
+/*
+ * encode(msg, destinations) -> str
+ * destinations is the already encoded TLV block for dstnodes, dstgroups and dstdocks
+ */
+static PyObject *codec_encode(PyObject *self, PyObject *args) {
+	PyObject *msg, *data, *result;
+	PyObject *values[NSCALAR];
+	const char *dests;
+	Py_ssize_t destlen, datalen = 0, optlen = 0, ii;
+	unsigned long msgid, flags, contenttype, headerlen, totallen, ival;
+	unsigned char *p;
+
+	if (!PyArg_ParseTuple(args, "Os#:encode", &msg, &dests, &destlen))
+		return NULL;
+
+	if (getU32Attr(msg, "msgid", &msgid) < 0 || getU32Attr(msg, "flags", &flags) < 0
+			|| getU32Attr(msg, "contenttype", &contenttype) < 0)
+		return NULL;
+
+	data = PyObject_GetAttrString(msg, "data");
+	if (data == NULL)
+		return NULL;
+	if (data != Py_None) {
+		datalen = PyObject_Size(data);
+		if (datalen < 0) {
+			Py_DECREF(data);
+			return NULL;
+		}
+	}
+	Py_DECREF(data);
+
+	/* First pass, collect values and the option block size */
+	for (ii = 0; ii < (Py_ssize_t)NSCALAR; ii++) {
+		values[ii] = PyObject_GetAttrString(msg, scalarOptions[ii].name);
+		if (values[ii] == NULL)
+			goto fail;
+		if (values[ii] == Py_None)
+			continue;
+		if (scalarOptions[ii].type < SRC) {
+			optlen += 6;
+		} else {
+			if (!PyString_Check(values[ii])) {
+				PyObject *str = PyObject_Str(values[ii]);  /* same as str(val) in the python version */
+				Py_DECREF(values[ii]);
+				values[ii] = str;
+				if (str == NULL)
+					goto fail;
+			}
+			if (PyString_GET_SIZE(values[ii]) > 255) {
+				PyErr_Format(PyExc_ValueError, "%s is longer than 255 bytes", scalarOptions[ii].name);
+				ii++;
+				goto fail;
+			}
+			optlen += 2 + PyString_GET_SIZE(values[ii]);
+		}
+	}
+
+	headerlen = 6 + optlen + destlen;
+	if (headerlen > 0xFFFF) {
+		PyErr_SetString(PyExc_ValueError, "header is larger than 65535 bytes");
+		goto fail;
+	}
+	totallen = 2 + headerlen + datalen;
+
+	result = PyString_FromStringAndSize(NULL, 6 + headerlen);
+	if (result == NULL)
+		goto fail;
+	p = (unsigned char *)PyString_AS_STRING(result);
+
+	putU32(p, totallen);
+	p[4] = (headerlen >> 8) & 0xFF;
+	p[5] = headerlen & 0xFF;
+	putU32(p + 6, msgid);
+	p[10] = flags & 0xFF;
+	p[11] = contenttype & 0xFF;
+	p += 12;
+
+	/* Second pass, write the values */
+	for (ii = 0; ii < (Py_ssize_t)NSCALAR; ii++) {
+		PyObject *val = values[ii];
+		if (val == Py_None)
+			continue;
+		p[0] = scalarOptions[ii].type;
+		if (scalarOptions[ii].type < SRC) {
+			ival = PyInt_AsUnsignedLongMask(val);
+			if (ival == (unsigned long)-1 && PyErr_Occurred()) {
+				Py_DECREF(result);
+				result = NULL;
+				break;
+			}
+			p[1] = 4;
+			putU32(p + 2, ival);
+			p += 6;
+		} else {
+			p[1] = (unsigned char)PyString_GET_SIZE(val);
+			memcpy(p + 2, PyString_AS_STRING(val), PyString_GET_SIZE(val));
+			p += 2 + PyString_GET_SIZE(val);
+		}
+	}
+
+	if (result != NULL)
+		memcpy(p, dests, destlen);
+	for (ii = 0; ii < (Py_ssize_t)NSCALAR; ii++)
+		Py_DECREF(values[ii]);
+	return result;
+
+fail:
+	while (ii-- > 0)
+		Py_XDECREF(values[ii]);
+	return NULL;
+}
+
+/*
+ * decode(headerbuf, msg) -> header length
+ * Fills in the header values of msg (a fresh MAGIMessage) from the encoded header
+ */
+static PyObject *codec_decode(PyObject *self, PyObject *args) {
+	PyObject *msg, *val, *target;
+	Py_buffer view;
+	const unsigned char *buf;
+	Py_ssize_t idx, end, ii;
+	unsigned int hdrlen, htype, hlen;
+	const char *name;
+	int rc;
+
+	if (!PyArg_ParseTuple(args, "s*O:decode", &view, &msg))
+		return NULL;
+	buf = (const unsigned char *)view.buf;
+
+	if (view.len < 12) {
+		PyErr_SetString(PyExc_ValueError, "header too short");
+		goto fail;
+	}
+
+	hdrlen = (buf[4] << 8) | buf[5];
+	end = hdrlen + 6;
+	if (end > view.len) {
+		PyErr_SetString(PyExc_ValueError, "header length larger than buffer");
+		goto fail;
+	}
+
+	val = u32Object(getU32(buf + 6));
+	rc = val == NULL ? -1 : PyObject_SetAttrString(msg, "msgid", val);
+	Py_XDECREF(val);
+	if (rc < 0) goto fail;
+	val = PyInt_FromLong(buf[10]);
+	rc = val == NULL ? -1 : PyObject_SetAttrString(msg, "flags", val);
+	Py_XDECREF(val);
+	if (rc < 0) goto fail;
+	val = PyInt_FromLong(buf[11]);
+	rc = val == NULL ? -1 : PyObject_SetAttrString(msg, "contenttype", val);
+	Py_XDECREF(val);
+	if (rc < 0) goto fail;
+
+	idx = 12;
+	while (idx < end) {
+		if (idx + 2 > end) {
+			PyErr_SetString(PyExc_ValueError, "truncated header option");
+			goto fail;
+		}
+		htype = buf[idx];
+		hlen = buf[idx+1];
+		idx += 2;
+		if (idx + hlen > (unsigned int)end) {
+			PyErr_SetString(PyExc_ValueError, "truncated header option");
+			goto fail;
+		}
+
+		name = NULL;
+		if (htype >= DSTNODES) {
+			for (ii = 0; ii < (Py_ssize_t)NSET; ii++)
+				if (setOptions[ii].type == htype) name = setOptions[ii].name;
+		} else {
+			for (ii = 0; ii < (Py_ssize_t)NSCALAR; ii++)
+				if (scalarOptions[ii].type == htype) name = scalarOptions[ii].name;
+		}
+
+		if (name == NULL) {
+			/* Don't understand the option, skip it like the python version */
+		} else if (htype < SRC) {
+			if (hlen != 4) {
+				PyErr_SetString(PyExc_ValueError, "integer header option must be 4 bytes");
+				goto fail;
+			}
+			val = u32Object(getU32(buf + idx));
+			rc = val == NULL ? -1 : PyObject_SetAttrString(msg, name, val);
+			Py_XDECREF(val);
+			if (rc < 0) goto fail;
+		} else if (htype < DSTNODES) {
+			val = PyString_FromStringAndSize((const char *)buf + idx, hlen);
+			if (val != NULL && htype != HMAC)
+				PyString_InternInPlace(&val);
+			rc = val == NULL ? -1 : PyObject_SetAttrString(msg, name, val);
+			Py_XDECREF(val);
+			if (rc < 0) goto fail;
+		} else {
+			target = PyObject_GetAttrString(msg, name);
+			if (target == NULL) goto fail;
+			val = PyString_FromStringAndSize((const char *)buf + idx, hlen);
+			if (val == NULL) {
+				Py_DECREF(target);
+				goto fail;
+			}
+			PyString_InternInPlace(&val);
+			if (PySet_Check(target)) {
+				rc = PySet_Add(target, val);
+			} else {
+				PyObject *ret = PyObject_CallMethod(target, "add", "O", val);
+				rc = ret == NULL ? -1 : 0;
+				Py_XDECREF(ret);
+			}
+			Py_DECREF(val);
+			Py_DECREF(target);
+			if (rc < 0) goto fail;
+		}
+		idx += hlen;
+	}
+
+	PyBuffer_Release(&view);
+	return PyInt_FromLong(hdrlen);
+
+fail:
+	PyBuffer_Release(&view);
+	return NULL;
+}
+
+static PyMethodDef codecMethods[] = {
+	{ "encode", codec_encode, METH_VARARGS, "encode(msg, destinations) -> encoded header" },
+	{ "decode", codec_decode, METH_VARARGS, "decode(headerbuf, msg) -> header length, fills in msg" },
+	{ NULL, NULL, 0, NULL }
+};
+
+PyMODINIT_FUNC init_codec(void) {
+	Py_InitModule3("_codec", codecMethods, "C accelerated MAGI message header codec");
+}
@@ -36,7 +36,8 @@ class Messenger(object):
 
 	def startDaemon(self):
 		"""
-			Start the thread that takes care of polling and scheduling for all the transports
+			Start the thread that takes care of polling and scheduling for all the transports.  Anything placed
+			in txqueue must be followed by a call to self.thread.wakeup() so the thread doesn't sit in poll.
 		"""
 		from worker import WorkerThread
 		self.thread = WorkerThread(self.name, self.txqueue, self.rxqueue)
@@ -52,6 +53,7 @@ class Messenger(object):
 			MulticastTransport('192.168.1.40', '255.239.13.4')
 		"""
 		self.txqueue.put(TransportRequest(transport, keepConnected))
+		self.thread.wakeup()
 
 	def join(self, group, caller = "default"):
 		""" 
@@ -61,6 +63,7 @@ class Messenger(object):
 			the same group doesn't cause the official leave to actually occur.
 		"""
 		self.txqueue.put(GroupRequest("join", group, caller))
+		self.thread.wakeup()
 		self.groupMembership[group].add(caller)
 
 	def leave(self, group, caller = "default"):
@@ -70,6 +73,7 @@ class Messenger(object):
 			If the caller joined with a caller value, it must use the same value for the leave request
 		"""
 		self.txqueue.put(GroupRequest("leave", group, caller))
+		self.thread.wakeup()
 		self.groupMembership[group].discard(caller)
 		if not self.groupMembership[group]:
 			del self.groupMembership[group]
@@ -86,6 +90,7 @@ class Messenger(object):
 			Enqueue a message for transmittal, kwargs is a list of delivery request values to specify desired delivery behavior
 		"""
 		self.txqueue.put(TransmitRequest(msg, kwargs))
+		self.thread.wakeup()
 
 	def trigger(self, **kwargs):
 		"""
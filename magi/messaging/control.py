@@ -0,0 +1,212 @@
+"""
+
+Compact encoding for the group and node router control messages.
+
+The routers exchange small dictionaries (add/del/set group lists, counts, digests, route requests and
+responses).  These used to always go out as YAML, which is slow to parse in pure python when a large
+experiment comes up.  The compact form is:
+
+| MAGIC - 1B | VERSION - 1B | Fields |
+
+where each field is | Tag - 1B | Length - varint | Value |.  Integers are unsigned varints, the digest
+is 8 bytes and group lists are sorted and delta encoded, each name stored as the length of the prefix
+it shares with the previous name (at most 127) followed by the rest of the name.  Unknown tags are skipped so fields
+can be added without a new version.
+
+The first byte of YAML text is never MAGIC, so decode() accepts either format.  Requests that the
+compact format can't represent are sent as YAML.  YAML uses the libyaml loader and dumper when available.
+
+"""
+
+import logging
+import struct
+import yaml
+from magi.messaging.magimessage import MAGIMessage
+
+log = logging.getLogger(__name__)
+
+try:
+	from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+	from yaml import SafeLoader, SafeDumper
+
+MAGIC = '\xc5'
+VERSION = 1
+DIGEST = struct.Struct('>Q')
+
+# tag -> (key, type)
+LIST = 1
+COUNT = 2
+FIXED64 = 3
+FLAG = 4
+STRING = 5
+FIELDS = {
+	1: ('add', LIST),
+	2: ('del', LIST),
+	3: ('set', LIST),
+	4: ('count', COUNT),
+	5: ('checksum', COUNT),
+	6: ('digest', FIXED64),
+	7: ('resend', FLAG),
+	8: ('request', STRING),
+	9: ('response', FLAG),
+	10: ('compact', COUNT),
+	11: ('requests', LIST),
+	12: ('routes', LIST),
+	13: ('hops', COUNT),
+	14: ('reply', FLAG),
+}
+TAGS = dict([(key, (tag, ftype)) for tag, (key, ftype) in FIELDS.iteritems()])
+
+
+class ControlError(Exception):
+	pass
+
+
+SMALL = [chr(ii) for ii in range(128)]
+
+def _varint(value):
+	if value < 0:
+		raise ControlError("negative value %d" % value)
+	out = []
+	while value > 0x7f:
+		out.append(chr((value & 0x7f) | 0x80))
+		value >>= 7
+	out.append(chr(value))
+	return ''.join(out)
+
+def _readVarint(data, idx):
+	value = 0
+	shift = 0
+	while True:
+		byte = ord(data[idx])
+		idx += 1
+		value |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return value, idx
+		shift += 7
+
+def _name(name):
+	if isinstance(name, unicode):
+		return name.encode('utf-8')
+	if not isinstance(name, str):
+		raise ControlError("can't encode %r as a name" % (name,))
+	return name
+
+def encodeList(names):
+	""" Sorted, prefix delta encoded list of names """
+	names = sorted([n if type(n) is str else _name(n) for n in names])
+	out = [_varint(len(names))]
+	last = ''
+	for name in names:
+		shared = 0  # binary search for the shared prefix length, string compares are much faster than a loop
+		limit = min(len(last), len(name), 127)
+		while shared < limit:
+			mid = (shared + limit + 1) >> 1
+			if last[:mid] == name[:mid]:
+				shared = mid
+			else:
+				limit = mid - 1
+		rest = len(name) - shared
+		out.append(SMALL[shared])
+		out.append(SMALL[rest] if rest < 128 else _varint(rest))
+		out.append(name[shared:])
+		last = name
+	return ''.join(out)
+
+def decodeList(data, idx=0):
+	""" Returns the list of names and the index after it """
+	count, idx = _readVarint(data, idx)
+	names = []
+	last = ''
+	for ii in xrange(count):
+		shared = ord(data[idx])  # always less than 128
+		length = ord(data[idx+1])
+		if length < 0x80:
+			idx += 2
+		else:
+			length, idx = _readVarint(data, idx+1)
+		last = last[:shared] + data[idx:idx+length]
+		idx += length
+		names.append(last)
+	return names, idx
+
+
+def encode(request):
+	""" Compact encoding of a control request, raises ControlError if it can't be represented """
+	out = [MAGIC, chr(VERSION)]
+	for key, value in request.iteritems():
+		if key == 'compact':
+			continue  # implied by the format
+		if key not in TAGS:
+			raise ControlError("no compact encoding for '%s'" % key)
+		tag, ftype = TAGS[key]
+		if ftype == LIST:
+			if isinstance(value, basestring):
+				raise ControlError("'%s' is not a list" % key)
+			field = encodeList(value)
+		elif ftype == COUNT:
+			field = _varint(int(value))
+		elif ftype == FIXED64:
+			field = DIGEST.pack(value)
+		elif ftype == FLAG:
+			if value is not True:
+				raise ControlError("'%s' is not a flag" % key)
+			field = ''
+		else:
+			field = _name(value)
+		out.append(chr(tag))
+		out.append(_varint(len(field)))
+		out.append(field)
+	return ''.join(out)
+
+def decode(data):
+	""" Decode a control request in either the compact or YAML format """
+	if not data or data[0] != MAGIC:
+		return yaml.load(data, Loader=SafeLoader)
+	return decodeCompact(data)
+
+def decodeCompact(data):
+	if len(data) < 2:
+		raise ControlError("truncated control message")
+	version = ord(data[1])
+	if version > VERSION:
+		raise ControlError("unsupported control message version %d" % version)
+	request = { 'compact': version }  # the sender understands this version
+	idx = 2
+	end = len(data)
+	try:
+		while idx < end:
+			tag = ord(data[idx])
+			length, idx = _readVarint(data, idx+1)
+			fieldend = idx + length
+			if fieldend > end:
+				raise ControlError("truncated control message")
+			if tag in FIELDS:
+				key, ftype = FIELDS[tag]
+				if ftype == LIST:
+					request[key] = decodeList(data, idx)[0]
+				elif ftype == COUNT:
+					request[key] = _readVarint(data, idx)[0]
+				elif ftype == FIXED64:
+					request[key] = DIGEST.unpack_from(data, idx)[0]
+				elif ftype == FLAG:
+					request[key] = True
+				else:
+					request[key] = data[idx:fieldend]
+			idx = fieldend
+	except (IndexError, struct.error):
+		raise ControlError("truncated control message")
+	return request
+
+def isCompact(data):
+	return bool(data) and data[0] == MAGIC
+
+def dump(request, compact):
+	""" Returns (contenttype, data) for a control request, compact if asked for and possible """
+	if compact:
+		try:
+			return MAGIMessage.BLOB, encode(request)
+		except ControlError, e:
+			log.debug("Sending control request as YAML: %s", e)
+	return MAGIMessage.YAML, yaml.dump(request, Dumper=SafeDumper)
@@ -8,6 +8,13 @@ from magi.util import helpers
 log = logging.getLogger(__name__)
 debug = False
 
+def toLazySet(value):
+	""" Like helpers.toSet, but empty values stay None so no set is allocated until it is needed """
+	if not value:
+		return None
+	return helpers.toSet(value)
+
+
 class MAGIMessage(object):
 	""" 
 		Represents the message object for sending messages between MAGI daemons.
@@ -21,6 +28,7 @@ class MAGIMessage(object):
 	YAML = 5
 	XML = 6
 	PICKLE = 7
+	JSON = 8
 
 	ISACK = 1
 	NOAGG = 2
@@ -39,6 +47,14 @@ class MAGIMessage(object):
 		52: 'dstdocks'
 	}
 
+	# Values carried on the wire, everything else is internal to the local daemon
+	WIREFIELDS = ('msgid', 'flags', 'contenttype', 'data', 'dstgroups', 'dstnodes', 'dstdocks',
+					'sequence', 'sequenceid', 'timestamp', 'hosttime', 'src', 'srcdock', 'hmac')
+
+	__slots__ = ['msgid', 'flags', 'contenttype', 'data', '_dstgroups', '_dstnodes', '_dstdocks',
+					'sequence', 'sequenceid', 'timestamp', 'hosttime', 'src', 'srcdock', 'hmac',
+					'_receivedon', '_appendedtoset', '_routed', '_userargsdict', '_orighdrlen']
+
 	def __init__(self, **kwargs):
 		""" 
 			Create a default message. 
@@ -50,9 +66,10 @@ class MAGIMessage(object):
 		self.contenttype = kwargs.pop('contenttype', MAGIMessage.NONE)
 		self.data = kwargs.pop('data', None)
 
-		self.dstgroups = helpers.toSet(kwargs.pop('groups', set()))
-		self.dstnodes  = helpers.toSet(kwargs.pop('nodes', set()))
-		self.dstdocks  = helpers.toSet(kwargs.pop('docks', set()))
+		# destination sets are only created when something is put in them or they are asked for
+		self._dstgroups = toLazySet(kwargs.pop('groups', None))
+		self._dstnodes  = toLazySet(kwargs.pop('nodes', None))
+		self._dstdocks  = toLazySet(kwargs.pop('docks', None))
 
 		self.sequence  = kwargs.pop('sequence', None)
 		self.sequenceid  = kwargs.pop('sequenceid', None)
@@ -65,15 +82,90 @@ class MAGIMessage(object):
 
 		# Internals, not used on the wire
 		self._receivedon = None   # interface we were received on
-		self._appendedto = set()  # marks when message is appended to an outgoing queue
+		self._appendedtoset = None  # marks when message is appended to an outgoing queue, see _appendedto
 		self._routed = None		  # marks when a message is routed to particular transports
-		self._userargs = {}		  # for messages entering locally, the user delivery args
+		self._userargsdict = None # for messages entering locally, the user delivery args, see _userargs
 		self._orighdrlen = 0      # for statistics
 
 		if len(kwargs) > 0:
 			log.error("Unknown arguments for MAGIMessage (%s)", kwargs)
 
 
+	def _getDstGroups(self):
+		if self._dstgroups is None:
+			self._dstgroups = set()
+		return self._dstgroups
+
+	def _setDstGroups(self, value):
+		self._dstgroups = value
+
+	def _getDstNodes(self):
+		if self._dstnodes is None:
+			self._dstnodes = set()
+		return self._dstnodes
+
+	def _setDstNodes(self, value):
+		self._dstnodes = value
+
+	def _getDstDocks(self):
+		if self._dstdocks is None:
+			self._dstdocks = set()
+		return self._dstdocks
+
+	def _setDstDocks(self, value):
+		self._dstdocks = value
+
+	def _getAppendedTo(self):
+		if self._appendedtoset is None:
+			self._appendedtoset = set()
+		return self._appendedtoset
+
+	def _setAppendedTo(self, value):
+		self._appendedtoset = value
+
+	def _getUserArgs(self):
+		if self._userargsdict is None:
+			self._userargsdict = {}
+		return self._userargsdict
+
+	def _setUserArgs(self, value):
+		self._userargsdict = value
+
+	dstgroups = property(_getDstGroups, _setDstGroups)
+	dstnodes = property(_getDstNodes, _setDstNodes)
+	dstdocks = property(_getDstDocks, _setDstDocks)
+	_appendedto = property(_getAppendedTo, _setAppendedTo)
+	_userargs = property(_getUserArgs, _setUserArgs)
+
+
+	def clone(self):
+		"""
+			Return a copy of the message that can be modified and queued separately.  The data is shared,
+			destination sets are copied if they exist, routing is kept and queue state starts fresh.
+		"""
+		new = MAGIMessage.__new__(MAGIMessage)
+		new.msgid = self.msgid
+		new.flags = self.flags
+		new.contenttype = self.contenttype
+		new.data = self.data
+		new._dstgroups = self._dstgroups and set(self._dstgroups) or None
+		new._dstnodes = self._dstnodes and set(self._dstnodes) or None
+		new._dstdocks = self._dstdocks and set(self._dstdocks) or None
+		new.sequence = self.sequence
+		new.sequenceid = self.sequenceid
+		new.timestamp = self.timestamp
+		new.hosttime = self.hosttime
+		new.src = self.src
+		new.srcdock = self.srcdock
+		new.hmac = self.hmac
+		new._receivedon = self._receivedon
+		new._appendedtoset = None
+		new._routed = self._routed
+		new._userargsdict = self._userargsdict
+		new._orighdrlen = self._orighdrlen
+		return new
+
+
 	def isAck(self):
 		return (self.flags & MAGIMessage.ISACK) != 0
 
@@ -105,13 +197,60 @@ class MAGIMessage(object):
 		return "In:%s,Out:%s (msgid:%s,flags:0x%X,conttype:%s) src:dock - %s:%s --> dstgroups:%s, dstnodes: %s, dstdocks: %s = data: %s"  % (self._receivedon, self._routed, self.msgid, self.flags, self.contenttype, self.src, self.srcdock, self.dstgroups, self.dstnodes, self.dstdocks, data)
 
 
+# Precompiled pieces of the wire format
+FIXEDHEADER = struct.Struct('>IHIBB')  # totallen, hdrlen, msgid, flags, contenttype
+INTOPTION = struct.Struct('>BBI')
+OPTIONHEADER = struct.Struct('>BB')
+UINT = struct.Struct('>I')
+
+try:
+	from magi.messaging import _codec
+except ImportError:
+	_codec = None  # not built, use the python version
+
+
 class DefaultCodec(object):
 	"""
 		A separate codec for encoding and decoding MAGI messages on via a messaging system transport.
 		Note all codec outputs must start with 6 bytes.  4 bytes for total message length and 2 bytes
 		for header length.  See :doc:`../messaging/wire` for more info.
+
+		The destination options (nodes, groups, docks) repeat from message to message so their encoded
+		block is cached.  If the _codec C extension is built, it is used for the rest of the header.
 	"""
 
+	INTOPTIONS = sorted((k, n) for k, n in MAGIMessage.OPTIONS.iteritems() if k < 20)
+	STROPTIONS = sorted((k, n) for k, n in MAGIMessage.OPTIONS.iteritems() if 20 <= k < 50)
+	SETOPTIONS = sorted((k, n) for k, n in MAGIMessage.OPTIONS.iteritems() if k >= 50)
+
+	INTERNED = (20, 21)  # src and srcdock repeat, the destination names are always interned
+
+	DESTCACHESIZE = 1024
+	destcache = dict()  # (dstnodes, dstgroups, dstdocks) -> encoded options
+
+	@classmethod
+	def encodeDestinations(cls, msg):
+		""" Return the encoded options block for the destinations of msg """
+		key = (frozenset(msg._dstnodes or ()), frozenset(msg._dstgroups or ()), frozenset(msg._dstdocks or ()))
+		block = cls.destcache.get(key)
+		if block is not None:
+			return block
+
+		options = list()
+		for (optkey, name), val in zip(cls.SETOPTIONS, key):
+			for item in val:
+				if item is None:
+					log.warning("Got a None value in key %s, skipping", optkey)
+				else:
+					options.append(OPTIONHEADER.pack(optkey, len(item)))
+					options.append(item)
+		block = ''.join(options)
+
+		if len(cls.destcache) >= cls.DESTCACHESIZE:
+			cls.destcache.clear()
+		cls.destcache[key] = block
+		return block
+
 	@classmethod
 	def encode(cls, msg):
 		"""
@@ -120,50 +259,50 @@ class DefaultCodec(object):
 			HeaderLength - 2 bytes
 			Encoded header pieces
 		"""
+		destinations = cls.encodeDestinations(msg)
+		if _codec is not None:
+			return _codec.encode(msg, destinations)
+
 		options = list()
-		for key, name in MAGIMessage.OPTIONS.iteritems():
+		for key, name in cls.INTOPTIONS:
 			val = getattr(msg, name)
 			if val is not None:
-				if key < 20:
-					options.append(struct.pack('>BBI', key, 4, val))
-				elif key < 50:
-					options.append(struct.pack('>BB%ds' % len(val), key, len(val), val))
-				else:
-					for item in val:
-						if item is None:
-							log.warning("Got a None value in key %s, skipping", key)
-						else:
-							options.append(struct.pack('>BB%ds' % len(item), key, len(item), item))
+				options.append(INTOPTION.pack(key, 4, val))
+		for key, name in cls.STROPTIONS:
+			val = getattr(msg, name)
+			if val is not None:
+				val = str(val)
+				options.append(OPTIONHEADER.pack(key, len(val)))
+				options.append(val)
+		options.append(destinations)
 
 		optionstr = ''.join(options)
 		headerlen = 6 + len(optionstr)
 		totallen =  2 + headerlen
 		if msg.data is not None:
 			totallen += len(msg.data)
-		return struct.pack('>IHIBB', totallen, headerlen, msg.msgid, msg.flags, msg.contenttype) + optionstr
+		return FIXEDHEADER.pack(totallen, headerlen, msg.msgid, msg.flags, msg.contenttype) + optionstr
 		
 
 	@classmethod
 	def decode(cls, headerbuf):
 		"""
 			Decodes header data and returns a new MAGIMessage with header information in a tuple with the total header size
-			headerbuf should include the same data as returned from encode
+			headerbuf should include the same data as returned from encode, it may be a string or buffer
 		"""
-		log.debug("Decoding MAGI message")
-		
 		newmsg = MAGIMessage()
-		(totallen, hdrlen, newmsg.msgid, newmsg.flags, newmsg.contenttype) = struct.unpack('>IHIBB', headerbuf[0:12])
+		if _codec is not None:
+			hdrlen = _codec.decode(headerbuf, newmsg)
+			newmsg._orighdrlen = hdrlen
+			return newmsg, hdrlen+6
+
+		(totallen, hdrlen, newmsg.msgid, newmsg.flags, newmsg.contenttype) = FIXEDHEADER.unpack_from(headerbuf, 0)
 		newmsg._orighdrlen = hdrlen
-		
-		log.debug("totallen: %d", totallen)
-		log.debug("hdrlen: %d", hdrlen)
-		log.debug("newmsg.msgid: %d", newmsg.msgid)
-		log.debug("newmsg.flags: %d", newmsg.flags)
-		log.debug("newmsg.contenttype: %d", newmsg.contenttype)
+		if debug: log.debug("Decoding MAGI message, totallen: %d, hdrlen: %d", totallen, hdrlen)
 		
 		idx = 12
 		while idx < hdrlen+6:
-			(htype, hlen) = struct.unpack('>BB', headerbuf[idx:idx+2])
+			(htype, hlen) = OPTIONHEADER.unpack_from(headerbuf, idx)
 			idx += 2
 			hname = MAGIMessage.OPTIONS.get(htype, None)
 			if debug: log.log(5, "setting option %s", hname)
@@ -171,13 +310,13 @@ class DefaultCodec(object):
 			if hname is None: 
 				log.warning("Don't understand header option %d, skipping", htype)
 			elif htype < 20:
-				setattr(newmsg, hname, struct.unpack('>I', headerbuf[idx:idx+hlen])[0])
+				setattr(newmsg, hname, UINT.unpack_from(headerbuf, idx)[0])
 			elif htype < 50:
-				setattr(newmsg, hname, headerbuf[idx:idx+hlen])
+				val = headerbuf[idx:idx+hlen]
+				setattr(newmsg, hname, htype in cls.INTERNED and intern(val) or val)
 			else:
-				getattr(newmsg, hname).add(headerbuf[idx:idx+hlen])
+				getattr(newmsg, hname).add(intern(headerbuf[idx:idx+hlen]))
 
 			idx += hlen
 
 		return newmsg, hdrlen+6
-
@@ -33,7 +33,7 @@ class MessageProcessor(object):
 		self.scheduler = scheduler
 		self.transports = transports
 		self.msgintf = msgintf
-		self.stats = stats
+		self.stats = stats if stats is not None else defaultdict(int)
 
 
 	def processMessages(self, qname, msglist, now):
@@ -80,35 +80,75 @@ class BlankRouter(MessageProcessor):
 		return set()
 
 
-class IdList(object):
+class IdWindow(object):
 	"""
-		Maintains list of last 149 to 199 unique IDs as a series of 4 sets.
-		As a set fills up, the oldest set is tossed and a new one added
+		Duplicate filter for the message ids from a single source, in the style of IPsec anti-replay.
+		Keeps the highest id seen and a bitmap of which of the WINDOW ids below it have been seen, so
+		memory is fixed and checks are constant time.  Ids compare with serial number arithmetic so the
+		32 bit id can wrap.  Ids older than the window are dropped as stale, unless they are so far off
+		that the source must have restarted with a new counter, in which case the window starts over.
 	"""
+	WINDOW = 1024
+	RESYNC = 65536
+	MASK = (1 << WINDOW) - 1
 
-	def __init__(self):
-		self.sets = [set()] * 4
+	__slots__ = ['top', 'bitmap', 'duplicates', 'stale']
 
-	def __contains__(self, val):
-		for s in self.sets:
-			if val in s:
-				return True
-		return False
+	def __init__(self):
+		self.top = None
+		self.bitmap = 0
+		self.duplicates = 0
+		self.stale = 0
+
+	def offset(self, value):
+		""" How far value is below the highest id seen, negative if above """
+		diff = (self.top - value) & 0xFFFFFFFF
+		if diff & 0x80000000:
+			diff -= 0x100000000
+		return diff
+
+	def __contains__(self, value):
+		if self.top is None:
+			return False
+		offset = self.offset(value)
+		if offset < 0 or offset >= IdWindow.WINDOW:
+			return False
+		return bool(self.bitmap >> offset & 1)
 
 	def __len__(self):
-		return sum([len(x) for x in self.sets])
+		""" Number of ids currently marked in the window """
+		return bin(self.bitmap).count('1')
 
 	def add(self, value):
 		"""
-			Add to our list if not already present, clean as required
+			Mark the id as seen, returns False if it is a duplicate or too old to tell
 		"""
-		if value in self:
-			return False
-		self.sets[-1].add(value)
-		if len(self.sets[-1]) >= 50:
-			self.sets.pop(0)
-			self.sets.append(set())
-		return True
+		if self.top is None:
+			self.top = value
+			self.bitmap = 1
+			return True
+
+		offset = self.offset(value)
+		if offset < 0:  # newer than anything so far, slide the window up
+			self.bitmap = ((self.bitmap << -offset) | 1) & IdWindow.MASK if -offset < IdWindow.WINDOW else 1
+			self.top = value
+			return True
+
+		if offset < IdWindow.WINDOW:
+			bit = 1 << offset
+			if self.bitmap & bit:
+				self.duplicates += 1
+				return False
+			self.bitmap |= bit
+			return True
+
+		if offset > IdWindow.RESYNC:  # restarted source with a new random counter
+			self.top = value
+			self.bitmap = 1
+			return True
+
+		self.stale += 1
+		return False
 
 
 class NameAndID(MessageProcessor):
@@ -120,21 +160,19 @@ class NameAndID(MessageProcessor):
 		MessageProcessor.__init__(self)
 		self.counter = random.randint(1, 2**31)
 #		self.counter = 1
-		self.lists = defaultdict(IdList)
+		self.lists = defaultdict(IdWindow)
 #		self.lastseenIds = defaultdict(int)
 
 	def processPRE(self, msglist, now):
-		""" Check for duplicate messages """
-		# TODO: works for only 200 last seen messages
+		""" Check for duplicate messages, window per source covers the last IdWindow.WINDOW ids """
 		passed = []
 		for msg in msglist:
-			log.debug("Checking for duplicate id %s:%d", msg.src, msg.msgid)
-			idlist = self.lists[msg.src]
-			if idlist.add(msg.msgid):
+			if debug: log.debug("Checking for duplicate id %s:%d", msg.src, msg.msgid)
+			if self.lists[msg.src].add(msg.msgid):
 				passed.append(msg)
 			else:
 				if debug: log.debug("Dropping duplicate id %s:%d", msg.src, msg.msgid)
-				log.debug("Dropping duplicate id %s:%d", msg.src, msg.msgid)
+				self.stats['duplicatesdropped'] += 1
 		return passed
 	
 #	def processPRE(self, msglist, now):
@@ -165,20 +203,26 @@ class NameAndID(MessageProcessor):
 
 class AckRequirement(MessageProcessor):
 	"""
-		Processor sets the ack flag when requested, monitors for the ack and schedules retransmit
+		Processor sets the ack flag when requested, monitors for the ack and schedules retransmit.
+		Inflight messages are indexed by msgid and their deadlines kept in a heap of (nextsend, msgid).
+		Heap entries are not removed when a message completes or is rescheduled, they are skipped
+		when they come up and no longer match the stored deadline.
 	"""
 	TIMEOUT = [0.5, 1.0, 2.0, 4.0, 8.0]
+	RTTGAIN = 0.125  # weight of a new sample in the smoothed ack round trip time
 
 	class InflightStore(object):
-		__slots__ = ['msg', 'nextsend', 'timerindex']
-		def __init__(self, m, n):
+		__slots__ = ['msg', 'nextsend', 'timerindex', 'senttime']
+		def __init__(self, m, n, s):
 			self.msg = m
 			self.nextsend = n
 			self.timerindex = 0
+			self.senttime = s
 
 	def __init__(self):
 		MessageProcessor.__init__(self)
 		self.inflight = dict()
+		self.deadlines = list()  # heap of (nextsend, msgid)
 
 	def processIN(self, msglist, now):
 		""" 
@@ -197,18 +241,26 @@ class AckRequirement(MessageProcessor):
 			old = self.inflight.get(ackid, None)
 			if old is None:
 				if debug: log.debug("Got ack for nothing, duplicate?")
+				self.stats['ackduplicates'] += 1
 				continue
 
 			# We find out which node or groups this ack is for and remove those from the required list
+			# Any other member of an already acked group, or a repeated node ack, changes nothing
 			if debug: log.debug("Got ack with %s", msg.data)
-			old.msg.dstnodes.discard(ackdata[1])
-			old.msg.dstgroups.difference_update(ackdata[2:])
+			dstnodes = old.msg.dstnodes
+			dstgroups = old.msg.dstgroups
+			if ackdata[1] not in dstnodes and dstgroups.isdisjoint(ackdata[2:]):
+				self.stats['ackduplicates'] += 1
+				continue
+			dstnodes.discard(ackdata[1])
+			dstgroups.difference_update(ackdata[2:])
 			
-			if len(old.msg.dstnodes) == 0 and len(old.msg.dstgroups) == 0:  # officially done
-				self.inflight.remove(ackid)
+			if len(dstnodes) == 0 and len(dstgroups) == 0:  # officially done
+				del self.inflight[ackid]
+				self.stats['ackscomplete'] += 1
+				if old.timerindex == 0:  # retransmitted acks are ambiguous, don't sample those
+					self.sampleRTT(now - old.senttime)
 				self.msgintf.messageStatus("Ack", True, old.msg)
-			else:
-				self.checkRetransmits()  # may need to reschedule now
 	
 		return passed
 
@@ -220,8 +272,10 @@ class AckRequirement(MessageProcessor):
 		for msg in msglist:
 			if msg._userargs.get('acknowledgement', False):
 				msg.flags |= MAGIMessage.WANTACK
-				self.inflight[msg.msgid] = AckRequirement.InflightStore(msg, now + AckRequirement.TIMEOUT[0])  # store with initial timeout
-				self.checkRetransmits()  # may need to reschedule now
+				store = AckRequirement.InflightStore(msg, now + AckRequirement.TIMEOUT[0], now)  # store with initial timeout
+				self.inflight[msg.msgid] = store
+				heapq.heappush(self.deadlines, (store.nextsend, msg.msgid))
+				self.scheduleMethod(self.checkRetransmits, store.nextsend)
 			else:
 				msg.flags &= ~MAGIMessage.WANTACK
 
@@ -230,31 +284,60 @@ class AckRequirement(MessageProcessor):
 
 	def checkRetransmits(self):
 		"""
-			Check for items that need a retransmit, send them and figure how
-			long to wait for the next one
-			@TODO we may want to store in a heap ordered by nextsend if this list gets large, that way we can cut out early
+			Send or drop whatever has passed its deadline and schedule ourselves for the next one
 		"""
 		now = time.time()
-		earliest = sys.maxint  # determines when we want to next push
-		for msgid in self.inflight.keys():
-			store = self.inflight[msgid]
-			if store.nextsend > now:
-				earliest = min(earliest, store.nextsend)
-				continue
+		deadlines = self.deadlines
+		while deadlines and deadlines[0][0] <= now:
+			nextsend, msgid = heapq.heappop(deadlines)
+			store = self.inflight.get(msgid)
+			if store is None or store.nextsend != nextsend:
+				continue  # acked or already rescheduled
 			
 			#TODO: currently tries to retransmit one time less than configured.
 			store.timerindex += 1
 			if store.timerindex >= len(AckRequirement.TIMEOUT):
 				if debug: log.debug("Dropping packet after too many retransmits, ID:%d", msgid)
 				del self.inflight[msgid]
+				self.stats['ackdrops'] += 1
 				self.msgintf.messageStatus("Dropping packet after too many retransmits", False, store.msg)
 			else:
 				if debug: log.debug("Retransmit %s", store.msg)
-				self.msgintf.sendDirect(store.msg)
+				self.stats['ackretransmits'] += 1
+				self.msgintf.sendDirect(store.msg.clone())  # later acks modify store.msg, not what is queued
 				store.nextsend += AckRequirement.TIMEOUT[store.timerindex]
-				earliest = min(earliest, store.nextsend)
+				heapq.heappush(deadlines, (store.nextsend, msgid))
+
+		self.cleanDeadlines()
+		if deadlines:
+			self.scheduleMethod(self.checkRetransmits, deadlines[0][0])
+
+
+	def cleanDeadlines(self):
+		"""
+			Drop stale entries from the top of the heap so we don't wake up for them, rebuild
+			the heap if completed messages make up most of it
+		"""
+		deadlines = self.deadlines
+		while deadlines:
+			nextsend, msgid = deadlines[0]
+			store = self.inflight.get(msgid)
+			if store is not None and store.nextsend == nextsend:
+				break
+			heapq.heappop(deadlines)
+
+		if len(deadlines) > 2 * len(self.inflight) + 64:
+			self.deadlines = [(store.nextsend, msgid) for msgid, store in self.inflight.iteritems()]
+			heapq.heapify(self.deadlines)
+
 
-		self.scheduleMethod(self.checkRetransmits, earliest)
+	def sampleRTT(self, rtt):
+		""" Keep a smoothed and max ack round trip time in stats """
+		if self.stats['ackrtt'] == 0:
+			self.stats['ackrtt'] = rtt
+		else:
+			self.stats['ackrtt'] += AckRequirement.RTTGAIN * (rtt - self.stats['ackrtt'])
+		self.stats['ackrttmax'] = max(self.stats['ackrttmax'], rtt)
 
 
 class AckReply(MessageProcessor):
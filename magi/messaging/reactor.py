@@ -0,0 +1,173 @@
+
+import asyncore
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+
+log = logging.getLogger(__name__)
+debug = False
+
+# epoll event values are the same as the poll values, asyncore.readwrite can decode either
+READFLAGS = select.POLLIN | select.POLLPRI
+WRITEFLAGS = select.POLLOUT
+ERRORFLAGS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+def setNonBlocking(fd):
+	""" Put the file descriptor in non blocking mode and make sure child processes don't inherit it """
+	fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+	fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+class Waker(object):
+	"""
+		Self pipe that lets other threads interrupt a blocking poll.  Wakeups that occur before the poller
+		drains the pipe are read together, and once the pipe is full further wakeups are dropped.  Wakeups
+		after close are ignored, so a late wake can't write into a reused descriptor.
+	"""
+
+	def __init__(self):
+		self.rfd, self.wfd = os.pipe()
+		setNonBlocking(self.rfd)
+		setNonBlocking(self.wfd)
+		self.lock = threading.Lock()
+
+	def wake(self):
+		""" Called from any thread, makes the read end of the pipe readable """
+		with self.lock:
+			if self.wfd is None:
+				return
+			try:
+				os.write(self.wfd, 'w')
+			except OSError, e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					raise
+
+	def drain(self):
+		""" Called from the polling thread, a wake during the read leaves its byte or the next one in the pipe """
+		try:
+			while os.read(self.rfd, 4096):
+				pass
+		except OSError, e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def close(self):
+		with self.lock:
+			os.close(self.rfd)
+			os.close(self.wfd)
+			self.wfd = None
+
+
+class Reactor(object):
+	"""
+		Persistent poll object for an asyncore style map of fd -> dispatcher.  Uses epoll when available,
+		otherwise select.poll.  Unlike asyncore.poll, the kernel registration is kept between calls and
+		only modified when a dispatcher changes its readable/writable state.  A blocking poll can be
+		interrupted by another thread by calling wakeup().
+	"""
+
+	def __init__(self):
+		if hasattr(select, 'epoll'):
+			self.poller = select.epoll()
+			self.timescale = 1.0   # epoll takes seconds
+		else:
+			self.poller = select.poll()
+			self.timescale = 1000.0  # poll takes milliseconds
+		self.registered = dict()  # fd -> event mask currently registered with the kernel
+		self.waker = Waker()
+		self.poller.register(self.waker.rfd, select.POLLIN)
+
+	def wakeup(self):
+		""" Thread safe, interrupt the current or next call to poll """
+		self.waker.wake()
+
+	def poll(self, timeout, map):
+		"""
+			Wait up to timeout seconds for events on any of the dispatchers in map or for a wakeup and
+			then dispatch those events.  A timeout of None waits until something happens.
+		"""
+		self.update(map)
+
+		if timeout is None:
+			timeout = -1
+		else:
+			timeout = max(0, timeout) * self.timescale
+
+		try:
+			events = self.poller.poll(timeout)
+		except (IOError, select.error), e:
+			if e.args[0] == errno.EINTR:
+				return
+			raise
+
+		for fd, flags in events:
+			if fd == self.waker.rfd:
+				self.waker.drain()
+				continue
+			obj = map.get(fd)
+			if obj is None:
+				continue
+			asyncore.readwrite(obj, flags)
+
+	def update(self, map):
+		""" Bring the kernel registrations in line with the current map and dispatcher states """
+		for fd in self.registered.keys():
+			if fd not in map:
+				self.unregister(fd)
+
+		for fd, obj in map.items():
+			flags = 0
+			if obj.readable():
+				flags |= READFLAGS
+			if obj.writable() and not obj.accepting:
+				flags |= WRITEFLAGS
+
+			if flags == 0:  # asyncore doesn't poll these either
+				if fd in self.registered:
+					self.unregister(fd)
+				continue
+
+			flags |= ERRORFLAGS
+			if self.registered.get(fd) == flags:
+				continue
+
+			try:
+				self.register(fd, flags)
+			except (IOError, OSError), e:
+				log.debug("Unable to register fd %d: %s", fd, e)
+				asyncore.readwrite(obj, select.POLLNVAL)
+
+	def register(self, fd, flags):
+		if fd in self.registered:
+			try:
+				self.poller.modify(fd, flags)
+			except (IOError, OSError), e:
+				if e.errno != errno.ENOENT:
+					raise
+				# fd was closed and reused behind our back, kernel already dropped the old entry
+				self.poller.register(fd, flags)
+		else:
+			try:
+				self.poller.register(fd, flags)
+			except (IOError, OSError), e:
+				if e.errno != errno.EEXIST:
+					raise
+				self.poller.modify(fd, flags)
+		if debug: log.debug("fd %d registered with flags 0x%x", fd, flags)
+		self.registered[fd] = flags
+
+	def unregister(self, fd):
+		del self.registered[fd]
+		try:
+			self.poller.unregister(fd)
+		except (IOError, OSError, KeyError, ValueError):
+			pass  # already closed, the kernel removed it for us
+
+	def close(self):
+		if hasattr(self.poller, 'close'):  # select.poll has nothing to close
+			self.poller.close()
+		self.waker.close()
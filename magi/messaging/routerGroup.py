@@ -32,90 +32,192 @@ Each transport will maintain another counting set for groups that it is requesti
 In this case, the counts represent the other transports that are requesting the group.  Once that number
 falls to zero, it no longer requests it and when its created, a new request is made.
 
+Group lists are verified with a 'digest', the sum of a hash of each group.  It doesn't depend on order
+so it is updated as groups come and go instead of recalculated.  Older daemons only know the sorted
+adler32 'checksum', so that is still sent out a transport until every neighbor on it has sent us a digest,
+and always on shared transports like multicast, where an older daemon can appear before we hear from it.
+Received messages are verified with the digest when they have one.
+
+Messages are encoded with magi.messaging.control.  YAML messages we send include our 'compact' version,
+once every neighbor on a transport has told us it understands the compact form we use it there.
+
 
 """
 
+import hashlib
 import logging
+import struct
 import zlib
-import yaml
 from collections import defaultdict
+from magi.messaging import control
 from magi.messaging.api import MAGIMessage
 from magi.messaging.processor import BlankRouter
 from magi.util.Collection import CountingSet
 
 log = logging.getLogger(__name__)
+debug = False
 
 
 class GroupStateError(Exception):
 	pass
 
 def listChecksum(grouplist):
-	""" Calculate the checksum used in router messages """
+	""" Calculate the checksum used in router messages by older daemons """
 	checksum = 1  # same as Adler32 in java zlib
 	for group in sorted(grouplist):
 		checksum = zlib.adler32(group, checksum) 
 	return checksum & 0xffffffff
 
+DIGESTMASK = 0xffffffffffffffff
+
+HASHCACHESIZE = 65536
+hashCache = dict()
+
+def groupHash(group):
+	""" 64 bit hash of a single group name, the same on all platforms """
+	value = hashCache.get(group)
+	if value is None:
+		if len(hashCache) >= HASHCACHESIZE:
+			hashCache.clear()
+		value = hashCache[group] = struct.unpack('>Q', hashlib.md5(group).digest()[:8])[0]
+	return value
+
+def listDigest(grouplist):
+	""" Order independent digest of a group list, the sum of the group hashes """
+	return sum([groupHash(group) for group in grouplist]) & DIGESTMASK
+
+def digestAdd(digest, groups):
+	""" Digest after adding groups that weren't already present """
+	return (digest + sum([groupHash(group) for group in groups])) & DIGESTMASK
+
+def digestRemove(digest, groups):
+	""" Digest after removing groups that were present """
+	return (digest - sum([groupHash(group) for group in groups])) & DIGESTMASK
+
 
 
 class NeighborGroupList(object):
 	"""
 		Storage of current state information for a single node on a transport directly connected to us
 		nodeGroups - the groups this neighbor requested
-		checksum - the calculated checksum of the group list in sorted() order
+		digest - the digest of nodeGroups, kept up to date as groups are added and removed
+		legacy - True until the neighbor sends us a digest, it needs the older checksum from us
+		compact - the compact control version the neighbor understands, 0 for YAML only
 	"""
-	__slots__ = ['nodeGroups', 'checksum']
+	__slots__ = ['nodeGroups', 'digest', 'legacy', 'compact']
 	def __init__(self):
 		self.nodeGroups = set()
-		self.checksum = 0
+		self.digest = 0
+		self.legacy = True
+		self.compact = 0
 
-	def _verify(self, count, checksum):
+	def _verify(self, count, checksum, digest=None):
 		if len(self.nodeGroups) != count:
 			raise GroupStateError("Invalid group count, local %d vs remote %d" % (len(self.nodeGroups), count))
+		if digest is not None:
+			if self.digest != digest:
+				raise GroupStateError("Invalid digest, local %d vs remote %d" % (self.digest, digest))
+			return
 		localchecksum = listChecksum(self.nodeGroups)
 		if localchecksum != checksum:
 			raise GroupStateError("Invalid checksum, local %d vs remote %d" % (localchecksum, checksum))
 
-	def add(self, count, checksum, groupset):
+	def add(self, count, checksum, groupset, digest=None):
 		ret = groupset - self.nodeGroups  # return only what gets added, ignore doubles
 		self.nodeGroups |= ret
+		olddigest = self.digest
+		self.digest = digestAdd(self.digest, ret)
 		try:
-			self._verify(count, checksum)
+			self._verify(count, checksum, digest)
 		except:
 			#Reset nodeGroups to original state before sending back exception
 			self.nodeGroups -= ret
+			self.digest = olddigest
 			raise
 		return ret
 
-	def remove(self, count, checksum, groupset):
+	def remove(self, count, checksum, groupset, digest=None):
 		ret = groupset & self.nodeGroups # return only what gets removed, i.e. we don't remove what isn't already there
 		self.nodeGroups -= ret
+		olddigest = self.digest
+		self.digest = digestRemove(self.digest, ret)
 		try:
-			self._verify(count, checksum)
+			self._verify(count, checksum, digest)
 		except:
 			#Reset nodeGroups to original state before sending back exception
 			self.nodeGroups |= ret
+			self.digest = olddigest
 			raise
 		return ret
 
-	def newlist(self, count, checksum, groupset):
+	def newlist(self, count, checksum, groupset, digest=None):
 		nodeGroupsCopy = set(self.nodeGroups) #to reset in case verification fails
 		add = groupset - self.nodeGroups # All entries that are new to the list
 		remove = self.nodeGroups - groupset # All entries that are no longer in the new list
 		self.nodeGroups = groupset
+		olddigest = self.digest
+		self.digest = digestRemove(digestAdd(self.digest, add), remove)
 		try:
-			self._verify(count, checksum)
+			self._verify(count, checksum, digest)
 		except GroupStateError:
 			# this is really bad if the checksum fails here, it means we are not calculating correctly
-			log.severe("Received a new list but checks failed.")
+			log.error("Received a new list but checks failed.")
 			#Reset nodeGroups to original state before sending back exception
 			self.nodeGroups = nodeGroupsCopy
+			self.digest = olddigest
 			raise
 		return (add, remove)
 
 
 
 
+class GroupIndex(object):
+	"""
+		Inverted index of group name to the set of transport filenos whose txGroups contain it.  It is
+		updated from the txGroups CountingSet transitions, so routing is a union of prebuilt sets.  Routing
+		results are cached by destination groups until the index changes.
+	"""
+
+	CACHESIZE = 4096
+
+	def __init__(self):
+		self.filenos = dict()  # group -> set(fileno)
+		self.cache = dict()  # frozenset(dstgroups) -> set(fileno)
+
+	def add(self, groups, fileno):
+		for group in groups:
+			self.filenos.setdefault(group, set()).add(fileno)
+		if groups:
+			self.cache.clear()
+
+	def remove(self, groups, fileno):
+		for group in groups:
+			filenos = self.filenos.get(group)
+			if filenos is None:
+				continue
+			filenos.discard(fileno)
+			if not filenos:
+				del self.filenos[group]
+		if groups:
+			self.cache.clear()
+
+	def route(self, dstgroups):
+		""" Set of filenos that have a request for any of dstgroups """
+		key = frozenset(dstgroups)
+		ret = self.cache.get(key)
+		if ret is None:
+			ret = set()
+			for group in key:
+				filenos = self.filenos.get(group)
+				if filenos:
+					ret |= filenos
+			if len(self.cache) >= GroupIndex.CACHESIZE:
+				self.cache.clear()
+			self.cache[key] = ret
+		return set(ret)
+
+
+
 class TransportGroupList(object):
 	"""
 		Storage for group information on a single transport.
@@ -123,21 +225,35 @@ class TransportGroupList(object):
 		srccache - a mapping from src node to NeighborGroupList, needed for removal on shared transports like multicast
 		txGroups - the list of actual groups to send out this transport based on info from neighbors
 		rxGroups - the list that is sent out this transport to inform others of our list of groups we want to route/receive
+		rxDigest - digest of rxGroups, updated when groups are created or removed from it
+		index - the router GroupIndex, told whenever a group appears in or disappears from txGroups
+		shared - True if neighbors we haven't heard from may get our messages, so the checksum is always sent
 	"""
 	
-	__slots__ = ['msgintf', 'fileno', 'srccache', 'txGroups', 'rxGroups']
-	def __init__(self, msgintf, fileno):
+	__slots__ = ['msgintf', 'fileno', 'srccache', 'txGroups', 'rxGroups', 'rxDigest', 'index', 'shared']
+	def __init__(self, msgintf, fileno, index=None, shared=False):
 		self.msgintf = msgintf
 		self.fileno = fileno
+		self.shared = shared
 		self.srccache = dict()
 		self.txGroups = CountingSet() 
 		self.rxGroups = CountingSet()
+		self.rxDigest = 0
+		if index is None:
+			index = GroupIndex()
+		self.index = index
 
 	def join(self, group):
-		return self.txGroups.inc(group)
+		if self.txGroups.inc(group):
+			self.index.add([group], self.fileno)
+			return True
+		return False
 			
 	def leave(self, group):
-		return self.txGroups.dec(group)
+		if self.txGroups.dec(group):
+			self.index.remove([group], self.fileno)
+			return True
+		return False
 			
 	def processMessage(self, src, request):
 		"""
@@ -151,37 +267,75 @@ class TransportGroupList(object):
 
 		tadded = list()
 		tremoved = list()
+		checksum = request.get('checksum')
+		digest = request.get('digest')
+		nentry.legacy = digest is None
+		nentry.compact = request.get('compact', 0)
 
 		try:
 			if 'add' in request:
-				added = nentry.add(request['count'], request['checksum'], set(request['add']))
+				added = nentry.add(request['count'], checksum, set(request['add']), digest)
 				tadded = self.txGroups.incGroup(added)
+				self.index.add(tadded, self.fileno)
 	
 			if 'del' in request:
-				removed = nentry.remove(request['count'], request['checksum'], set(request['del']))
+				removed = nentry.remove(request['count'], checksum, set(request['del']), digest)
 				tremoved = self.txGroups.decGroup(removed)
+				self.index.remove(tremoved, self.fileno)
 				
 			if 'set' in request:
 				if 'add' in request or 'del' in request:
 					log.error("Got a group route message with a bad set of requests (%s)", request.keys())
 				else:
-					if request['count'] == len(nentry.nodeGroups) and request['checksum'] == nentry.checksum: 
+					if digest is not None and request['count'] == len(nentry.nodeGroups) and digest == nentry.digest: 
 						return ([], []) # Nothing actually changed according to our list, shortcut it here
 					
-					(added, removed) = nentry.newlist(request['count'], request['checksum'], set(request['set']))
+					(added, removed) = nentry.newlist(request['count'], checksum, set(request['set']), digest)
 					tadded = self.txGroups.incGroup(added)
 					tremoved = self.txGroups.decGroup(removed)
+					self.index.add(tadded, self.fileno)
+					self.index.remove(tremoved, self.fileno)
 	
 		except GroupStateError:
-			msg = MAGIMessage(contenttype=MAGIMessage.YAML, nodes=[src], docks=[GroupRouter.DOCK], data=yaml.safe_dump({'resend':True}))
-			msg._routed = [self.fileno]
-			self.msgintf.send(msg)
+			self.msgintf.send(self.controlMessage({'resend':True}, nodes=[src]))
 			raise
 
 		# Return the lists that we changed
 		return (tadded, tremoved)
 
 
+	def rxIncGroup(self, groups):
+		""" Increment rxGroups, return the groups that were created """
+		added = self.rxGroups.incGroup(groups)
+		self.rxDigest = digestAdd(self.rxDigest, added)
+		return added
+
+	def rxDecGroup(self, groups):
+		""" Decrement rxGroups, return the groups that were removed """
+		removed = self.rxGroups.decGroup(groups)
+		self.rxDigest = digestRemove(self.rxDigest, removed)
+		return removed
+
+	def listInfo(self, request):
+		""" Add the count and digest of rxGroups to an outgoing request, plus the checksum if any neighbor needs it """
+		request['count'] = len(self.rxGroups)
+		request['digest'] = self.rxDigest
+		if self.shared or not self.srccache or any([n.legacy for n in self.srccache.itervalues()]):
+			request['checksum'] = listChecksum(self.rxGroups)
+		return request
+
+	def controlMessage(self, request, **kwargs):
+		""" Group router message for this transport, compact when all the neighbors understand it """
+		compact = False
+		if GroupRouter.COMPACT:
+			compact = len(self.srccache) > 0 and all([n.compact for n in self.srccache.itervalues()])
+			request['compact'] = control.VERSION
+		(contenttype, data) = control.dump(request, compact)
+		msg = MAGIMessage(contenttype=contenttype, docks=[GroupRouter.DOCK], data=data, **kwargs)
+		msg._routed = [self.fileno]
+		return msg
+
+
 	def requestChanges(self, added, deleted):
 		"""
 			Caller is letting us know that another transport has changed the list of groups it wishes to know about.
@@ -190,30 +344,21 @@ class TransportGroupList(object):
 		if self.fileno == 0:
 			return # shortcut for localhost
 
-		# Determine what addition message to send, if any
+		# Determine what addition message to send, if any, only what is actually new to us
 		request = dict()
-		additions = list()
-		for g in added:
-			if self.rxGroups.inc(g):
-				additions.append(g)  # This is actually new to us
+		additions = self.rxIncGroup(added)
 		if len(additions) > 0:
 			request['add'] = additions
 
-		# Determine what removal message to send, if any
-		deletions = list()
-		for g in deleted:
-			if self.rxGroups.dec(g):
-				deletions.append(g)  # Noone appears to want this anymore
+		# Determine what removal message to send, if any, only what noone appears to want anymore
+		deletions = self.rxDecGroup(deleted)
 		if len(deletions) > 0:
 			request['del'] = deletions
 		
 		# If something did change send out the updates
 		if len(additions) > 0 or len(deletions) > 0:
-			request['count'] = len(self.rxGroups)
-			request['checksum'] = listChecksum(self.rxGroups)
-			msg = MAGIMessage(contenttype=MAGIMessage.YAML, groups=[GroupRouter.ONEHOPNODES], docks=[GroupRouter.DOCK], data=yaml.safe_dump(request))
+			msg = self.controlMessage(self.listInfo(request), groups=[GroupRouter.ONEHOPNODES])
 			log.debug("Sending request for group changes to neighbors: %s", msg)
-			msg._routed = [self.fileno]
 			self.msgintf.send(msg)
 
 
@@ -230,10 +375,12 @@ class GroupRouter(BlankRouter):
 	ALLNODES = "__ALL__"
 	ONEHOPNODES = "__NEIGH__"
 	DOCK = "__GROUPS__"
+	COMPACT = True  # offer and use the compact control format
 
 	def __init__(self):
 		BlankRouter.__init__(self)
 		self.transportGroupLists = dict()
+		self.groupIndex = GroupIndex()  # group -> transports that want it, shared with the TransportGroupLists
 		self.ackHolds = dict() # storage for group ack aggregation
 		self.localGroupFlags = defaultdict(set)  # used to filter local join/leave requests when multiple callers are involved
 
@@ -241,7 +388,7 @@ class GroupRouter(BlankRouter):
 	def configure(self, name="missing", scheduler=None, msgintf=None, transports=None, stats=None, **kwargs):
 		""" Can't finish our initialization until we get a msgintf pointer """
 		BlankRouter.configure(self, name, scheduler, msgintf, transports, stats, **kwargs)
-		self.transportGroupLists[0] = TransportGroupList(self.msgintf, 0)
+		self.transportGroupLists[0] = TransportGroupList(self.msgintf, 0, self.groupIndex)
 
 
 	def groupRequest(self, req):
@@ -296,18 +443,10 @@ class GroupRouter(BlankRouter):
 		log.debug("Processing group router msg: %s", msg)
 		try:
 			tgl = self.transportGroupLists[msg._receivedon.fileno()]
-			request = yaml.load(msg.data)
-			response = None
+			request = control.decode(msg.data)
 
 			if 'resend' in request:
-				response = {
-					'set': list(tgl.rxGroups),
-					'count': len(tgl.rxGroups),
-					'checksum': listChecksum(tgl.rxGroups)
-				}
-				listmsg = MAGIMessage(contenttype=MAGIMessage.YAML, nodes=[msg.src], docks=[GroupRouter.DOCK], data=yaml.safe_dump(response))
-				listmsg._routed = [msg._receivedon.fileno()]
-				self.msgintf.send(listmsg)
+				self.msgintf.send(tgl.controlMessage(tgl.listInfo({ 'set': list(tgl.rxGroups) }), nodes=[msg.src]))
 
 			else:
 				# Discover what actually changed
@@ -398,7 +537,7 @@ class GroupRouter(BlankRouter):
 
 	def routeMessage(self, msg):
 		""" Return a list of all the transport filenos this message should be sent out based on group names """
-		log.debug("Message to be routed: %s", msg)
+		if debug: log.debug("Message to be routed: %s", msg)
 		#log.debug("Routing message to destination groups: %s", msg.dstnodes)
 		if GroupRouter.ALLNODES in msg.dstgroups:
 			return set(self.transports.keys())
@@ -409,39 +548,31 @@ class GroupRouter(BlankRouter):
 			else:
 				return set([0])
 
-		ret = set()
-		for fileno, tgl in self.transportGroupLists.iteritems():
-			for dgroup in msg.dstgroups:
-				if dgroup in tgl.txGroups:
-					ret.add(fileno)
-					
-		log.debug("Message routed on transports: %s", ret)
+		# doesn't depend on the receiving transport, the worker takes that out afterwards
+		ret = self.groupIndex.route(msg.dstgroups)
+		if debug: log.debug("Message routed on transports: %s", ret)
 		return ret
 
 
 	def transportAdded(self, transport):
 		""" When a transport comes up, add it to our list """
-		newtgl = TransportGroupList(self.msgintf, transport.fileno()) 
+		newtgl = TransportGroupList(self.msgintf, transport.fileno(), self.groupIndex, transport.shared())
 		self.transportGroupLists[transport.fileno()] = newtgl
 
 		# Remember, rxGroups = Union(all other txgroups), need to rebuild this one as its blank right now
 		for othertgl in self.transportGroupLists.itervalues():
 			if othertgl is newtgl: continue
-			newtgl.rxGroups.incGroup(othertgl.txGroups.keys())
+			newtgl.rxIncGroup(othertgl.txGroups.keys())
 
 		log.info("added transport %s, init rxgroup to: %s", transport, newtgl.rxGroups)
 		# ask neighbors to resend
-		resend = MAGIMessage(contenttype=MAGIMessage.YAML, groups=[GroupRouter.ONEHOPNODES], docks=[GroupRouter.DOCK], data=yaml.safe_dump({'resend':True}))
-		resend._routed = [transport.fileno()]
+		resend = newtgl.controlMessage({'resend':True}, groups=[GroupRouter.ONEHOPNODES])
 		log.info("Sending transport add message %s", resend)
 		self.msgintf.send(resend)
 
 		#if len(newtgl.rxGroups) > 0: #Always send out a group list, as neighbors might have a stale copy
 		log.debug("Sending a group list out for the newly initialized transport")
-		response = { 'set': list(newtgl.rxGroups), 'count': len(newtgl.rxGroups), 'checksum': listChecksum(newtgl.rxGroups) }
-		listmsg = MAGIMessage(contenttype=MAGIMessage.YAML, groups=[GroupRouter.ONEHOPNODES], docks=[GroupRouter.DOCK], data=yaml.safe_dump(response))
-		listmsg._routed = [transport.fileno()]
-		self.msgintf.send(listmsg)
+		self.msgintf.send(newtgl.controlMessage(newtgl.listInfo({ 'set': list(newtgl.rxGroups) }), groups=[GroupRouter.ONEHOPNODES]))
 
 
 	def transportRemoved(self, fd, ignored):
@@ -451,6 +582,7 @@ class GroupRouter(BlankRouter):
 		for othertgl in self.transportGroupLists.itervalues():
 			if othertgl is tgl: continue
 			othertgl.requestChanges([], tgl.txGroups)
+		self.groupIndex.remove(tgl.txGroups.keys(), fd)
 		del self.transportGroupLists[fd]
 
 
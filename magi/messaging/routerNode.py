@@ -1,8 +1,8 @@
 
 import logging
 import time
-import yaml
 from collections import defaultdict
+from magi.messaging import control
 from magimessage import MAGIMessage
 from processor import BlankRouter
 from routerGroup import GroupRouter
@@ -14,39 +14,144 @@ PausedMessage = namedtuple("PausedMessage", "msg, rxtransport")
 
 
 class NodeEntry(object):
-	__slots__ = ['fileno', 'touched']
-	def __init__(self, fileno):
-		self.update(fileno)
+	__slots__ = ['fileno', 'touched', 'referenced', 'slot']
+	def __init__(self, fileno, now, slot):
+		self.slot = slot
+		self.update(fileno, now)
 
-	def update(self, fileno):
+	def update(self, fileno, now):
 		self.fileno = fileno
-		self.touched = time.time()
+		self.touched = now
+		self.referenced = True
+
+
+class RouteCache(object):
+	"""
+		Node name to nexthop fileno, holding at most 'size' routes.  When full, the CLOCK approximation of
+		LRU picks the route to evict: lookups mark a route as referenced and the clock hand passes over
+		ring slots clearing the marks until it finds one that wasn't used since its last pass.
+		Routes that haven't been confirmed by a response or traffic from the node in 'ttl' seconds are
+		dropped when they are next looked up, so a new route request goes out.
+	"""
+
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		self.entries = dict()
+		self.ring = list()  # node names in clock order, None for free slots
+		self.free = list()  # free slot indexes
+		self.hand = 0
+		self.evicted = 0
+		self.expired = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, node):
+		return node in self.entries
+
+	def get(self, node, now):
+		""" Returns the fileno for node or None if there is no current route """
+		entry = self.entries.get(node)
+		if entry is None:
+			return None
+		if now - entry.touched > self.ttl:
+			self.expired += 1
+			self.remove(node)
+			return None
+		entry.referenced = True
+		return entry.fileno
+
+	def put(self, node, fileno, now):
+		""" Add or update the route for node """
+		entry = self.entries.get(node)
+		if entry is not None:
+			entry.update(fileno, now)
+			return
+
+		if self.free:
+			slot = self.free.pop()
+		elif len(self.ring) < self.size:
+			slot = len(self.ring)
+			self.ring.append(None)
+		else:
+			slot = self.evict()
+		self.ring[slot] = node
+		self.entries[node] = NodeEntry(fileno, now, slot)
+
+	def evict(self):
+		""" Run the clock hand to an unreferenced route, remove it and return its slot """
+		ring = self.ring
+		while True:
+			entry = self.entries[ring[self.hand]]
+			slot = self.hand
+			self.hand = (self.hand + 1) % len(ring)
+			if entry.referenced:
+				entry.referenced = False
+				continue
+			del self.entries[ring[slot]]
+			self.evicted += 1
+			return slot
+
+	def confirm(self, node, fileno, now):
+		""" Traffic from node arrived on fileno, refresh the route if it goes the same way """
+		entry = self.entries.get(node)
+		if entry is not None and entry.fileno == fileno:
+			entry.touched = now
+
+	def remove(self, node):
+		entry = self.entries.pop(node, None)
+		if entry is not None:
+			self.ring[entry.slot] = None
+			self.free.append(entry.slot)
+
+	def removeFileno(self, fileno):
+		""" Drop all the routes through fileno """
+		for node in [node for node, entry in self.entries.iteritems() if entry.fileno == fileno]:
+			self.remove(node)
 
 
 class NodeRouter(BlankRouter):
 	"""
-		Maintains cache of nexthops for node names.
-		When cache meets its max size, throw out items touched the longest time ago
-		Also maintains a list of messages that are waiting for node routes
+		Maintains cache of nexthops for node names, see RouteCache.
+		Also maintains a list of messages that are waiting for node routes.  At most MAXPAUSED messages
+		wait for any one node and MAXPAUSEDTOTAL overall, further messages are dropped and counted in the
+		'pauseddropped' stat.
+
+		Older daemons find routes with a 'request' for one node flooded to every node, which the node
+		answers with a flooded 'response'.  Newer daemons say which version of hop by hop discovery they
+		understand ('hops') and which compact control version ('compact') when they send their name and
+		cached routes as 'routes' to the neighbors on a new transport.  On a transport where every known
+		neighbor has done that (the neighbors are the ones the group router has heard from), nodes needing
+		routes are collected for REQUESTDELAY and sent to the neighbors as one 'requests' list, compact when
+		they all understand it.  A neighbor that has a route, or is one of the nodes, answers with 'routes',
+		otherwise it asks its own other transports the same way and passes the answers back.  Answers going
+		to one transport in the same tick are merged, so a burst of messages to many unknown nodes costs a
+		message per link rather than a flood per node.  Other transports get the older floods.
+		On shared transports like multicast, the 'routes' sent for a new transport ask ('reply') the
+		neighbors already there to send theirs back.
 	"""
 	MAXCACHESIZE = 1000
+	ROUTETTL = 600
+	MAXPAUSED = 64
+	MAXPAUSEDTOTAL = 4096
+	REQUESTSQUELCH = 10
+	REQUESTDELAY = 0.01
 	DOCK = "__NODES__"
+	HOPS = 1  # version of hop by hop route discovery we understand
 
-	def __init__(self):
+	def __init__(self, cachesize=None, ttl=None, groupRouter=None):
 		BlankRouter.__init__(self)
-		self.nodeRouteCache = dict()
+		self.nodeRouteCache = RouteCache(cachesize or self.MAXCACHESIZE, ttl or self.ROUTETTL)
+		self.groupRouter = groupRouter  # knows the neighbors on each transport
+		self.neighbors = defaultdict(dict)  # fileno -> neighbor -> (hops, compact) from its 'routes'
 		self.inProcessRequests = dict()
 		self.pausedMessages = defaultdict(list) 
-
-	def cleanNodeCache(self, ratio):
-		""" 
-			Clean the cache of ratio% entries where 0 < ratio < 1.0.  Use an ordered list of access times to find out
-			which access time to use as a breaking point for keeping entries
-		"""
-		times = [x.touched for x in self.nodeRouteCache.itervalues()]
-		times.sort()
-		median = times[len(times)*ratio]
-		self.nodeRouteCache = dict([(src, entry) for src, entry in self.nodeRouteCache.iteritems() if entry.touched > median])
+		self.pausedCount = 0
+		self.pendingRequests = dict()  # node -> filenos not to ask, for the next requests
+		self.asked = dict()  # node -> (time, filenos of the neighbors that asked us for it)
+		self.pendingRoutes = defaultdict(set)  # fileno -> nodes to tell the neighbors there about
+		self.pendingResponse = False
 
 
 	def processIN(self, msglist, now):
@@ -59,14 +164,28 @@ class NodeRouter(BlankRouter):
 				if msg.src in self.pausedMessages:
 					# Use the information we have at hand to allow paused messages to go out
 					self.processRouteResponse(msg)
+				elif msg._receivedon is not None:
+					self.nodeRouteCache.confirm(msg.src, msg._receivedon.fileno(), now)
 				passed.append(msg)
 				continue
 	
-			nodemessage = yaml.load(msg.data)
+			try:
+				nodemessage = control.decode(msg.data)
+			except Exception, e:
+				log.error("Failed to decode node router message from %s: %s", msg.src, e)
+				continue
+
+			if 'hops' in nodemessage and msg._receivedon is not None:
+				self.neighbors[msg._receivedon.fileno()][msg.src] = (nodemessage['hops'], nodemessage.get('compact', 0))
+
 			if 'request' in nodemessage:
-				self.processRouteRequest(nodemessage['request'])
+				self.processRouteRequest([nodemessage['request']])
+			elif 'requests' in nodemessage:
+				self.processHopRequest(msg, nodemessage['requests'])
 			elif 'response' in nodemessage:
 				self.processRouteResponse(msg)
+			elif 'routes' in nodemessage:
+				self.processRouteSync(msg, nodemessage['routes'], nodemessage.get('reply', False))
 	
 		return passed
 
@@ -80,63 +199,186 @@ class NodeRouter(BlankRouter):
 			# As we allow loopback, this can happen, just ignore it
 			return
 
-		# already have it, update and return
-		if msg.src in self.nodeRouteCache:
-			self.nodeRouteCache[msg.src].update(msg._receivedon.fileno())
-			return 
-
-		# new node info, create a new entry, cleaning cache if necessary
-		if len(self.nodeRouteCache) >= self.MAXCACHESIZE:
-			self.cleanNodeCache(0.25)
 		if msg._receivedon is None:
 			log.error("Can't process response from %s, no received on interface", msg.src)
-		else:
-			log.debug("Adding route to cache: %s -> %s", msg.src, msg._receivedon.fileno())
-			self.nodeRouteCache[msg.src] = NodeEntry(msg._receivedon.fileno())
+			return
+
+		self.learnRoute(msg.src, msg._receivedon)
+
+
+	def processRouteSync(self, msg, nodes, reply=False):
+		"""
+			A neighbor sent its name and the nodes it has routes for, on a new transport or as the answer to
+			our requests, use them unless we already have a route
+		"""
+		if msg._receivedon is None:
+			return
+		for node in nodes:
+			if node != self.nodename and node not in self.nodeRouteCache:
+				self.learnRoute(node, msg._receivedon)
+		if reply:
+			self.sendHop(msg._receivedon.fileno(), {'routes': [self.nodename]})
+
+
+	def learnRoute(self, node, transport):
+		""" Add a route to node through transport, send any messages that were waiting for it and tell the neighbors that asked """
+		log.debug("Adding route to cache: %s -> %s", node, transport.fileno())
+		now = time.time()
+		self.nodeRouteCache.put(node, transport.fileno(), now)
+		self.inProcessRequests.pop(node, None)
+
+		asked = self.asked.pop(node, None)
+		if asked is not None and asked[0] + self.REQUESTSQUELCH > now:
+			for fd in asked[1] - set([transport.fileno()]):
+				self.queueRoutes(fd, node)
 
 		# Check for messages waiting for route and queue
-		waiting = self.pausedMessages.get(msg.src, [])
+		waiting = self.pausedMessages.pop(node, [])
+		self.pausedCount -= len(waiting)
 		for paused in waiting:
-			if paused._receivedon is msg._receivedon:
-				log.debug("Not sending paused message for %s out %d, same as rx interface", msg.src, msg._receivedon.fileno())
-			elif msg._receivedon.fileno() in paused._appendedto:
-				log.debug("Not sending paused message for %s out %d, already went out for something else", msg.src, msg._receivedon.fileno())
+			if paused._receivedon is transport:
+				log.debug("Not sending paused message for %s out %d, same as rx interface", node, transport.fileno())
+			elif transport.fileno() in paused._appendedto:
+				log.debug("Not sending paused message for %s out %d, already went out for something else", node, transport.fileno())
 			else:
-				log.debug("sending paused message for: %s", msg.src)
-				paused._routed = [msg._receivedon.fileno()]
+				log.debug("sending paused message for: %s", node)
+				paused._routed = [transport.fileno()]
 				self.msgintf.sendDirect(paused)
 
-		if len(waiting) > 0:
-			self.pausedMessages[msg.src] = []
-
 
-	def processRouteRequest(self, nodename):
+	def processRouteRequest(self, nodenames):
 		"""
-			Process a request for a node route
+			Process a flooded request for node routes, schedule a response if we are one of them
 		"""
 		# TODO: Should we cache src now?
 		log.debug("Processing route request")
-		if nodename.strip() == self.nodename:
-			resp = MAGIMessage(contenttype=MAGIMessage.YAML, docks=[NodeRouter.DOCK], groups=[GroupRouter.ALLNODES], data=yaml.safe_dump({'response':True}))
-			self.msgintf.send(resp)
+		if self.nodename not in [name.strip() for name in nodenames]:
+			return
+		if not self.pendingResponse:
+			self.pendingResponse = True
+			self.scheduleMethod(self.sendResponse, time.time() + self.REQUESTDELAY)
+
+
+	def sendResponse(self):
+		""" Answer all the flooded requests for us since the last response """
+		self.pendingResponse = False
+		resp = MAGIMessage(contenttype=MAGIMessage.YAML, docks=[NodeRouter.DOCK], groups=[GroupRouter.ALLNODES], 
+						   data=control.dump({'response':True}, False)[1])
+		self.msgintf.send(resp)
+
+
+	def processHopRequest(self, msg, nodenames):
+		"""
+			A neighbor asked for routes, answer for ourselves and the nodes we have routes to, ask our other
+			transports for the rest
+		"""
+		if msg._receivedon is None:
+			return
+		fd = msg._receivedon.fileno()
+		now = time.time()
+		if len(self.asked) >= self.MAXPAUSEDTOTAL:
+			self.asked = dict([(n, a) for n, a in self.asked.iteritems() if a[0] + self.REQUESTSQUELCH > now])
+		for node in nodenames:
+			if node == self.nodename or self.nodeRouteCache.get(node, now) not in (None, fd):
+				self.queueRoutes(fd, node)
+				continue
+			asked = self.asked.get(node)
+			if asked is None or asked[0] + self.REQUESTSQUELCH <= now:
+				asked = self.asked[node] = (now, set())
+			asked[1].add(fd)
+			self.requestRoute(msg._receivedon, node, fd)
+
+
+	def queueRoutes(self, fd, node):
+		""" Tell the neighbors on fd about node with the next routes """
+		if not self.pendingRoutes:
+			self.scheduleMethod(self.sendRoutes, time.time() + self.REQUESTDELAY)
+		self.pendingRoutes[fd].add(node)
+
 
+	def sendRoutes(self):
+		""" Send each transport the routes collected for it since the last ones """
+		pending = self.pendingRoutes
+		self.pendingRoutes = defaultdict(set)
+		for fd, nodes in pending.iteritems():
+			if fd in self.transports:
+				self.sendHop(fd, {'routes': sorted(nodes)})
 
-	def requestRoute(self, intransport, node):
+
+	def requestRoute(self, intransport, node, asker=None):
 		"""
-			Need a route, see if we should sent a request and if so, do it
+			Need a route, see if we should sent a request and if so, add it to the next one.  asker is the
+			fileno of the neighbor that asked us for it, which isn't asked back
 		"""
 		log.debug("Requesting route for %s", node)
 		reqt = self.inProcessRequests.get(node, 0)
 		now = time.time()
-		if reqt + 10 > now:
+		if reqt + self.REQUESTSQUELCH > now:
 			log.debug("Squelch route request for %s as there is one in process", node)
+			if asker is not None and node in self.pendingRequests:
+				self.pendingRequests[node].add(asker)
 			return
-			
+
+		if len(self.inProcessRequests) >= self.MAXPAUSEDTOTAL:  # unanswered requests, forget the ones past squelching
+			self.inProcessRequests = dict([(n, t) for n, t in self.inProcessRequests.iteritems() if t + self.REQUESTSQUELCH > now])
 		self.inProcessRequests[node] = now
-		# Send a request out all interfaces except local and receiving interface
-		req = MAGIMessage(contenttype=MAGIMessage.BLOB, docks=[NodeRouter.DOCK], groups=[GroupRouter.ALLNODES], data=yaml.safe_dump({'request':node}))
-		req._routed = set(self.transports.keys()) - set([0])
-		self.msgintf.send(req)
+		if not self.pendingRequests:
+			self.scheduleMethod(self.sendRequests, now + self.REQUESTDELAY)
+		self.pendingRequests[node] = set() if asker is None else set([asker])
+
+
+	def sendRequests(self):
+		""" Ask for all the nodes collected since the last requests, one list per hop by hop transport, floods on the others """
+		pending = self.pendingRequests
+		self.pendingRequests = dict()
+		flood = defaultdict(list)  # node -> older transports to flood the request out
+		for fd in self.transports:
+			if fd == 0:
+				continue
+			nodes = [node for node, skip in pending.iteritems() if fd not in skip]
+			if not nodes:
+				continue
+			if self.hopByHop(fd):
+				self.sendHop(fd, {'requests': sorted(nodes)})
+			else:
+				for node in nodes:
+					flood[node].append(fd)
+		for node, fds in flood.iteritems():
+			req = MAGIMessage(contenttype=MAGIMessage.YAML, docks=[NodeRouter.DOCK], groups=[GroupRouter.ALLNODES], 
+							  data=control.dump({'request': node}, False)[1])
+			req._routed = set(fds)
+			self.msgintf.send(req)
+
+
+	def knownNeighbors(self, fd):
+		""" The neighbors on fd that we have heard from """
+		known = set(self.neighbors.get(fd, ()))
+		if self.groupRouter is not None:
+			tgl = self.groupRouter.transportGroupLists.get(fd)
+			if tgl is not None:
+				known.update(tgl.srccache)
+		return known
+
+	def hopByHop(self, fd):
+		""" True if every neighbor on fd understands hop by hop requests """
+		if self.groupRouter is None:
+			return False
+		heard = self.neighbors.get(fd)
+		if not heard:
+			return False
+		return all([heard.get(n, (0, 0))[0] >= 1 for n in self.knownNeighbors(fd)])
+
+	def sendHop(self, fd, request):
+		""" Send request to the neighbors on fd, compact when they all understand it """
+		heard = self.neighbors.get(fd, {})
+		known = self.knownNeighbors(fd)
+		compact = len(known) > 0 and all([heard.get(n, (0, 0))[1] for n in known])
+		request['hops'] = self.HOPS
+		request['compact'] = control.VERSION
+		(contenttype, data) = control.dump(request, compact)
+		msg = MAGIMessage(contenttype=contenttype, docks=[NodeRouter.DOCK], groups=[GroupRouter.ONEHOPNODES], data=data)
+		msg._routed = [fd]
+		self.msgintf.send(msg)
 
 
 	def routeMessage(self, msg):
@@ -144,18 +386,41 @@ class NodeRouter(BlankRouter):
 		ret = set()
 		log.debug("Message to be routed: %s", msg)
 		#log.debug("Routing message to destination nodes: %s", msg.dstnodes)
+		now = time.time()
 		for node in msg.dstnodes:
 			if node == self.nodename:
 				ret.add(0)
 				continue
 
-			if node in self.nodeRouteCache:
-				ret.add(self.nodeRouteCache[node].fileno)
+			fileno = self.nodeRouteCache.get(node, now)
+			if fileno is not None:
+				ret.add(fileno)
 				continue
 
 			# Need to send RouteRequest and pause message for this node
-			self.pausedMessages[node].append(msg)
+			if len(self.pausedMessages.get(node, ())) >= self.MAXPAUSED or self.pausedCount >= self.MAXPAUSEDTOTAL:
+				log.debug("Too many messages waiting for a route, dropping message for %s", node)
+				self.stats['pauseddropped'] += 1
+			else:
+				self.pausedMessages[node].append(msg)
+				self.pausedCount += 1
 			self.requestRoute(msg._receivedon, node)
 		log.debug("Message routed on transports: %s", ret)
 		return ret
 
+
+	def transportAdded(self, transport):
+		""" Tell the neighbors on a new transport about ourselves and the routes we know """
+		if transport.fileno() == 0:
+			return
+		request = {'routes': [self.nodename] + self.nodeRouteCache.entries.keys()}
+		if transport.shared():
+			request['reply'] = True  # neighbors already there won't send theirs otherwise
+		self.sendHop(transport.fileno(), request)
+
+
+	def transportRemoved(self, fd, transport):
+		""" Routes through the transport are gone """
+		self.nodeRouteCache.removeFileno(fd)
+		self.neighbors.pop(fd, None)
+		self.pendingRoutes.pop(fd, None)
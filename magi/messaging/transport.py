@@ -1,6 +1,6 @@
 
 import socket
-from asyncore import dispatcher
+from asyncore import dispatcher, _DISCONNECTED
 from magimessage import DefaultCodec
 
 class Transport(dispatcher):
@@ -21,6 +21,10 @@ class Transport(dispatcher):
 		""" Returns true if this transport doesn't actually tx/rx any messages """
 		return False
 
+	def shared(self):
+		""" Returns true if neighbors we haven't heard from yet may receive what we send on this transport """
+		return False
+
 	def setCodec(self, codec):
 		""" Set the encoder/decoder used for serializing the base MAGI message """
 		self.codec = codec
@@ -45,6 +49,20 @@ class Transport(dispatcher):
 		""" Just set the socket and leave it, no map adding """
 		self.socket = sock
 
+	def recv_into(self, buf):
+		""" Same as dispatcher.recv but reads into a writable buffer, returns the number of bytes read """
+		try:
+			count = self.socket.recv_into(buf)
+			if count == 0:
+				# a closed connection is indicated by signaling a read condition, and having recv_into() return 0.
+				self.handle_close()
+			return count
+		except socket.error, why:
+			if why.args[0] in _DISCONNECTED:
+				self.handle_close()
+				return 0
+			raise
+
 	def close(self):
 		self.socket.close()
 
@@ -2,6 +2,8 @@
 from transport import Transport
 from magimessage import DefaultCodec
 from magi.util.Collection import namedtuple
+import bisect
+import errno
 import socket
 import struct
 import logging
@@ -10,23 +12,141 @@ import time
 
 log = logging.getLogger(__name__)
 RXRequest = namedtuple("RXRequest", "start, end, time")
+DATAHEADER = struct.Struct('>BHHH')  # type, multicastid, partnum, partcount
+IPUDPHEADER = 28  # IPv4 plus UDP header bytes that come out of the MTU
 debug = True
 
 
+def toRanges(parts):
+	""" Convert a list of part numbers into a sorted list of inclusive (first, last) ranges """
+	ranges = list()
+	for part in sorted(set(parts)):
+		if ranges and ranges[-1][1] == part - 1:
+			ranges[-1] = (ranges[-1][0], part)
+		else:
+			ranges.append((part, part))
+	return ranges
+
+
+class MissingRanges(object):
+	"""
+		Set of missing part numbers kept as sorted, non overlapping ranges along with the last time a
+		retransmit was requested for each range.  Size depends on the number of gaps, not the number of parts.
+		Ranges are passed in and out as inclusive (first, last) values.
+	"""
+
+	__slots__ = ['starts', 'ends', 'times']
+
+	def __init__(self, first, last, reqtime=0):
+		self.starts = [first]  # start of each range
+		self.ends = [last+1]   # end of each range, exclusive
+		self.times = [reqtime]  # last request time of each range
+
+	def __len__(self):
+		return sum(self.ends) - sum(self.starts)
+
+	def __nonzero__(self):
+		return len(self.starts) > 0
+
+	def find(self, part):
+		""" Index of the range holding part or -1 """
+		idx = bisect.bisect_right(self.starts, part) - 1
+		if idx >= 0 and part < self.ends[idx]:
+			return idx
+		return -1
+
+	def __contains__(self, part):
+		return self.find(part) >= 0
+
+	def __iter__(self):
+		""" Inclusive (first, last) ranges that are missing """
+		for start, end in zip(self.starts, self.ends):
+			yield (start, end-1)
+
+	def split(self, part):
+		""" Make sure a range starts at part if part is missing """
+		idx = self.find(part)
+		if idx < 0 or self.starts[idx] == part:
+			return
+		self.starts.insert(idx+1, part)
+		self.ends.insert(idx+1, self.ends[idx])
+		self.times.insert(idx+1, self.times[idx])
+		self.ends[idx] = part
+
+	def discard(self, part):
+		""" Part has arrived, returns False if it wasn't missing """
+		idx = self.find(part)
+		if idx < 0:
+			return False
+		self.split(part+1)
+		if self.starts[idx] == part:
+			del self.starts[idx], self.ends[idx], self.times[idx]
+		else:
+			self.ends[idx] = part
+		return True
+
+	def requested(self, first, last, reqtime):
+		""" Record a request for the parts from first to last """
+		self.split(first)
+		self.split(last+1)
+		idx = bisect.bisect_left(self.starts, first)
+		stop = idx
+		while stop < len(self.starts) and self.starts[stop] <= last:
+			self.times[stop] = reqtime
+			stop += 1
+		# merge touching ranges that now have the same request time
+		idx = max(idx-1, 0)
+		while idx < min(stop, len(self.starts)-1):
+			if self.ends[idx] == self.starts[idx+1] and self.times[idx] == self.times[idx+1]:
+				self.ends[idx] = self.ends[idx+1]
+				del self.starts[idx+1], self.ends[idx+1], self.times[idx+1]
+				stop -= 1
+			else:
+				idx += 1
+
+	def hasStale(self, threshold):
+		""" True if any part was last requested before threshold """
+		return len(self.times) > 0 and min(self.times) < threshold
+
+	def stale(self, threshold, limit):
+		""" Up to limit inclusive (first, last) ranges last requested before threshold, touching ranges are joined """
+		ranges = list()
+		for start, end, reqtime in zip(self.starts, self.ends, self.times):
+			if reqtime >= threshold:
+				continue
+			if ranges and ranges[-1][1] == start - 1:
+				ranges[-1] = (ranges[-1][0], end-1)
+			elif len(ranges) < limit:
+				ranges.append((start, end-1))
+			else:
+				break
+		return ranges
+
+
 class RXMessageTracker(object):
-	""" Tracks a single message from a single neighbor node """
+	"""
+		Tracks a single message from a single neighbor node.  Pieces are copied straight into a
+		reassembly buffer, allocated once the piece size is known from the first full sized piece.
+	"""
 
-	__slots__ = ['data', 'missing', 'complete', 'scheduled', 'src', 'msgid', 'sched', 'txqueue']
+	__slots__ = ['data', 'missing', 'complete', 'scheduled', 'src', 'msgid', 'sched', 'txqueue', 'neighbor',
+				'reqall', 'total', 'piecesize', 'length', 'early']
 
-	def __init__(self, src, msgid, sched, txqueue):
-		self.data = None
-		self.missing = {0:0}  # Map of part ID to last request time
+	def __init__(self, src, msgid, sched, txqueue, neighbor=None):
+		self.data = None  # reassembly buffer
+		self.missing = None  # MissingRanges of part numbers once we know the part count
+		self.reqall = 0  # last request time for the whole message, used until we know anything about it
 		self.complete = False
 		self.scheduled = None
 		self.src = src
 		self.msgid = msgid
 		self.sched = sched
 		self.txqueue = txqueue
+		self.neighbor = neighbor  # NeighborTracker of the source, tells us if it understands range requests
+		self.total = 0
+		self.piecesize = 0
+		self.length = 0  # length of the message in the buffer, known when the last piece arrives
+		self.early = None  # last piece if it arrives before we know the piece size
 
 	def msg_addPacket(self, part, total, piece):
 		""" Record a new piece of data """
@@ -34,21 +154,27 @@ class RXMessageTracker(object):
 			# already done, extra packet, ignore it
 			return 
 
-		if self.data is None:
+		if self.missing is None:
 			# first time in, initialize our state
-			self.data = [None]*total
-			del self.missing[0]
-			self.missing = dict([(k, 0) for k in range(1,total+1)])  # dict with part numbers as keys, 0 for each value
+			self.total = total
+			self.missing = MissingRanges(1, total)
 
-		# apply the piece
-		self.data[part-1] = piece
+		if part not in self.missing:
+			return  # repeated piece
 
-		# GTL this del() is raising a KeyError very occasionally on large
-		# container experiments (1000+ nodes). So check before deleting
-		# and figuring out where this error is coming from.
-		if part in self.missing:
-			del self.missing[part]
+		if part < self.total or self.total == 1:
+			if self.data is None:
+				self.allocate(len(piece))
+			elif len(piece) != self.piecesize:
+				log.error("Piece %d of %s/%d is %d bytes, expected %d", part, self.src, self.msgid, len(piece), self.piecesize)
+				return
+			self.store(part, piece)
+		elif self.data is None:
+			self.early = piece
+		else:
+			self.store(part, piece)
 
+		self.missing.discard(part)
 		if not self.missing:
 			self.complete = True
 			self.msg_unscheduleAll()
@@ -56,35 +182,42 @@ class RXMessageTracker(object):
 			self.msg_schedRequest()
 
 
+	def allocate(self, piecesize):
+		""" All pieces but the last are the same size, so we can place everything once we know one of them """
+		self.piecesize = piecesize
+		self.data = bytearray(piecesize * self.total)
+		if self.early is not None:
+			self.store(self.total, self.early)
+			self.early = None
+
+	def store(self, part, piece):
+		offset = (part-1) * self.piecesize
+		self.data[offset:offset+len(piece)] = piece
+		if part == self.total:
+			self.length = offset + len(piece)
+
+
 	def msg_getData(self):
 		"""
 			Get the packet data as a tuple of header and data portions
 			Assumes at least length number and header will fit into the first packet
 		"""
-		(totallen, hdrlen) = struct.unpack('>IH', self.data[0][:6])
+		(totallen, hdrlen) = struct.unpack_from('>IH', self.data)
 		realhlen = hdrlen + 6  # read in header plus the two length values
-
-		header = self.data.pop(0)
-		while len(header) < realhlen:
-			header += self.data.pop(0)
-
-		if len(header) > realhlen:
-			self.data.insert(0, header[realhlen:])
-			header = header[:realhlen]
-		
-		return (header, ''.join(self.data))
+		return (buffer(self.data, 0, realhlen), str(buffer(self.data, realhlen, self.length - realhlen)))
 
 
-	def msg_requestMade(self, sched, pieces):
-		""" Indicates that a request was made for this message """
+	def msg_requestMade(self, sched, ranges):
+		""" Indicates that a request was made for these (first, last) ranges of this message, 0 is the whole message """
 		now = time.time()
-		if self.data is None:
-			if pieces[0] == 0:
-				self.missing[0] = now
+		if self.missing is None:
+			if ranges[0][0] == 0:
+				self.reqall = now
 		else:
-			for p in pieces:
-				if p in self.missing:
-					self.missing[p] = now
+			for first, last in ranges:
+				if first == 0:
+					first, last = 1, self.total
+				self.missing.requested(first, min(last, self.total), now)
 
 		self.msg_schedRequest()
 
@@ -100,11 +233,11 @@ class RXMessageTracker(object):
 			return 
 
 		threshold = time.time() - 5  # more than 5 seconds ago
-		if self.data is None:
-			if self.missing[0] > threshold:
+		if self.missing is None:
+			if self.reqall > threshold:
 				return
 		else:
-			if not any([k for k,t in self.missing.iteritems() if t < threshold]):
+			if not self.missing.hasStale(threshold):
 				return
 			
 		self.scheduled = self.sched.sched_relative(random.uniform(0.5, 3), self.makeRequest)
@@ -124,18 +257,26 @@ class RXMessageTracker(object):
 
 		now = time.time()
 		threshold = now - 5  # more than 5 seconds ago
-		if self.data is None:  # Request full message
-			if self.missing[0] > threshold:
+		if self.missing is None:  # Request full message
+			if self.reqall > threshold:
 				return  # skip it, someone beat us to the punch
-			self.missing[0] = now
+			self.reqall = now
 			request = MCTHeader.PktReq(self.msgid, self.src, 0)  # All pieces
 		else:
-			ids = [k for k,t in self.missing.iteritems() if t < threshold]
-			if not ids:
+			ranges = self.missing.stale(threshold, MCTHeader.MAXRANGES)
+			if not ranges:
 				return # again, someone beat us somehow, ignore and move on
-			for k in ids:
-				self.missing[k] = now
-			request = MCTHeader.PktReq(self.msgid, self.src, *ids)
+			if self.neighbor is not None and self.neighbor.rangereq:
+				request = MCTHeader.PktReqRange(self.msgid, self.src, ranges)
+			else:
+				# older source, list each piece, whatever doesn't fit goes in a later request
+				pieces = list()
+				for first, last in ranges:
+					pieces.extend(xrange(first, min(last+1, first + MCTHeader.MAXPIECES - len(pieces))))
+				ranges = toRanges(pieces)
+				request = MCTHeader.PktReq(self.msgid, self.src, *pieces)
+			for first, last in ranges:
+				self.missing.requested(first, last, now)
 
 		self.txqueue.insert(0, request) # insert request at head of queue
 
@@ -151,7 +292,7 @@ class NeighborTracker(object):
 		If it determines that we need to make a request, it will schedule one.
 	"""
 
-	__slots__ = ['addr', 'sched', 'queue', 'codec', 'boottime', 'lastid', 'lastlinear', 'completeset', 'messages']
+	__slots__ = ['addr', 'sched', 'queue', 'codec', 'boottime', 'lastid', 'lastlinear', 'completeset', 'messages', 'rangereq']
 
 	def __init__(self, addr=None, sched=None, queue=None, codec=None):
 		self.addr = addr
@@ -163,6 +304,7 @@ class NeighborTracker(object):
 		self.lastlinear = 0  #  the last complete id in the linear integer line
 		self.completeset = set()  # complete ids but still missing in between so we can't update lastlinear
 		self.messages = dict()  # the list of messages being built
+		self.rangereq = False  # neighbor understands PKTREQRANGE, learned from its status packets
 
 
 	def neigh_adjustWaiting(self):
@@ -186,7 +328,7 @@ class NeighborTracker(object):
 		if msgid <= self.lastlinear or msgid in self.completeset:
 			raise MessageCompleteError("This message is complete")  # Already completed
 		if msgid not in self.messages:
-			self.messages[msgid] = RXMessageTracker(self.addr, msgid, self.sched, self.queue)
+			self.messages[msgid] = RXMessageTracker(self.addr, msgid, self.sched, self.queue, self)
 		return self.messages[msgid]
 
 
@@ -213,10 +355,11 @@ class NeighborTracker(object):
 		return None
 
 
-	def neigh_currentId(self, msgid, boottime):
+	def neigh_currentId(self, msgid, boottime, flags=0):
 		"""
-			Record the latest sent id according to the neighbor
+			Record the latest sent id and capabilities according to the neighbor
 		"""
+		self.rangereq = bool(flags & MCTHeader.STATRANGEREQ)
 		log.debug("CurrentID %s from %s", msgid, self.addr)
 		if boottime != self.boottime:
 			log.debug("New boottime (%s) for %s, reseting tracking info to start with %d", boottime, self.addr, msgid)
@@ -249,10 +392,10 @@ class NeighborTracker(object):
 		self.neigh_adjustWaiting()
 
 
-	def neigh_requestMade(self, msgid, pieces):
-		""" I or someone else made a request for retransmit, adjust timers """
+	def neigh_requestMade(self, msgid, ranges):
+		""" I or someone else made a request for retransmit of (first, last) ranges, adjust timers """
 		try:
-			self.neigh_getMessageTracker(msgid).msg_requestMade(self.sched, pieces)
+			self.neigh_getMessageTracker(msgid).msg_requestMade(self.sched, ranges)
 		except MessageCompleteError:
 			return  # we don't care
 
@@ -278,25 +421,28 @@ class TXMessageTracker(TXTracker):
 
 	SPLITSIZE = 1450
 
-	def __init__(self, msg=None, multicastid=None, codec=None):
+	def __init__(self, msg=None, multicastid=None, codec=None, splitsize=None):
 		""" Create a new parts tracker that tracks this particular message """
 		self.msg = msg
 		if self.msg.data is None:
 			self.msg.data = ""
 		self.multicastid = multicastid
+		self.splitsize = splitsize or self.SPLITSIZE
 		self.eheader = codec.encode(self.msg)
-		self.start2 = self.SPLITSIZE - len(self.eheader)
-		self.parts = (len(self.eheader) + len(self.msg.data) - 1)/self.SPLITSIZE + 1
+		self.start2 = self.splitsize - len(self.eheader)
+		self.parts = (len(self.eheader) + len(self.msg.data) - 1)/self.splitsize + 1
 		self.queueAll()
 
 	def getId(self):
 		return self.multicastid
 
-	def queue(self, pieces):
-		if len(pieces) > 0 and pieces[0] == 0:
-			self.queueAll()
-		else:
-			self.tosend.update(pieces)
+	def queue(self, ranges):
+		""" Send the (first, last) ranges of parts again, a range starting at 0 is the whole message """
+		for first, last in ranges:
+			if first == 0:
+				self.queueAll()
+				return
+			self.tosend.update(xrange(first, min(last, self.parts) + 1))
 
 	def queueAll(self):
 		self.tosend = set(xrange(1, self.parts+1))
@@ -316,12 +462,13 @@ class TXMessageTracker(TXTracker):
 		if partnum < 1 or partnum > self.parts:
 			raise IndexError("Invalid part number")
 
-		info = MCTHeader.PktData(self.multicastid, partnum, self.parts).encode()
+		# A single slice and concatenation is cheaper in python than filling a buffer from views
+		info = DATAHEADER.pack(MCTHeader.PKTDATA, self.multicastid, partnum, self.parts)
 		if partnum == 1:  # Message header in addition to data
 			return info + self.eheader + self.msg.data[0:self.start2]
 
-		start = self.start2 + ((partnum-2) * self.SPLITSIZE)
-		return info + self.msg.data[start : start+self.SPLITSIZE]
+		start = self.start2 + ((partnum-2) * self.splitsize)
+		return info + self.msg.data[start : start+self.splitsize]
 
 
 
@@ -338,7 +485,7 @@ class TXControlTracker(TXTracker):
 	def getId(self):
 		return None
 
-	def queue(self, pieces):
+	def queue(self, ranges):
 		self.sent = False
 
 	def isDone(self):
@@ -363,8 +510,14 @@ class MCTHeader(object):
 	PKTREQ  = 1 # request to retransmit data
 	PKTSTAT = 2 # current status of this nodes transmitted
 	PKTDEAD = 3 # response to request for retransmit of an ID we don't have
+	PKTREQRANGE = 4 # request to retransmit ranges of data, only sent to sources that announce STATRANGEREQ
+
+	STATRANGEREQ = 0x01  # PKTSTAT flag, this node understands PKTREQRANGE, older nodes ignore the flags byte
 
-	strs = {PKTDATA:"PktData", PKTREQ:"PktReq", PKTSTAT:"PktStat", PKTDEAD:"PktDead"}
+	MAXPIECES = 700  # keep requests within a 1500 byte packet
+	MAXRANGES = 350
+
+	strs = {PKTDATA:"PktData", PKTREQ:"PktReq", PKTSTAT:"PktStat", PKTDEAD:"PktDead", PKTREQRANGE:"PktReqRange"}
 
 	def __init__(self, type, *args):
 		self.type = type
@@ -374,15 +527,25 @@ class MCTHeader(object):
 			self.partnum = args[1]
 			self.partcount = args[2]
 
-		elif type == MCTHeader.PKTREQ:
+		elif type == MCTHeader.PKTREQ or type == MCTHeader.PKTREQRANGE:
 			if len(args[1]) == 4:
 				self.src = socket.inet_ntoa(args[1])
 			else:
 				self.src = args[1]
-			self.pieces = args[2:]
+			if type == MCTHeader.PKTREQ:
+				self.pieces = args[2:]
+				if 0 in self.pieces:
+					self.ranges = [(0, 0)]
+				else:
+					self.ranges = toRanges(self.pieces)
+			else:
+				self.ranges = zip(args[2::2], args[3::2])
 
 		elif type == MCTHeader.PKTSTAT:
 			self.boottime = args[1]
+			self.flags = 0
+			if len(args) > 2:
+				self.flags = args[2]
 
 
 	def __repr__(self):
@@ -392,6 +555,9 @@ class MCTHeader(object):
 		elif self.type == MCTHeader.PKTREQ:
 			return "PktReq %s to %s for %s" % (self.multicastid, self.src, self.pieces)
 
+		elif self.type == MCTHeader.PKTREQRANGE:
+			return "PktReqRange %s to %s for %s" % (self.multicastid, self.src, self.ranges)
+
 		elif self.type == MCTHeader.PKTSTAT:
 			return "PktStat %s, boottime %s" % (self.multicastid, self.boottime)
 
@@ -403,12 +569,18 @@ class MCTHeader(object):
 
 	def encode(self):
 		if self.type == MCTHeader.PKTDATA:
-			return struct.pack('>BHHH', self.type, self.multicastid, self.partnum, self.partcount)
+			return DATAHEADER.pack(self.type, self.multicastid, self.partnum, self.partcount)
 
 		elif self.type == MCTHeader.PKTREQ:
 			return struct.pack('>BH4s%dH' % len(self.pieces), self.type, self.multicastid, socket.inet_aton(self.src), *self.pieces)
 
+		elif self.type == MCTHeader.PKTREQRANGE:
+			flat = [val for pair in self.ranges for val in pair]
+			return struct.pack('>BH4s%dH' % len(flat), self.type, self.multicastid, socket.inet_aton(self.src), *flat)
+
 		elif self.type == MCTHeader.PKTSTAT:
+			if self.flags:
+				return struct.pack('>BHLB', self.type, self.multicastid, self.boottime, self.flags)
 			return struct.pack('>BHL', self.type, self.multicastid, self.boottime)
 
 		elif self.type == MCTHeader.PKTDEAD:
@@ -426,8 +598,12 @@ class MCTHeader(object):
 		return MCTHeader(MCTHeader.PKTREQ, mid, src, *pieces)
 
 	@classmethod
-	def PktStat(cls, mid, boottime):
-		return MCTHeader(MCTHeader.PKTSTAT, mid, boottime)
+	def PktReqRange(cls, mid, src, ranges):
+		return MCTHeader(MCTHeader.PKTREQRANGE, mid, src, *[val for pair in ranges for val in pair])
+
+	@classmethod
+	def PktStat(cls, mid, boottime, flags=0):
+		return MCTHeader(MCTHeader.PKTSTAT, mid, boottime, flags)
 
 	@classmethod
 	def PktDead(cls, mid):
@@ -438,19 +614,26 @@ class MCTHeader(object):
 		"""
 			Reads packet header
 			PKTDATA - a piece of a MAGIMessage with the header (multicastmsgid, part#, totalparts)
-			PKTREQ - a request to retransmit a range of pieces of a particular messages (multicastmsgid, part#begin, part#end)
-			PKTSTAT - periodic indicator of the last message id that this node transmitted
+			PKTREQ - a request to retransmit a list of pieces of a particular messages (multicastmsgid, src, part#, ...)
+			PKTREQRANGE - a request to retransmit ranges of pieces (multicastmsgid, src, first, last, first, last, ...)
+			PKTSTAT - periodic indicator of the last message id that this node transmitted, optional flags byte
 			PKTDEAD - response to PKTREQ when the sender has no record of the packet (never sent or no longer available)
 		"""
 		ptype = ord(data[0])
 		if ptype == MCTHeader.PKTDATA:
-			return MCTHeader(*struct.unpack('>BHHH', data[:7]))
+			return MCTHeader(*DATAHEADER.unpack_from(data))
 
 		elif ptype == MCTHeader.PKTREQ:
 			piececount = (len(data) - 7)/2
 			return MCTHeader(*struct.unpack('>BH4s%dH' % piececount, data))
 
+		elif ptype == MCTHeader.PKTREQRANGE:
+			rangecount = (len(data) - 7)/4
+			return MCTHeader(*struct.unpack('>BH4s%dH' % (rangecount*2), data[:7+rangecount*4]))
+
 		elif ptype == MCTHeader.PKTSTAT:
+			if len(data) > 7:
+				return MCTHeader(*struct.unpack('>BHLB', data[:8]))
 			return MCTHeader(*struct.unpack('>BHL', data[:7]))
 
 		elif ptype == MCTHeader.PKTDEAD:
@@ -461,11 +644,46 @@ class MCTHeader(object):
 
 
 
+class TokenBucket(object):
+	"""
+		Paces transmission to 'rate' bytes per second with bursts of up to 'burst' bytes.  Sending is
+		allowed while there are tokens left and may overdraw, the sender then waits for the refill.
+	"""
+
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = burst
+		self.tokens = burst
+		self.last = time.time()
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	def ready(self, now):
+		""" True if we may send now """
+		if self.tokens <= 0:
+			self.refill(now)
+		return self.tokens > 0
+
+	def consume(self, count):
+		self.tokens -= count
+
+	def delay(self):
+		""" Seconds until sending is allowed again """
+		return max(0, -self.tokens / self.rate)
+
+
 class MulticastTransport(Transport):
 	""" 
 		Group multicast communication.
 	"""
-	def __init__(self, address=None, port=None, localaddr=None, droppercent=0.0, codec=DefaultCodec):
+
+	BATCHSIZE = 64  # most packets sent for each writable event
+	DEFAULTRATE = 12500000  # bytes/sec, bursts beyond the slowest control network just turn into drops and NACKs
+	DEFAULTBURST = 262144
+
+	def __init__(self, address=None, port=None, localaddr=None, droppercent=0.0, codec=DefaultCodec, mtu=None, rate=DEFAULTRATE, burst=DEFAULTBURST):
 		"""
 			Create a new multicast transport.
 			 addr
@@ -476,6 +694,10 @@ class MulticastTransport(Transport):
 				the address of the local interface to stick to for receiving
 			droppercent
 				for testing only, transmitter will drop x% (0-1.0) of packets at network layer
+			 mtu
+				link MTU used to size data packets (i.e. 9000 for jumbo frames), default packets fit a 1500 MTU
+			 rate, burst
+				transmit pacing in bytes per second and the largest burst in bytes, a rate of 0 disables pacing
 		"""
 
 		Transport.__init__(self, codec=codec)
@@ -483,6 +705,13 @@ class MulticastTransport(Transport):
 		self.port = port
 		self.localaddr = localaddr
 		self.droppercent = droppercent
+		self.splitsize = TXMessageTracker.SPLITSIZE
+		if mtu:
+			self.splitsize = min(int(mtu), 65535) - IPUDPHEADER - DATAHEADER.size
+		self.pacer = None
+		if rate:
+			self.pacer = TokenBucket(rate, burst)
+		self.retry = None  # packet that couldn't be sent, goes out before anything else
 		self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 		self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
@@ -503,6 +732,9 @@ class MulticastTransport(Transport):
 		self.txMessage = TXTracker() # blank tracker, forces dequeing of next
 
 
+	def shared(self):
+		return True
+
 	def __repr__(self):
 		return "MulticastTransport %s:%d" % (self.addr,self.port)
 	__str__ = __repr__
@@ -525,7 +757,7 @@ class MulticastTransport(Transport):
 	def sendStatus(self):
 		""" Queue a status message to send """
 		# GTL - note: this is not currently called so status is not sent.
-		self.outmessages.insert(0, MCTHeader.PktStat(self.idcounter, self.boottime))
+		self.outmessages.insert(0, MCTHeader.PktStat(self.idcounter, self.boottime, MCTHeader.STATRANGEREQ))
 		self.sched.sched_relative(10, self.sendStatus)
 
 	def handle_read(self):
@@ -549,30 +781,30 @@ class MulticastTransport(Transport):
 
 		if header.type == MCTHeader.PKTDATA:
 			if debug: log.log(7, "Received data packet for %d - %d of %d", header.multicastid, header.partnum, header.partcount)
-			msg = ntracker.neigh_dataPacket(header.multicastid, header.partnum, header.partcount, data[7:])
+			msg = ntracker.neigh_dataPacket(header.multicastid, header.partnum, header.partcount, buffer(data, DATAHEADER.size))
 			if msg is not None: # We completed a messages with this packet
 				self.inmessages.append(msg)
 
 		elif header.type == MCTHeader.PKTSTAT:
 			if debug: log.log(7, "Received stat packet, %s reports lastid %d, checking to see if we are missing anything", srchost, header.multicastid)
-			ntracker.neigh_currentId(header.multicastid, header.boottime)
+			ntracker.neigh_currentId(header.multicastid, header.boottime, header.flags)
 
 		elif header.type == MCTHeader.PKTDEAD:
 			if debug: log.debug("Received dead packet indicator for %d, removing from our list of requests", header.multicastid)
 			ntracker.neigh_packetDead(header.multicastid)
 
-		elif header.type == MCTHeader.PKTREQ:
+		elif header.type == MCTHeader.PKTREQ or header.type == MCTHeader.PKTREQRANGE:
 			# Request packet, if we are the source, retransmit, if not, apply NACK supression as required
 			if debug: log.debug("Received request for packet %s/%d", header.src, header.multicastid)
 			if header.src == self.localaddr:
 				if header.multicastid in self.finished:
-					if debug: log.debug("I am the source of the packet, requeing message with %s", header.pieces)
+					if debug: log.debug("I am the source of the packet, requeing message with %s", header.ranges)
 					msg = self.finished.pop(header.multicastid)
-					msg.queue(header.pieces)
+					msg.queue(header.ranges)
 					self.outmessages.insert(0, msg)   # TODO: Need to check if already in outmessages
 				elif self.txMessage.getId() == header.multicastid:
-					if debug: log.debug("Adding parts back to current transmission %s", header.pieces)
-					self.txMessage.queue(header.pieces)
+					if debug: log.debug("Adding parts back to current transmission %s", header.ranges)
+					self.txMessage.queue(header.ranges)
 				else:
 					if debug: log.debug("Message not available, indicating dead")
 					self.outmessages.insert(0, MCTHeader.PktDead(header.multicastid))
@@ -580,7 +812,7 @@ class MulticastTransport(Transport):
 				if debug: log.log(7, "Request for someone else, making note in case we are missing it too (squelch NACK's)")
 				if header.src not in self.neighbors:
 					self.neighbors[header.src] = NeighborTracker(addr=header.src, sched=self.sched, queue=self.outmessages, codec=self.codec)
-				self.neighbors[header.src].neigh_requestMade(header.multicastid, header.pieces)
+				self.neighbors[header.src].neigh_requestMade(header.multicastid, header.ranges)
 
 
 	def readable(self):
@@ -595,28 +827,67 @@ class MulticastTransport(Transport):
 			return TXControlTracker(msg)
 		else:
 			self.idcounter += 1
-			return TXMessageTracker(msg=msg, multicastid=self.idcounter, codec=self.codec)
+			return TXMessageTracker(msg=msg, multicastid=self.idcounter, codec=self.codec, splitsize=self.splitsize)
 		
 
-	def handle_write(self):
-		""" Send one UDP packet, let poll determine writablility and spread processing over other sockets """
-		if self.txMessage.isDone():
+	def nextPacket(self):
+		""" Get the next packet to send, moving through the queue of trackers as needed, None when there is nothing """
+		if self.retry is not None:
+			data = self.retry
+			self.retry = None
+			return data
+
+		while self.txMessage.isDone():
 			# Done with this message, move onto used queue, file away based on the multicast transport id
 			if self.txMessage.getId() is not None:
 				self.finished[self.txMessage.getId()] = self.txMessage
+			self.txMessage = TXTracker()
+			if len(self.outmessages) == 0:
+				return None
 			self.txMessage = self.getNextTracker()
-			return
 
-		data = self.txMessage.getNext()
-		if random.random() < self.droppercent:
-			if debug: log.debug("dropping %d bytes for %s", len(data), self.addr)
-			return
-		if debug: log.debug("sending %d bytes to %s", len(data), self.addr)
-		self.socket.sendto(data, (self.addr, self.port))
+		return self.txMessage.getNext()
+
+
+	def handle_write(self):
+		"""
+			Send a batch of UDP packets, stopping early when the socket buffer fills or the pacer runs out,
+			so each poll wakeup moves a useful amount of data without starving other sockets
+		"""
+		for ii in xrange(self.BATCHSIZE):
+			data = self.nextPacket()
+			if data is None:
+				break
+
+			if self.pacer is not None:
+				self.pacer.consume(len(data))
+			if random.random() < self.droppercent:
+				if debug: log.debug("dropping %d bytes for %s", len(data), self.addr)
+			else:
+				if debug: log.log(7, "sending %d bytes to %s", len(data), self.addr)
+				try:
+					self.socket.sendto(data, (self.addr, self.port))
+				except socket.error, e:
+					if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+						raise
+					self.retry = data  # buffer is full, try again on the next writable event
+					break
+
+			if self.pacer is not None and not self.pacer.ready(time.time()):
+				if self.sched is not None:
+					self.sched.sched_relative(self.pacer.delay(), self.paceWakeup)
+				break
+
+
+	def paceWakeup(self):
+		""" Nothing to do, the scheduled event makes sure the poll loop checks writable() again after the pacing delay """
+		pass
 
 
 	def writable(self):
-		return not self.txMessage.isDone() or len(self.outmessages) > 0
+		if self.pacer is not None and not self.pacer.ready(time.time()):
+			return False
+		return self.retry is not None or not self.txMessage.isDone() or len(self.outmessages) > 0
 
 
 
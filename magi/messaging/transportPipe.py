@@ -1,4 +1,5 @@
 
+import errno
 import logging
 import os
 import sys
@@ -50,24 +51,15 @@ class OutputPipe(PipeBase):
 	def fromFile(cls, filename):
 		return OutputPipe(fd=os.open(filename, os.O_NONBLOCK | os.O_WRONLY))
 
-	def handle_write(self):
-		""" Override handle_write as we have a file descriptor, not a socket """
-		if self.txMessage.isDone():
-			try:
-				msg = self.outmessages.pop(0)
-				self.txMessage = transportStream.TXTracker(codec=self.codec, msg=msg)
-			except IndexError:
-				return
-			
-		if debug: log.log(2, "starting pipe write")
-		#keep sending till you can
-		while not self.txMessage.isDone():
-			bytesWritten = os.write(self.fd, self.txMessage.getData())
-			self.txMessage.sent(bytesWritten)
-			#if no more can be written, break out
-			if bytesWritten == 0:
-				break
-		if debug: log.log(2, "done pipe write")
+	def writeData(self, data):
+		""" Override writeData as we have a file descriptor, not a socket """
+		if debug: log.log(2, "pipe write of %d bytes", len(data))
+		try:
+			return os.write(self.fd, data)
+		except OSError, e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return 0
+			raise
 
 	def __repr__(self):
 		return "OutputPipe %d" % self.fileno()
@@ -97,19 +89,20 @@ class InputPipe(PipeBase):
 	def fromFile(cls, filename):
 		return InputPipe(fd=os.open(filename, os.O_NONBLOCK | os.O_RDONLY))
 
-	def handle_read(self):
-		""" Override handle_read as we have a file descriptor, not a socket """
-		if debug: log.log(2, "starting pipe read")
-		buf = os.read(self.fd, 4096)
+	def recv(self, size):
+		""" Override recv as we have a file descriptor, not a socket """
+		if debug: log.log(2, "pipe read of up to %d bytes", size)
+		buf = os.read(self.fd, size)
 		if buf == "":
 			log.error("EOF on stream, file descriptor closed")
 			raise IOError("EOF on stream, file descriptor closed")
-		self.rxMessage.processData(buf)
-		if debug: log.log(2, "done pipe read")
-		while self.rxMessage.isDone():  # Extract all messages that are in the buffer
-			if debug: log.debug("New message received on %s", self)
-			self.inmessages.append(self.rxMessage.getMessage())
-			self.rxMessage = transportStream.RXTracker(codec=self.codec, startbuf=self.rxMessage.getLeftover())
+		return buf
+
+	def recv_into(self, view):
+		""" No readinto for file descriptors, read a block and place it in the view """
+		buf = self.recv(min(len(view), transportStream.StreamTransport.MAXREAD))
+		view[:len(buf)] = buf
+		return len(buf)
 
 	def __repr__(self):
 		return "InputPipe %d" % self.fd
@@ -2,6 +2,7 @@
 import sys
 import struct
 import logging
+from collections import deque
 from transport import Transport
 from magimessage import DefaultCodec
 
@@ -9,153 +10,172 @@ log = logging.getLogger(__name__)
 debug = False
 
 class TXTracker(object):
+	"""
+		Tracks the transmission of one or more messages on a stream.  Each message is queued as two segments,
+		the preamble plus encoded header and the payload.  Segments are sent from buffer views so a partial
+		send never copies the remainder.  Runs of small segments are joined into one chunk so several short
+		messages leave in a single send call.
+	"""
 
-	def __init__(self, msg = None, codec = DefaultCodec):
-		if msg is None:
-			self.dataDone = True
-			return
-
-		self.header = StreamTransport.PREAMBLE + codec.encode(msg)
-		self.headerDone = False
-		self.hindex = 0
+	COALESCE = 65536  # segments below this size are joined into a single chunk
 
-		if msg.data is None:
-			self.data = ""
-		else:
-			self.data = msg.data
-		self.dataDone = False
-		self.dindex = 0
+	def __init__(self, msg = None, codec = DefaultCodec):
+		self.codec = codec
+		self.segments = deque()
+		self.queued = 0       # bytes queued, including the unsent part of chunk
+		self.chunk = None     # the string or buffer currently being sent
+		self.cindex = 0
+		if msg is not None:
+			self.add(msg)
+
+	def add(self, msg):
+		""" Encode and queue another message behind anything already in progress """
+		header = StreamTransport.PREAMBLE + self.codec.encode(msg)
+		self.segments.append(header)
+		self.queued += len(header)
+		if msg.data:
+			self.segments.append(msg.data)
+			self.queued += len(msg.data)
 
 	def isDone(self):
-		return self.dataDone
+		return self.queued == 0
 		
 	def getData(self):
-		if self.dataDone:
+		""" Return a view of the next bytes to send, the same view is returned until sent() moves past it """
+		if self.chunk is None:
+			self.nextChunk()
+		return buffer(self.chunk, self.cindex)
+
+	def nextChunk(self):
+		if not self.segments:
 			raise IndexError("No more data")
-		elif self.headerDone:
-			return self.data[self.dindex:]
-		else:
-			return self.header[self.hindex:]
+
+		if len(self.segments[0]) >= TXTracker.COALESCE:
+			self.chunk = self.segments.popleft()
+			return
+
+		parts = list()
+		size = 0
+		while self.segments and size + len(self.segments[0]) <= TXTracker.COALESCE:
+			seg = self.segments.popleft()
+			size += len(seg)
+			parts.append(str(seg))  # small copy, join won't take buffers
+		self.chunk = ''.join(parts)
 
 	def sent(self, count):
 		if debug: log.debug("%d bytes sent", count)
-		if self.dataDone:
-			raise IndexError("Already completed, this doesn't make sense")
-
-		elif self.headerDone:
-			self.dindex += count
-			if self.dindex >= len(self.data):
-				if debug: log.debug("Data send complete")
-				self.dataDone = True
-		else:
-			self.hindex += count
-			if self.hindex >= len(self.header):
-				self.headerDone = True
-				if debug: log.debug("Header send complete")
-				# self.dataDone = True ##  For testing partial transfers
+		if self.chunk is None:
+			raise IndexError("Nothing in progress, this doesn't make sense")
+
+		self.cindex += count
+		self.queued -= count
+		if self.cindex >= len(self.chunk):
+			if debug: log.debug("Chunk of %d bytes complete", len(self.chunk))
+			self.chunk = None
+			self.cindex = 0
 
 
 
 class RXTracker(object):
+	"""
+		Receives a single message from a stream.  The preamble and 6 byte length prefix are collected first,
+		then one bytearray of the exact message size is allocated and filled either from processData or
+		directly by the transport through getBuffer/received.  Bytes past the end of the message are kept
+		as a view for the next tracker, so the cost of receiving is linear in the message size.
+	"""
 
-	def __init__(self, startbuf = "", codec = DefaultCodec):
-		self.preamblebuf = ""
-		self.preambledone = False
+	PREFIXLEN = 6  # 4 bytes total length, 2 bytes header length
 
+	def __init__(self, startbuf = "", codec = DefaultCodec):
+		self.scan = bytearray()  # preamble and length prefix while searching
 		self.hdrlen = 0
-		self.hdrbuf = ""
-		self.headerdone = False
-
-		self.datalen = sys.maxint
-		self.datalist = list()
-		self.leftover = list()
+		self.buf = None          # length prefix, header and data once the size is known
+		self.filled = 0
+		self.leftover = ""
 
 		self.codec = codec 
 		self.processData(startbuf)
 		
 
 	def processData(self, data):
+		""" Consume data, a string or buffer, anything past the end of this message is saved as leftover """
 		if data is None or len(data) == 0:
 			return
 
-		if debug: log.debug("processing %d bytes (%s, %s)", len(data), self.preambledone, self.headerdone)
+		if debug: log.debug("processing %d bytes (%s)", len(data), self.buf is not None)
 
-		if not self.preambledone:  # Reading into preamble
-			self.preamblebuf += data
-			data = None
-			pidx = self.preamblebuf.find(StreamTransport.PREAMBLE)
-
-			if pidx < 0:
-				# delete what we can easily from head of buffer for faster search next time
-				if len(self.preamblebuf) > StreamTransport.PREAMBLELEN:
-					self.preamblebuf = self.preamblebuf[-StreamTransport.PREAMBLELEN:]
+		pos = 0
+		total = len(data)
+		while self.buf is None and pos < total:  # Reading preamble and lengths, only ever take what we need
+			want = StreamTransport.PREAMBLELEN + RXTracker.PREFIXLEN - len(self.scan)
+			self.scan.extend(data[pos:pos+want])
+			pos += want
+			if len(self.scan) < StreamTransport.PREAMBLELEN + RXTracker.PREFIXLEN:
 				return
 
-			self.hdrbuf = self.preamblebuf[pidx + StreamTransport.PREAMBLELEN:]
+			if self.scan[:StreamTransport.PREAMBLELEN] != StreamTransport.PREAMBLE:
+				pidx = self.scan.find(StreamTransport.PREAMBLE, 1)
+				if pidx < 0:  # keep what might be the start of a preamble
+					pidx = len(self.scan) - StreamTransport.PREAMBLELEN + 1
+				del self.scan[:pidx]
+				continue
+
 			if debug: log.debug("Preamble complete")
-			self.preambledone = True
-
-
-		if self.preambledone and not self.headerdone: # Reading into header
-			if data:  # still have data to read
-				self.hdrbuf += data
-				data = None
-			try:
-				# extraction of lengths may happen multiple times, but keeps code simpler
-				(totallen, self.hdrlen) = struct.unpack('>IH', self.hdrbuf[:6])
-				self.datalen = totallen - self.hdrlen - 2  # totalen [headerlen] [header] [data], totallen ecompases all []
-
-				left = self.hdrlen - len(self.hdrbuf) + 6
-				if left <= 0:
-					if debug: log.debug("Header complete")
-					self.headerdone = True # Got it all
-
-				if left >= 0:
-					if debug: log.debug("Need %d more bytes for header", left)
-					return  # More data needed to do anymore so return now
-
-				# otherwise, got first portion of data as well
-				self.datalist.append(self.hdrbuf[6+self.hdrlen:])
-			except struct.error:
-				return
+			self.allocate(self.scan[StreamTransport.PREAMBLELEN:])
 
+		if pos >= total:
+			return
+
+		take = min(total - pos, len(self.buf) - self.filled)
+		self.buf[self.filled:self.filled+take] = buffer(data, pos, take)
+		self.filled += take
+		pos += take
 
-		if data:  # Reading into data
-			if debug: log.debug("Appended %d byte to datalist", len(data))
-			self.datalist.append(data)
+		if pos < total:
+			self.leftover = buffer(data, pos)  # rest belongs to the next message, don't copy it
 
 
+	def allocate(self, prefix):
+		""" Got the length prefix, create the buffer for the entire message """
+		(totallen, self.hdrlen) = struct.unpack('>IH', str(prefix))
+		size = totallen + 4  # totallen covers [headerlen] [header] [data]
+		if size < RXTracker.PREFIXLEN + self.hdrlen:
+			log.error("Bad message lengths (%d, %d), searching for next preamble", totallen, self.hdrlen)
+			del self.scan[:StreamTransport.PREAMBLELEN]
+			return
+		if debug: log.debug("Allocating %d bytes for message", size)
+		self.buf = bytearray(size)
+		self.buf[0:RXTracker.PREFIXLEN] = prefix
+		self.filled = RXTracker.PREFIXLEN
+
+
+	def getBuffer(self):
+		""" Return a writable view of the unfilled part of the message or None if its size is not known yet """
+		if self.buf is None or self.filled >= len(self.buf):
+			return None
+		return memoryview(self.buf)[self.filled:]
+
+	def received(self, count):
+		""" Note that count bytes were written into the view returned from getBuffer """
+		self.filled += count
+
 	def isDone(self):
-		mylen = sum([len(x) for x in self.datalist])
-		if debug: log.debug("Checking if done (%s, %s, have %d vs %d needed)", self.preambledone, self.headerdone, mylen, self.datalen)
-		return self.preambledone and self.headerdone and mylen >= self.datalen
+		if debug: log.debug("Checking if done (have %d vs %d needed)", self.filled, len(self.buf or ""))
+		return self.buf is not None and self.filled >= len(self.buf)
 
 	def getMessage(self):
 		try:
-			mylen = sum([len(x) for x in self.datalist])
-			#self.leftover should be used
-			#leftover = list()
-			while mylen > self.datalen:  # Pull out left over data
-				self.leftover.insert(0, self.datalist.pop(-1))
-				mylen = sum([len(x) for x in self.datalist])
-
-			if mylen < self.datalen:  # Need part of that first (last) buffer
-				hh = self.leftover.pop(0)
-				mid = self.datalen - mylen
-				self.datalist.append(hh[:mid])
-				self.leftover.insert(0, hh[mid:])
-				
-				
-			newmsg, hdrsize = self.codec.decode(self.hdrbuf)
-			newmsg.data = ''.join(self.datalist)
+			hdrsize = RXTracker.PREFIXLEN + self.hdrlen
+			newmsg, hdrsize = self.codec.decode(buffer(self.buf, 0, hdrsize))
+			newmsg.data = str(buffer(self.buf, hdrsize))  # only copy, consumers expect an immutable string
 			return newmsg
 		except:
 			log.error("Error decoding message", exc_info=1)
 			return None
 
 	def getLeftover(self):
-		if debug: log.debug("%d bytes leftover", sum([len(x) for x in self.leftover]))
-		return ''.join(self.leftover)
+		if debug: log.debug("%d bytes leftover", len(self.leftover))
+		return self.leftover
 
 
 
@@ -168,6 +188,8 @@ class StreamTransport(Transport):
 
 	PREAMBLE = "MAGI\x88MSG"
 	PREAMBLELEN = len(PREAMBLE)
+	MINREAD = 4096
+	MAXREAD = 262144
 
 	def __init__(self, sock = None, codec=DefaultCodec):
 		"""
@@ -180,10 +202,12 @@ class StreamTransport(Transport):
 			self.connected = False
 		self.txMessage = TXTracker(codec=self.codec)
 		self.rxMessage = RXTracker(codec=self.codec)
+		self.readsize = StreamTransport.MINREAD
 
 
 	def setCodec(self, codec):
 		Transport.setCodec(self, codec)
+		self.txMessage.codec = codec
 		self.rxMessage.codec = codec
 
 		
@@ -191,30 +215,68 @@ class StreamTransport(Transport):
 		"""
 			select indicates that we have data, this will do the actual reading and processing
 		"""
-		self.rxMessage.processData(self.recv(4096))
+		view = self.rxMessage.getBuffer()
+		if view is not None:
+			# Size is known, read straight into the message buffer
+			self.rxMessage.received(self.recv_into(view))
+		else:
+			self.rxMessage.processData(self.readChunk())
+
 		while self.rxMessage.isDone():  # Extract all messages that are in the buffer
 			if debug: log.debug("StreamTransport: New message received on %s", self)
 			self.inmessages.append(self.rxMessage.getMessage())
 			self.rxMessage = RXTracker(startbuf=self.rxMessage.getLeftover(), codec=self.codec)
 
 
+	def readChunk(self):
+		"""
+			Read when we don't know how much we need yet.  The read size doubles when reads come back full,
+			up to MAXREAD, so a busy stream of small messages takes fewer calls.
+		"""
+		data = self.recv(self.readsize)
+		if len(data) >= self.readsize and self.readsize < StreamTransport.MAXREAD:
+			self.readsize *= 2
+		return data
+
+
 	def handle_write(self):
 		"""
 			select indicates that we can write, this will attempt to write whatever we have around
 		"""
-		if self.txMessage.isDone():
-			try:
-				self.txMessage = TXTracker(codec=self.codec, msg=self.outmessages.pop(0))
-			except IndexError:
-				return
+		self.fillTracker()
 
 		#keep sending till you can
 		while not self.txMessage.isDone():
-			bytesWritten = self.send(self.txMessage.getData())
+			bytesWritten = self.writeData(self.txMessage.getData())
 			self.txMessage.sent(bytesWritten)
 			#if no more can be written, break out
 			if bytesWritten == 0:
 				break
+			self.fillTracker()
+
+
+	def fillTracker(self):
+		"""
+			Move messages from outmessages into the tracker while it has room for them to be coalesced
+		"""
+		while self.outmessages and self.txMessage.queued < TXTracker.COALESCE:
+			msg = self.outmessages.pop(0)
+			self.prepareMessage(msg)
+			self.txMessage.add(msg)
+
+
+	def prepareMessage(self, msg):
+		"""
+			Called just before a message is encoded for transmission, subclasses can fill in header values
+		"""
+		pass
+
+
+	def writeData(self, data):
+		"""
+			Write as much of data as possible, return the number of bytes written
+		"""
+		return self.send(data)
 
 
 	def readable(self):
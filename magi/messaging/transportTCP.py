@@ -79,25 +79,11 @@ class TCPTransport(transportStream.StreamTransport):
 		self.connect(self.saveHost, self.savePort)
 
 
-	def handle_write(self):
+	def prepareMessage(self, msg):
 		"""
 			Override stream version so we can add hosttime to outgoing packets
 		"""
-		if self.txMessage.isDone():
-			try:
-				msg = self.outmessages.pop(0)
-				msg.hosttime = int(time.time())
-				self.txMessage = transportStream.TXTracker(codec=self.codec, msg=msg)
-			except IndexError:
-				return
-			
-		#keep sending till you can
-		while not self.txMessage.isDone():
-			bytesWritten = self.send(self.txMessage.getData())
-			self.txMessage.sent(bytesWritten)
-			#if no more can be written, break out
-			if bytesWritten == 0:
-				break
+		msg.hosttime = int(time.time())
 			
 
 	def __repr__(self):
@@ -1,6 +1,5 @@
 
 import threading
-import asyncore
 import logging
 import time
 import sys
@@ -9,6 +8,7 @@ from magi.util.scheduler import Scheduler
 from magi.util import helpers
 from magimessage import MAGIMessage
 from transport import Transport
+from reactor import Reactor
 from routerGroup import GroupRouter
 from routerNode import NodeRouter
 from processor import AckReply, NameAndID, AckRequirement, SequenceRequirement, TimestampRequirement
@@ -18,6 +18,10 @@ from api import GroupRequest, TransportRequest, TransmitRequest, MessageStatus
 log = logging.getLogger(__name__)
 debug = True
 
+# Longest we block in poll without a wakeup, only a safety net for anyone filling txqueue without calling wakeup()
+MAXPOLLWAIT = 5.0
+TIMERRESOLUTION = 0.01  # short timers (NACKs, retransmits) go in a timing wheel with this granularity
+
 
 class LocalTransport(Transport):
 	def fileno(self):
@@ -79,14 +83,17 @@ class WorkerThread(threading.Thread):
 		# transports that can be passed to poll (have a valid socket fd)
 		self.pollMap = dict()
 
+		# persistent poller for pollMap, lets user requests interrupt the wait via wakeup()
+		self.reactor = Reactor()
+
 		# scheduler shared by all in this thread including transports
-		self.scheduler = Scheduler()
+		self.scheduler = Scheduler(resolution=TIMERRESOLUTION)
 
 		# create the processors we will use
 		ackrep = AckReply()
 		nameid = NameAndID()
 		groupr = GroupRouter()
-		noder = NodeRouter()
+		noder = NodeRouter(groupRouter=groupr)
 		ackreq = AckRequirement()
 		seq = SequenceRequirement()
 		tstamp = TimestampRequirement()
@@ -155,7 +162,7 @@ class WorkerThread(threading.Thread):
 				log.debug("Processing locally created message %s", obj.msg)
 				if type(obj.msg.data) not in (str, buffer):
 					log.error("Dropping message, data is of type %s, needs to be a string or buffer", type(obj.msg.data))
-					return
+					continue
 				obj.msg._receivedon = self.transportMap[0]
 				obj.msg._userargs = obj.args
 				self.queues['OUT'].append(obj.msg)
@@ -406,6 +413,10 @@ class WorkerThread(threading.Thread):
 		# Run all of our processing chains until their input queues are empty
 		self.processMsgQueues()
 		
+	def wakeup(self):
+		""" Thread safe, called after placing something in txqueue so the worker handles it right away """
+		self.reactor.wakeup()
+
 	def stop(self):
 		self.requiredList = set()
 		log.debug("Closing transports")
@@ -414,6 +425,7 @@ class WorkerThread(threading.Thread):
 			transport.close()
 		log.debug("Transports closed")
 		self.done = True
+		self.wakeup()
 
 	def run(self):
 #		import cProfile
@@ -423,7 +435,7 @@ class WorkerThread(threading.Thread):
 		"""
 			Run the sockets thread.  Infinite loop:
 			- run the scheduler and events, returns the time until the next future event
-			- wait for that amount of time (max 1/10th second) for events on any open sockets
+			- wait for that amount of time for events on any open sockets or a wakeup from the user side
 		"""
 		self.threadId = helpers.getThreadId()
 		log.info("Worker started. Thread id: " + str(self.threadId))
@@ -433,11 +445,8 @@ class WorkerThread(threading.Thread):
 		self.done = False
 		while not self.done:
 			try:
-				timeout = min(0.2, self.scheduler.run()) # Max 0.2 second sleep, maybe less, we can't wait on Queue.Queue so we have to poll it
-				if len(self.pollMap) <= 0:
-					time.sleep(timeout)
-				else:
-					asyncore.poll(timeout, self.pollMap)  # poll appears to be a little faster than poll2
+				timeout = min(MAXPOLLWAIT, self.scheduler.run())
+				self.reactor.poll(timeout, self.pollMap)  # returns early on socket events or wakeup()
 				self.loop()
 			except:
 				if log is None:
@@ -445,5 +454,6 @@ class WorkerThread(threading.Thread):
 				log.error("Failed in router thread: %s", sys.exc_info()[1], exc_info=True)
 				time.sleep(0.5) # Don't jump into a super loop on repeatable errors
 				
+		self.reactor.close()  # here rather than in stop, which could race with a poll in progress
 		log.info("Worker stopped")
 
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+from collections import defaultdict
 import hashlib
+import itertools
 import logging
 import pickle
 import threading
@@ -9,6 +11,7 @@ import time
 from magi.messaging.magimessage import MAGIMessage
 from magi.util import database, helpers, config
 from magi.util.agent import NonBlockingDispatchAgent, agentmethod
+from magi.util.pool import WorkerPool
 import pymongo
 import yaml
 
@@ -24,9 +27,19 @@ def getAgent(**kwargs):
 
 class DataManAgent(NonBlockingDispatchAgent):
     
+    STREAM_WINDOW = 4 # data chunks sent ahead of the requester's acknowledgements
+    STREAM_ACK_TIMEOUT = 60
+    QUERY_WORKERS = 8 # concurrent database queries per getData request
+    
     def __init__(self, *args, **kwargs):
         try:
             NonBlockingDispatchAgent.__init__(self, *args, **kwargs)
+            self.concurrencyKeys['streamData'] = self.streamKey
+            self.streamAcks = dict() # (requester, queryId) -> highest acknowledged chunk, None once cancelled
+            self.streamCancels = dict() # (requester, queryId) -> time, cancelled before the stream started
+            self.streamCondition = threading.Condition()
+            self.queryLock = threading.Lock()
+            self.queryStats = defaultdict(lambda: [0, 0, 0.0, 0.0]) # agent -> [queries, records, total time, max time]
             self.collectionMetadata = dict()
             self.events = dict()
             self.rcvdPongs = set()
@@ -169,13 +182,142 @@ class DataManAgent(NonBlockingDispatchAgent):
         NonBlockingDispatchAgent.stop(self, msg)
             
     @agentmethod()
-    def getData(self, msg, agents=None, nodes=None, filters=dict(), timestampChunks=None, visited=set()):
+    def getData(self, msg, agents=None, nodes=None, filters=dict(), timestampChunks=None, visited=set(), fields=None):
         """
             Request to fetch data
         """
         functionName = self.getData.__name__
         helpers.entrylog(log, functionName, locals())
         
+        agents_, nodes_, timestampChunks = self.resolveQuery(agents, nodes, timestampChunks)
+        
+        data = self.fetchData(agents_, nodes_, filters, timestampChunks, fields)
+        
+        args = {
+            "agents": agents,
+            "nodes": nodes,
+            "filters": filters,
+            "timestampChunks": timestampChunks,
+            "visited": visited,
+            "data": data
+        }
+        call = {'version': 1.0, 'method': 'putData', 'args': args}
+        log.debug('Creating data message')
+        msg = MAGIMessage(nodes=msg.src, docks='dataman', contenttype=MAGIMessage.PICKLE, data=pickle.dumps(call))
+        log.debug('Sending message')
+        self.messenger.send(msg)
+        
+        helpers.exitlog(log, functionName)
+        
+    @agentmethod()
+    def streamData(self, msg, queryId, agents=None, nodes=None, filters=dict(), timestampChunks=None, 
+                   fields=None, chunkSize=database.QUERY_CHUNK_SIZE, window=STREAM_WINDOW):
+        """
+            Request to fetch data as a sequence of putDataChunk messages, 
+            numbered from 0 in agent then node order, each holding at most 
+            chunkSize records of one agent and node. Every agent and node pair 
+            gets at least one chunk. The final chunk has no records and last 
+            set. At most window chunks are sent ahead of the requester's 
+            ackData calls.
+        """
+        functionName = self.streamData.__name__
+        helpers.entrylog(log, functionName, locals())
+        
+        agents_, nodes_, timestampChunks = self.resolveQuery(agents, nodes, timestampChunks)
+        
+        key = (msg.src, queryId)
+        with self.streamCondition:
+            if self.streamCancels.pop(key, None) is not None:
+                log.info("Data query %s from %s was cancelled before it started", queryId, msg.src)
+                return
+            self.streamAcks[key] = -1
+        seq = 0
+        try:
+            for agent in sorted(agents_):
+                for node in sorted(nodes_):
+                    for chunk in self.queryRecords(agent, node, filters, timestampChunks, fields, chunkSize):
+                        if not self.waitForAck(key, seq - window):
+                            if self.streamAcks[key] is None:
+                                log.info("Data query %s from %s cancelled", queryId, msg.src)
+                            else:
+                                log.error("No acknowledgement for data chunk %d of query %s from %s, giving up", 
+                                          seq - window, queryId, msg.src)
+                            return
+                        self.sendChunk(msg, queryId, seq, agent, node, chunk)
+                        seq += 1
+            self.sendChunk(msg, queryId, seq, None, None, [], last=True)
+        finally:
+            with self.streamCondition:
+                del self.streamAcks[key]
+        
+        helpers.exitlog(log, functionName)
+        
+    @agentmethod()
+    def ackData(self, msg, queryId, seq, cancel=False):
+        """
+            Requester has taken data chunks up to seq of a streamData query, 
+            or with cancel set, wants no more of it
+        """
+        key = (msg.src, queryId)
+        with self.streamCondition:
+            if key not in self.streamAcks:
+                if cancel:
+                    # the stream may still be queued behind another from the same requester
+                    now = time.time()
+                    for old in [k for k, t in self.streamCancels.iteritems() if t + DataManAgent.STREAM_ACK_TIMEOUT < now]:
+                        del self.streamCancels[old]
+                    self.streamCancels[key] = now
+            elif cancel:
+                self.streamAcks[key] = None
+                self.streamCondition.notify_all()
+            elif self.streamAcks[key] is not None and seq > self.streamAcks[key]:
+                self.streamAcks[key] = seq
+                self.streamCondition.notify_all()
+        
+    def waitForAck(self, key, seq):
+        """
+            Internal function to wait until chunk seq of a stream is acknowledged, 
+            False on timeout or if the stream was cancelled
+        """
+        stop = time.time() + DataManAgent.STREAM_ACK_TIMEOUT
+        with self.streamCondition:
+            while True:
+                acked = self.streamAcks[key]
+                if acked is None:
+                    return False
+                if acked >= seq:
+                    return True
+                remaining = stop - time.time()
+                if remaining <= 0:
+                    return False
+                self.streamCondition.wait(remaining)
+    
+    def streamKey(self, msg):
+        """
+            Concurrency key for a streamData call. Streams from one requester 
+            run one at a time, and at most half the workers run streams, 
+            leaving the rest for acknowledgements and other calls.
+        """
+        return ('streamData', hash((msg.src, msg.srcdock)) % max(1, self.workers // 2))
+    
+    def sendChunk(self, msg, queryId, seq, agent, node, records, last=False):
+        args = {
+            "queryId": queryId,
+            "seq": seq,
+            "agent": agent,
+            "node": node,
+            "records": records,
+            "last": last
+        }
+        call = {'version': 1.0, 'method': 'putDataChunk', 'args': args}
+        self.messenger.send(MAGIMessage(nodes=msg.src, docks=msg.srcdock or 'dataman', 
+                                        contenttype=MAGIMessage.PICKLE, 
+                                        data=pickle.dumps(call, pickle.HIGHEST_PROTOCOL)))
+        
+    def resolveQuery(self, agents, nodes, timestampChunks):
+        """
+            Internal function to fill in the default agents, nodes and time range of a query
+        """
         agents_ = helpers.toSet(agents)
         nodes_ = helpers.toSet(nodes)
         
@@ -190,37 +332,105 @@ class DataManAgent(NonBlockingDispatchAgent):
         
         if timestampChunks == None:
             timestampChunks = [(0, time.time())]
+            
+        return agents_, nodes_, timestampChunks
+    
+    def fetchData(self, agents, nodes, filters, timestampChunks, fields):
+        """
+            Internal function to fetch agent -> node -> records, with one 
+            query across all the nodes per agent and time range. The queries 
+            run concurrently, each one's records are split by node as it 
+            completes and the time ranges are joined in order at the end.
+        """
+        functionName = self.fetchData.__name__
+        helpers.entrylog(log, functionName, locals())
         
-        data = dict()
-        for agent in agents_:
-            data[agent] = dict()
-            for node in nodes_:
-                filters_copy = filters.copy()
-                filters_copy['host'] = node
-                nodedata = []
-                for tsChunk in timestampChunks:
-                    nodedata = nodedata + database.getData(agent, 
-                                                           filters_copy, 
-                                                           tsChunk, 
-                                                           database.configHost(), 
-                                                           database.ROUTER_SERVER_PORT)
-                data[agent][node] = nodedata
+        parts = dict() # (agent, time range index) -> node -> records
+            
+        filters_copy = filters.copy()
+        filters_copy['host'] = {'$in': list(nodes)}
+        if fields and 'host' not in fields:
+            fields = list(fields) + ['host']
         
-        args = {
-            "agents": agents,
-            "nodes": nodes,
-            "filters": filters,
-            "timestampChunks": timestampChunks,
-            "visited": visited,
-            "data": data
-        }
-        call = {'version': 1.0, 'method': 'putData', 'args': args}
-        log.debug('Creating data message')
-        msg = MAGIMessage(nodes=msg.src, docks='dataman', contenttype=MAGIMessage.PICKLE, data=pickle.dumps(call))
-        log.debug('Sending message')
-        self.messenger.send(msg)
+        # connect once up front rather than in every worker
+        database.getConnection(database.getConfigHost(), database.ROUTER_SERVER_PORT)
+        
+        queries = [(agent, index) for agent in agents for index in range(len(timestampChunks))]
+        errors = []
+        pool = WorkerPool('dataquery', min(DataManAgent.QUERY_WORKERS, len(queries)), len(queries))
+        for agent, index in queries:
+            pool.submit(agent, None, self.fetchQuery, parts, errors, agent, index, 
+                        filters_copy, timestampChunks[index], fields)
+        pool.shutdown()
+        
+        if errors:
+            raise errors[0]
+        
+        data = dict()
+        for agent in agents:
+            data[agent] = dict((node, []) for node in nodes)
+            for index in range(len(timestampChunks)):
+                for node, records in parts[(agent, index)].iteritems():
+                    data[agent].setdefault(node, []).extend(records)
         
         helpers.exitlog(log, functionName)
+        return data
+    
+    def fetchQuery(self, parts, errors, agent, index, filters, tsChunk, fields):
+        """
+            Internal function to run one query on a worker and split its records by node into parts
+        """
+        start = time.time()
+        try:
+            records = list(database.iterData(agent, filters, tsChunk, 
+                                             database.getConfigHost(), database.ROUTER_SERVER_PORT, fields))
+        except Exception, e:
+            log.error("Query for agent %s, time range %s failed: %s", agent, tsChunk, e)
+            with self.queryLock:
+                errors.append(e)
+            return
+        elapsed = time.time() - start
+        log.debug("Query for agent %s, time range %s returned %d records in %.3f seconds", 
+                  agent, tsChunk, len(records), elapsed)
+        
+        bynode = dict()
+        for record in records:
+            bynode.setdefault(record['host'], []).append(record)
+        
+        with self.queryLock:
+            parts[(agent, index)] = bynode
+            stats = self.queryStats[agent]
+            stats[0] += 1
+            stats[1] += len(records)
+            stats[2] += elapsed
+            stats[3] = max(stats[3], elapsed)
+            
+    @agentmethod()
+    def getQueryStats(self, msg=None):
+        """
+            Number of queries, records returned, total and max query time per agent
+        """
+        with self.queryLock:
+            return dict((agent, {'queries': queries, 'records': records, 'time': total, 'maxtime': maxtime}) 
+                        for agent, (queries, records, total, maxtime) in self.queryStats.iteritems())
+    
+    def queryRecords(self, agent, node, filters, timestampChunks, fields, chunkSize=database.QUERY_CHUNK_SIZE):
+        """
+            Internal function to fetch the records of an agent on a node as 
+            lists of at most chunkSize records, at least one possibly empty list
+        """
+        filters_copy = filters.copy()
+        filters_copy['host'] = node
+        records = itertools.chain.from_iterable(
+                    database.iterData(agent, filters_copy, tsChunk, 
+                                      database.getConfigHost(), database.ROUTER_SERVER_PORT, fields)
+                    for tsChunk in timestampChunks)
+        empty = True
+        for chunk in database.chunkData(records, chunkSize):
+            empty = False
+            yield chunk
+        if empty:
+            yield []
         
     def getSensorAgents(self, node):
         """
@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 
 import Queue
-from collections import defaultdict
-import copy
+import heapq
 import logging
 from socket import gethostname
 import threading
@@ -10,12 +9,15 @@ import time
 
 from magi.db import Collection
 from magi.db.Collection import DATABASE_SERVER_PORT
+from magi.messaging.magimessage import MAGIMessage
 from magi.orchestrator.OrchestratorDisplay import OrchestratorDisplayState
 from magi.orchestrator.dagdisplay import DagDisplay
 from magi.util import helpers
+from magi.util.blobs import splitBlob
+from magi.util.calls import dumpMessageData
 import yaml
 
-from parse import EventObject, TriggerList, createEvent, createTrigger, Stream
+from parse import BaseMethodCall, EventObject, TriggerList, TriggerIndex, createEvent, createTrigger, Stream
 
 
 log = logging.getLogger(__name__)
@@ -27,6 +29,7 @@ class StreamIterator(object):
         self.name = name
         self.wrapped = stream
         self.index = 0
+        self.checkedIndex = None # index of the trigger list last checked
         if not self.isDone():
             if self.isNextTrigger():
                 self.next().activate()
@@ -102,10 +105,11 @@ class StreamIterator(object):
     def next(self):
         return self.wrapped[self.index]
 
-    def getFirstTimeout(self):
+    def getDeadline(self):
+        """ Time the current trigger list may complete without new triggers, None if it only waits on events """
         if self.isNextTrigger():
-            return self.next().getTimeout()
-        return 0
+            return self.next().getDeadline()
+        return None
         
     def __repr__(self):
         '''give name, index, and remaining stream events.'''
@@ -121,6 +125,13 @@ class Orchestrator(object):
     # if True, show current state
     show_state = False
     
+    # longest wait for a message, so that stop requests are noticed
+    MAXWAIT = 3.0
+    
+    # seconds during which more requests to send a blob to the same place 
+    # are answered by the copy already sent
+    BLOB_RESEND = 10.0
+    
     def __init__(self, messenger, aal, verbose=False, exitOnFailure=True, 
             useColor=True, dagdisplay=False, dbHost="localhost", dbPort=DATABASE_SERVER_PORT):
         """
@@ -142,8 +153,16 @@ class Orchestrator(object):
         self.aal = aal
         
         # save triggers based on 'event' value for quicker lookup
-        self.triggerCache = defaultdict(list)
-        self.activeTriggerCache = defaultdict(list)
+        self.triggerCache = TriggerIndex()
+        self.activeTriggerCache = TriggerIndex()
+        
+        # see runStreams
+        self.ready = set()
+        self.deadlines = []
+        self.waiting = dict()
+        
+        # (digest, groups, nodes) -> when the blob was last sent there
+        self.blobsSent = dict()
         
         self.exitOnFailure = exitOnFailure
         self.verbose = verbose
@@ -261,6 +280,9 @@ class Orchestrator(object):
             currentIndex = self.activeStreams[streamName].index
             if objectIndex < currentIndex:
                 self.activeStreams[streamName].index -= 1
+            # the current item may have changed
+            self.activeStreams[streamName].checkedIndex = None
+            self.ready.add(streamName)
         
         log.info("Modified event stream %s" %(eventStream))
         
@@ -281,6 +303,8 @@ class Orchestrator(object):
         log.info("Current event stream %s" %(eventStream))
             
         eventObject = createEvent(event, self.aal.rawAAL)
+        if isinstance(eventObject, BaseMethodCall):
+            eventObject.encode(self.aal.contenttype)
         
         if index is not None:
             eventStream.insert(index, eventObject)
@@ -290,6 +314,11 @@ class Orchestrator(object):
                     self.activeStreams[streamName].index += 1
         else:
             eventStream.append(eventObject)
+        
+        if streamName in self.activeStreams:
+            # the current item may have changed
+            self.activeStreams[streamName].checkedIndex = None
+            self.ready.add(streamName)
                 
         log.info("Modified event stream %s" %(eventStream))
         
@@ -342,37 +371,32 @@ class Orchestrator(object):
                 streamIter.dbIndex += 1
                 streamIter.recordNext(self.collection)
         
+        # names of the streams that need looking at: new or moved forward, 
+        # woken by a trigger they wait on, or past their deadline
+        self.ready = set(self.activeStreams)
+        # heap of (deadline, stream name, index, stream) for streams waiting 
+        # on trigger lists with a timeout
+        self.deadlines = []
+        # event -> names of the streams waiting on it
+        self.waiting = dict()
+        
         while len(self.activeStreams) > 0 and not self.stopStreams:
             
             if Orchestrator.show_state:
                 self.display.waitingOnTriggers(self.triggerCache, self.activeStreams.values())
                 Orchestrator.show_state = False
                 
+            self.expireDeadlines(time.time())
+            
             try:
                 
                 msg = None
-                # minimumTimeout is the minimum timeout for the currently
-                # staged event/triggers. This is usually zero unless
-                # we're waiting on a trigger.
-                minimumTimeout = min([s.getFirstTimeout()
-                               for s in self.activeStreams.values()]) - time.time()
-
-                if minimumTimeout > 0:
-                    # don't wait for longer than 3 seconds as we need to be 
-                    # able to listen for signals
-                    try: 
-                        #if self.verbose: 
-                        #    self.display.waitingForMessage(3.0)
-                        msg = self.messaging.nextMessage(True, min(minimumTimeout, 3.0))
-                    except Queue.Empty: 
-                        pass
-
-                    if not msg:
-                        continue
-
+                if self.ready:
+                    msg = self.messaging.nextMessage(False)
                 else:
-                    # block for short time so we don't busy loop.
-                    msg = self.messaging.nextMessage(True, 0.1)
+                    # nothing to do until a message arrives or the next 
+                    # deadline passes
+                    msg = self.messaging.nextMessage(True, self.getWaitTime())
                
                 log.debug(msg)
 
@@ -417,38 +441,79 @@ class Orchestrator(object):
             except Queue.Empty:
                 pass
 
-            # continue until nothing can move forward anymore
-            progress = True
-            while progress:
-                progress = False
-
-                for streamIter in self.activeStreams.values():
-                    # work on the current event in each stream 
-                    if streamIter.isDone():
-                        # Nothing left in stream, remove the stream
-                        self.display.streamEnded(streamIter)
-                        # self.dagdisplay.startToIndex(self.activeStreams)
-                        del self.activeStreams[streamIter.getName()]
-                        
-                    elif streamIter.isNextEvent():
-                        event = streamIter.next()
-                        # Send all the event messages and move on.
-                        # getMessages() always returns a list with only 
-                        # one item. 
-                        self.display.eventFired(streamIter)
-                        for msg in event.getMessages():
-                            if self.verbose:
-                                log.info("orch sends %s" % msg.data)
-                            self.messaging.send(msg)
-                        
-                        if self.overWriteCachedTriggers and event.trigger:
-                            # this event has an accompanying trigger
-                            # if the cache has the same trigger, it becomes
-                            # stale now, and should be removed
-                            #self.triggerCache.pop(event.trigger, None)
-                            self.invalidateTriggers(event.trigger, None)
-                            
-                        #Collecting outgoing event data into the database    
+            # streams waiting on events that received triggers
+            for event in self.activeTriggerCache.takeChanged():
+                self.ready.update(self.waiting.get(event, ()))
+            
+            # step the ready streams in turn until nothing can move forward
+            while self.ready:
+                ready = self.ready
+                self.ready = set()
+                for name in ready:
+                    streamIter = self.activeStreams.get(name)
+                    if streamIter is not None and self.stepStream(streamIter):
+                        self.ready.add(name)
+
+    def getWaitTime(self):
+        """ Seconds until the next stream deadline, at most MAXWAIT """
+        if self.deadlines:
+            return max(0, min(self.deadlines[0][0] - time.time(), Orchestrator.MAXWAIT))
+        return Orchestrator.MAXWAIT
+    
+    def expireDeadlines(self, now):
+        """ Ready the streams whose deadlines have passed """
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, name, index, streamIter = heapq.heappop(self.deadlines)
+            if self.activeStreams.get(name) is streamIter and streamIter.index == index:
+                self.ready.add(name)
+    
+    def waitOn(self, streamIter, triggerList):
+        """ Wake the stream when an event its trigger list waits on arrives, or at its deadline """
+        if streamIter.checkedIndex == streamIter.index:
+            return
+        streamIter.checkedIndex = streamIter.index
+        name = streamIter.getName()
+        for event in triggerList.getWaitingEvents():
+            self.waiting.setdefault(event, set()).add(name)
+        deadline = triggerList.getDeadline()
+        if deadline is not None:
+            heapq.heappush(self.deadlines, (deadline, name, streamIter.index, streamIter))
+    
+    def stopWaiting(self, streamIter, triggerList):
+        name = streamIter.getName()
+        for event in triggerList.getWaitingEvents():
+            names = self.waiting.get(event)
+            if names:
+                names.discard(name)
+    
+    def stepStream(self, streamIter):
+        """ Work on the current item of a stream, returns True if the stream moved forward """
+        if streamIter.isDone():
+            # Nothing left in stream, remove the stream
+            self.display.streamEnded(streamIter)
+            # self.dagdisplay.startToIndex(self.activeStreams)
+            del self.activeStreams[streamIter.getName()]
+            return False
+            
+        elif streamIter.isNextEvent():
+            event = streamIter.next()
+            # Send all the event messages and move on.
+            # getMessages() always returns a list with only 
+            # one item. 
+            self.display.eventFired(streamIter)
+            for msg in event.getMessages():
+                if self.verbose:
+                    log.info("orch sends %s" % msg.data)
+                self.messaging.send(msg)
+            
+            if self.overWriteCachedTriggers and event.trigger:
+                # this event has an accompanying trigger
+                # if the cache has the same trigger, it becomes
+                # stale now, and should be removed
+                #self.triggerCache.pop(event.trigger, None)
+                self.invalidateTriggers(event.trigger, None)
+                
+            #Collecting outgoing event data into the database    
 #                         if self.collection:
 #                             self.collection.insert({'type' : 'event', 
 #                                                     'streamName' : streamIter.getName(), 
@@ -458,36 +523,38 @@ class Orchestrator(object):
 #                                                     'groups' : event.groups, 
 #                                                     'nodes' : event.nodes,
 #                                                     'docks' : event.docks})
-            
-                        streamIter.advance()
-                        if self.record and self.collection:
-                            streamIter.recordNext(self.collection)
-                        progress = True
-                        
-                    elif streamIter.isNextTrigger():
-                        triggerList = streamIter.next()
-                        for trigger in triggerList:
-                            if trigger.isComplete(self.activeTriggerCache):
-                                self.display.triggerCompleted(streamIter, trigger)
-                                if self.record and self.collection:
-                                    self.collection.insert({'streamName' : streamIter.getName(), 
-                                                            'eventItr' : streamIter.dbIndex, 
-                                                            'eventType' : "triggerComplete",
-                                                            'eventLabel' : "Trigger Complete\n%s" %(trigger.toString())})
-                                    streamIter.dbIndex += 1
-                                self.jumpToTarget(streamIter, trigger)
-                                progress = True
-                                break
-                                
-                    else:
-                        log.error('Unknown object in stream "%s". ' \
-                                    'Moving ahead.' %(streamIter.getName()))
-                        log.error(streamIter.next())
-                        streamIter.advance()
-                        if self.record and self.collection:
-                            streamIter.recordNext(self.collection)
-                        progress = True
 
+            streamIter.advance()
+            if self.record and self.collection:
+                streamIter.recordNext(self.collection)
+            return True
+            
+        elif streamIter.isNextTrigger():
+            triggerList = streamIter.next()
+            for trigger in triggerList:
+                if trigger.isComplete(self.activeTriggerCache):
+                    self.activeTriggerCache.unwatch(triggerList)
+                    self.stopWaiting(streamIter, triggerList)
+                    self.display.triggerCompleted(streamIter, trigger)
+                    if self.record and self.collection:
+                        self.collection.insert({'streamName' : streamIter.getName(), 
+                                                'eventItr' : streamIter.dbIndex, 
+                                                'eventType' : "triggerComplete",
+                                                'eventLabel' : "Trigger Complete\n%s" %(trigger.toString())})
+                        streamIter.dbIndex += 1
+                    self.jumpToTarget(streamIter, trigger)
+                    return True
+            self.waitOn(streamIter, triggerList)
+            return False
+                    
+        else:
+            log.error('Unknown object in stream "%s". ' \
+                        'Moving ahead.' %(streamIter.getName()))
+            log.error(streamIter.next())
+            streamIter.advance()
+            if self.record and self.collection:
+                streamIter.recordNext(self.collection)
+            return True
 
     def jumpToTarget(self, streamIter, trigger):
         """ Advance stream based on the target """
@@ -512,6 +579,7 @@ class Orchestrator(object):
             elif self.aal.hasStream(trigger.target):
                 self.display.streamJump(streamIter, trigger.target)
                 self.activeStreams[trigger.target] = StreamIterator(trigger.target, self.aal.getStream(trigger.target))
+                self.ready.add(trigger.target)
             else:
                 log.error("Couldn't find target stream %s, stopping here",
                           trigger.target)
@@ -536,28 +604,45 @@ class Orchestrator(object):
         if self.overWriteCachedTriggers:
             self.invalidateTriggers(incoming.event, incoming.nodes)
         
-        for node in incoming.nodes:
-            nodeTrigger = copy.copy(incoming)
-            nodeTrigger.nodes = set([node])
-            nodeTrigger.activate()
-            self.triggerCache[nodeTrigger.event].append(nodeTrigger)
-            self.activeTriggerCache[nodeTrigger.event].append(nodeTrigger)
-        
-        #log.debug('Updated trigger cache: %s' % self.triggerCache) 
-        
-        return self.activeTriggerCache[incoming.event]
+        incoming.activate()
+        self.triggerCache.add(incoming)
+        return self.activeTriggerCache.add(incoming)
 
     def invalidateTriggers(self, triggerEvent, nodes=None):
         functionName = self.invalidateTriggers.__name__
         helpers.entrylog(log, functionName, locals())
-        nodes = helpers.toSet(nodes)
-        activeTriggers = self.activeTriggerCache[triggerEvent]
-        for trigger in activeTriggers:
-            if (not nodes) or (trigger.nodes.issubset(nodes)):
-                log.debug("Deactivating trigger: %s" %(trigger))
-                trigger.deActivate()
-                activeTriggers.remove(trigger)
+        log.debug("Deactivating triggers for event %s from nodes %s" %(triggerEvent, nodes))
+        self.activeTriggerCache.invalidate(triggerEvent, nodes)
                 
+    def getBlob(self, digest, groups=None, nodes=None):
+        """
+            Send the chunks of an agent code blob to the groups or nodes 
+            missing it. All the nodes loading an agent ask at about the same 
+            time, only the first request sends the blob.
+        """
+        data = self.aal.blobs.get(digest)
+        if data is None:
+            log.error("Asked for unknown blob %s", digest)
+            return False
+        
+        target = (digest, tuple(sorted(groups or [])), tuple(sorted(nodes or [])))
+        now = time.time()
+        if now - self.blobsSent.get(target, 0) < Orchestrator.BLOB_RESEND:
+            log.debug("Blob %s already sent to %s", digest, target[1:])
+            return True
+        self.blobsSent[target] = now
+        
+        chunks = splitBlob(data)
+        log.info("Sending blob %s, %d bytes in %d chunks, to groups %s nodes %s", 
+                 digest, len(data), len(chunks), groups, nodes)
+        for index, chunk in enumerate(chunks):
+            call = {'version': 1.0, 'method': 'putBlob', 
+                    'args': {'digest': digest, 'index': index, 'count': len(chunks), 'data': chunk}}
+            contenttype, payload = dumpMessageData(call, MAGIMessage.PICKLE)
+            self.messaging.send(MAGIMessage(groups=groups, nodes=nodes, docks='daemon', 
+                                            contenttype=contenttype, data=payload))
+        return True
+        
     def doMessageAction(self, msgData):
         """
             The function takes a message, and demuxxes it. Based on the content of the message it 
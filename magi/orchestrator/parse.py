@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import base64
 import cStringIO
 from collections import defaultdict
+import copy
 import logging
 import optparse
 import sys
@@ -9,8 +11,15 @@ import time
 
 from magi.messaging.api import MAGIMessage
 from magi.util import helpers
+from magi.util.blobs import blobDigest
+from magi.util.calls import dumpMessageData
 import yaml
 
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
 from controlflow import ControlGraph  
 
 
@@ -76,6 +85,10 @@ class Trigger(object):
     def getTimeout(self):
         return 0
 
+    def getDeadline(self):
+        """ Time at which the trigger may complete without another event arriving, None if never """
+        return None
+
     def __repr__(self):
         return "{ \n\tTrigger type: %s \n\tTrigger data: %s \n}" % (
                 self.__class__.__name__, self.__dict__)
@@ -105,6 +118,11 @@ class TimeoutTrigger(Trigger):
             return (self.timeActivated + self.timeout)
         return sys.maxint
     
+    def getDeadline(self):
+        if self.isActive():
+            return (self.timeActivated + self.timeout)
+        return None
+    
     def __eq__(self, other): 
         return (self.timeout == other.timeout) and \
                 (self.target == other.target)
@@ -130,6 +148,9 @@ class EventTrigger(Trigger):
             self.args = {'retVal' : True}
         
     def isComplete(self, triggerCache):
+        if isinstance(triggerCache, TriggerIndex):
+            return triggerCache.isComplete(self)
+        
         if not triggerCache:
             return False
         
@@ -161,6 +182,13 @@ class EventTrigger(Trigger):
     def isEqual(self, trigger):
         return self.event == trigger.event and self.args == trigger.args
     
+    def matches(self, cachedTrigger):
+        """ True if the received trigger has all the args this trigger waits for """
+        for key, value in self.args.iteritems():
+            if cachedTrigger.args.get(key) != value:
+                return False
+        return True
+    
     def merge(self, trigger):
         self.nodes.update(trigger.nodes)
         self.count = max(len(self.nodes), 1)
@@ -198,6 +226,12 @@ class ConjunctionTrigger(Trigger):
     def getTimeout(self):
         return max([trigger.getTimeout() for trigger in self.triggers])
 
+    def getDeadline(self):
+        deadlines = [d for d in [trigger.getDeadline() for trigger in self.triggers] if d is not None]
+        if deadlines:
+            return max(deadlines)
+        return None
+
     def toString(self):
         trgrRepr = " & ".join([trigger.toString() for trigger in self.triggers])
         return "(%s)" %(trgrRepr)
@@ -224,6 +258,9 @@ class DisjunctionTrigger(Trigger):
     def getTimeout(self):
         return min([trigger.getTimeout() for trigger in self.triggers])
 
+    def getDeadline(self):
+        return self.triggers.getDeadline()
+
     def toString(self):
         trgrRepr = " or ".join([trigger.toString() for trigger in self.triggers])
         return "(%s)" %(trgrRepr)
@@ -265,6 +302,160 @@ def getEventTriggers(triggers):
             eventTriggers.update(getEventTriggers(trigger.triggers))
     return eventTriggers
 
+def iterTriggers(triggers):
+    """ The timeout and event triggers in a trigger, or list of triggers, including nested ones """
+    if isinstance(triggers, Trigger):
+        triggers = [triggers]
+    for trigger in triggers:
+        if isinstance(trigger, (ConjunctionTrigger, DisjunctionTrigger)):
+            for subtrigger in iterTriggers(trigger.triggers):
+                yield subtrigger
+        else:
+            yield trigger
+
+def argsSignature(args):
+    try:
+        return frozenset(args.iteritems())
+    except TypeError:
+        # unhashable values, yaml sorts the keys
+        return yaml.dump(args)
+
+class TriggerIndex(object):
+    """
+        Received event triggers, indexed by event and args. Triggers with the
+        same event and args are merged into one entry holding the nodes they
+        came from. Waiting EventTriggers are registered as watchers on their 
+        event the first time they are checked, and collect the matching nodes
+        as triggers arrive, so checking one costs the same however many nodes 
+        have reported.
+        Invalidation doesn't search the entries. Each node's trigger is stamped
+        with the event's epoch and the node's epoch within the event when it 
+        arrives, invalidating bumps one of those, and only triggers with the 
+        current stamp count. Stale nodes are dropped when a watcher could be 
+        complete or the entries are read.
+        Indexing by event gives the cached entries, as the plain dict of 
+        trigger lists did.
+    """
+    def __init__(self):
+        self.entries = dict() # event -> args signature -> (EventTrigger, node -> stamp)
+        self.watchers = dict() # event -> id(waiting trigger) -> (waiting trigger, node -> stamp)
+        self.epochs = dict() # event -> [event epoch, node -> node epoch]
+        self.changed = set() # events that received triggers since takeChanged
+        
+    def stamp(self, event, node):
+        epoch = self.epochs.get(event)
+        if epoch is None:
+            return (0, 0)
+        return (epoch[0], epoch[1].get(node, 0))
+    
+    def prune(self, event, stamps):
+        """ Drop the nodes whose triggers were invalidated """
+        epoch = self.epochs.get(event)
+        if epoch is None:
+            return
+        eventEpoch, nodeEpochs = epoch
+        for node, stamp in stamps.items():
+            if stamp != (eventEpoch, nodeEpochs.get(node, 0)):
+                del stamps[node]
+        
+    def add(self, incoming):
+        """ Merge a received trigger into the index, returns its entry """
+        event = incoming.event
+        entries = self.entries.setdefault(event, dict())
+        signature = argsSignature(incoming.args)
+        if signature not in entries:
+            entry = copy.copy(incoming)
+            entry.nodes = set()
+            entries[signature] = (entry, dict())
+        entry, stamps = entries[signature]
+        
+        nodeStamps = [(node, self.stamp(event, node)) for node in incoming.nodes]
+        stamps.update(nodeStamps)
+        
+        for trigger, matched in self.watchers.get(event, {}).itervalues():
+            if trigger.matches(incoming):
+                for node, stamp in nodeStamps:
+                    if not trigger.nodes or node in trigger.nodes:
+                        matched[node] = stamp
+        
+        self.changed.add(event)
+        return entry
+    
+    def invalidate(self, event, nodes=None):
+        """ Forget the triggers received for event from the given nodes, or from all nodes """
+        nodes = helpers.toSet(nodes)
+        epoch = self.epochs.setdefault(event, [0, dict()])
+        if not nodes:
+            epoch[0] += 1
+            epoch[1] = dict()
+            self.entries.pop(event, None)
+            return
+        nodeEpochs = epoch[1]
+        for node in nodes:
+            nodeEpochs[node] = nodeEpochs.get(node, 0) + 1
+            
+    def watch(self, trigger):
+        """ Start collecting the nodes that match a waiting trigger """
+        matched = dict()
+        for entry, stamps in self.entries.get(trigger.event, {}).itervalues():
+            if trigger.matches(entry):
+                for node, stamp in stamps.iteritems():
+                    if (not trigger.nodes or node in trigger.nodes) and stamp == self.stamp(trigger.event, node):
+                        matched[node] = stamp
+        self.watchers.setdefault(trigger.event, dict())[id(trigger)] = (trigger, matched)
+        return matched
+    
+    def unwatch(self, triggers):
+        """ Stop tracking the event triggers in the given trigger or triggers """
+        for trigger in iterTriggers(triggers):
+            if not isinstance(trigger, EventTrigger):
+                continue
+            watchers = self.watchers.get(trigger.event)
+            if watchers:
+                watchers.pop(id(trigger), None)
+    
+    def getMatched(self, trigger):
+        watcher = self.watchers.get(trigger.event, {}).get(id(trigger))
+        if watcher is None:
+            return self.watch(trigger)
+        return watcher[1]
+    
+    def matchedNodes(self, trigger):
+        """ Nodes with current triggers matching a waiting trigger """
+        matched = self.getMatched(trigger)
+        self.prune(trigger.event, matched)
+        return set(matched)
+    
+    def isComplete(self, trigger):
+        """ True if enough nodes have current triggers matching a waiting trigger """
+        matched = self.getMatched(trigger)
+        if len(matched) < trigger.count:
+            return False # stale nodes only make it smaller
+        self.prune(trigger.event, matched)
+        return len(matched) >= trigger.count
+    
+    def takeChanged(self):
+        """ Events that received triggers since the last call """
+        changed = self.changed
+        self.changed = set()
+        return changed
+    
+    def __contains__(self, event):
+        return event in self.entries
+    
+    def __getitem__(self, event):
+        """ The entries for event, with their nodes set to those with current triggers """
+        result = []
+        for entry, stamps in self.entries.get(event, {}).itervalues():
+            self.prune(event, stamps)
+            entry.nodes = set(stamps)
+            if entry.nodes:
+                result.append(entry)
+        return result
+    
+    def __len__(self):
+        return len(self.entries)
+    
 class TriggerList(list):
     """
         The grouping of triggers that we find in an AAL entry
@@ -272,6 +463,14 @@ class TriggerList(list):
     def __init__(self, triggerlist=[]):
         for entry in triggerlist:
             self.append(createTrigger(dict(entry))) #cloning entry to not change the original
+        self.waitingEvents = None
+    
+    def getWaitingEvents(self):
+        """ Events the triggers in the list wait for """
+        if self.waitingEvents is None:
+            self.waitingEvents = set([trigger.event for trigger in iterTriggers(self) 
+                                      if isinstance(trigger, EventTrigger)])
+        return self.waitingEvents
         
     def activate(self, activationTime=None):
         if not activationTime:
@@ -282,6 +481,13 @@ class TriggerList(list):
     def getTimeout(self):
         return min([trigger.getTimeout() for trigger in self])
     
+    def getDeadline(self):
+        """ Earliest time one of the triggers may complete on time alone, None if all wait on events """
+        deadlines = [d for d in [trigger.getDeadline() for trigger in self] if d is not None]
+        if deadlines:
+            return min(deadlines)
+        return None
+    
     def __repr__(self):
         return 'TriggerList: %s \n' %(list(self))
 
@@ -295,10 +501,17 @@ class EventObject(object):
         return self.__dict__ == other.__dict__
     
 class BaseMethodCall(EventObject):
-    """ Base class for any thing that sends an encoded MethodCall """
+    """ 
+        Base class for any thing that sends an encoded MethodCall.
+        The call is encoded the first time it is sent, or when the AAL is 
+        parsed, and the payload is reused for every send after that. Call 
+        encode() again after changing the call.
+    """
+    
+    contenttype = MAGIMessage.YAML
 
     def __init__(self, groups=None, nodes=None, docks=None,
-                 method=None, args=None, trigger=None):
+                 method=None, args=None, trigger=None, contenttype=None):
         """
             Create a new method call object.
             groups - list of groups to send to
@@ -308,6 +521,7 @@ class BaseMethodCall(EventObject):
             args - dictionary of keyword arguments
             trigger - (optional) the string to send back as a trigger once the
                 call is complete
+            contenttype - (optional) MAGIMessage.YAML, JSON or PICKLE
         """
         self.groups = groups
         self.nodes = nodes
@@ -319,17 +533,42 @@ class BaseMethodCall(EventObject):
         self.trigger = trigger
         
         self.agent = 'daemon'
+        
+        if contenttype is not None:
+            self.contenttype = contenttype
+        self.payload = None # (contenttype, data) once encoded
 
-    def getMessages(self):
+    def getCall(self):
         call = {'version': 1.0, 'method': self.method, 'args': self.args}
         if self.trigger:
             call['trigger'] = self.trigger
+        return call
+    
+    def encode(self, contenttype=None):
+        """ Serialize the call, optionally with a new content type """
+        if contenttype is not None:
+            self.contenttype = contenttype
+        self.payload = dumpMessageData(self.getCall(), self.contenttype)
+        return self.payload
+        
+    def getMessages(self):
+        if self.payload is None:
+            self.encode()
+        contenttype, data = self.payload
         return [MAGIMessage(groups=self.groups, nodes=self.nodes,
-                            docks=self.docks, contenttype=MAGIMessage.YAML,
-                            data=yaml.dump(call, width=10000))]
-        #width set to 10000 for not breaking arg dict into multiple lines
-        #because the custom yaml parsing code in c agent library requires that
-        #pyyaml by default breaks down content of more than a certain length 
+                            docks=self.docks, contenttype=contenttype,
+                            data=data)]
+
+    def __eq__(self, other):
+        """ The same call, whether or not either has been encoded """
+        if not isinstance(other, BaseMethodCall):
+            return False
+        mine = dict(self.__dict__)
+        theirs = dict(other.__dict__)
+        for key in ('payload', 'contenttype'):
+            mine.pop(key, None)
+            theirs.pop(key, None)
+        return mine == theirs
 
     def __repr__(self):
         return 'Event: %s(%s) \n\t trigger: %s\n' %(self.method, 
@@ -367,7 +606,7 @@ class LoadUnloadAgentCall(BaseMethodCall):
         """
             Create the load/unload agent call, expected kwargs 'code'
             and 'execargs'
-            Optional kwargs are 'tardata' or 'path'
+            Optional kwargs for loads are 'digest', 'tardata' or 'path'
         """
         args = {
             "name": name,
@@ -376,8 +615,12 @@ class LoadUnloadAgentCall(BaseMethodCall):
             "execargs": kwargs['execargs']
         }
 
-        # optional values, but only 1
-        if "tardata" in kwargs:
+        # optional values, but only 1, unloads don't need the code
+        if not load:
+            pass
+        elif "digest" in kwargs:
+            args["digest"] = kwargs["digest"]
+        elif "tardata" in kwargs:
             args["tardata"] = kwargs["tardata"]
         elif "path" in kwargs:
             args["path"] = kwargs["path"]
@@ -449,7 +692,8 @@ class AAL(object):
         ordered set of events and triggers
     """
 
-    def __init__(self, files=None, data=None, groupBuildTimeout=20000, dagdisplay=False, triggerCheck=False):
+    def __init__(self, files=None, data=None, groupBuildTimeout=20000, dagdisplay=False, triggerCheck=False,
+                 contenttype=MAGIMessage.YAML, inlineCode=False):
         """
             Create a new AAL object using either files or a
             string object (data).
@@ -457,6 +701,12 @@ class AAL(object):
             the list of events and triggers that form each event stream
             ADditionally, it also creates the control graph that can be 
             visualized later.
+            The method calls are encoded once here, as contenttype. 
+            MAGIMessage.YAML, the default, is the only type agents not 
+            written in python can read.
+            Agent tardata is sent as a digest, the daemons fetch the code 
+            from blobs unless they have it. inlineCode sends the tardata in 
+            the loadAgent call, for daemons that don't know digests.
         """
 
         # TODO: currently the startup stream is always setup for an AAL 
@@ -464,6 +714,9 @@ class AAL(object):
         self.startup = True 
         self.agentLoadTimeout = 200000
         
+        # agent code by digest, served to the daemons that ask for it
+        self.blobs = dict()
+        
         try:
             yaml_file = cStringIO.StringIO()
             read_data = False
@@ -481,7 +734,7 @@ class AAL(object):
                 log.critical('Yaml Parse Error: reading event AAL files.')
                 sys.exit(1)
     
-            self.rawAAL = yaml.load(yaml_file.getvalue())
+            self.rawAAL = yaml.load(yaml_file.getvalue(), Loader=Loader)
             
             #Pointer to streams
             self.setupStreams = []
@@ -569,6 +822,13 @@ class AAL(object):
                             agent['code'] = name + '_code' 
         
                         # Add event call to load agent
+                        if 'tardata' in agent and not inlineCode:
+                            tardata = base64.b64decode(agent['tardata'])
+                            digest = blobDigest(tardata)
+                            self.blobs[digest] = tardata
+                            agent = dict(agent)
+                            del agent['tardata']
+                            agent['digest'] = digest
                         loadAgentStream.append(LoadAgentCall(name, **agent))
                         
                     else:
@@ -680,6 +940,13 @@ class AAL(object):
                 log.error('Incoming event triggers are not a subset of outgoing event triggers')
                 raise AALParseError('Incoming event triggers are not a subset of outgoing event triggers')
             
+            # encode each call once rather than every time it is sent
+            self.contenttype = contenttype
+            for stream in self.setupStreams + self.teardownStreams + self.userEventStreams:
+                for event in stream:
+                    if isinstance(event, BaseMethodCall):
+                        event.encode(contenttype)
+            
             self.cgraph = ControlGraph() 
             for eventStream in self.userEventStreams:
                 streamName = eventStream.name
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import sys
+import time
+from magi.util.scheduler import Scheduler
+
+
+class SchedulerTest(unittest2.TestCase):
+	"""
+		Testing of the event scheduler, with and without the timing wheel
+	"""
+
+	def setUp(self):
+		self.fired = list()
+
+	def record(self, name):
+		self.fired.append(name)
+
+	def runOrder(self, sched):
+		now = time.time()
+		sched.sched_time(now + 0.05, self.record, 'b')
+		sched.sched_time(now + 0.01, self.record, 'a')
+		c = sched.sched_time(now + 0.03, self.record, 'c')
+		sched.unsched(c)
+		sched.unsched(c)  # second time is a no-op
+
+		self.assertAlmostEquals(sched._run(now), 0.01)
+		self.assertEquals(self.fired, [])
+		sched._run(now + 0.2)
+		self.assertEquals(self.fired, ['a', 'b'])
+		self.assertEquals(sched._run(now + 0.2), sys.maxint)
+
+	def test_heapOrder(self):
+		""" Test events fire in order, unscheduled events don't fire """
+		self.runOrder(Scheduler())
+
+	def test_wheelOrder(self):
+		""" Test events fire in order through the timing wheel """
+		sched = Scheduler(resolution=0.01)
+		now = time.time()
+		sched.sched_time(now + 0.05, self.record, 'b')
+		sched.sched_time(now + 0.02, self.record, 'a')
+		c = sched.sched_time(now + 0.03, self.record, 'c')
+		sched.unsched(c)
+		self.assertEquals(len(sched.heap), 0)
+		self.assertEquals(sched.wheel.count, 2)
+
+		# never early, at most one resolution late
+		wait = sched._run(now)
+		self.assert_(0 < wait <= 0.03, wait)
+		sched._run(now + 0.019)
+		self.assertEquals(self.fired, [])
+		sched._run(now + 0.031)
+		self.assertEquals(self.fired, ['a'])
+		sched._run(now + 0.2)
+		self.assertEquals(self.fired, ['a', 'b'])
+		self.assertEquals(sched._run(now + 0.2), sys.maxint)
+
+	def test_wheelCascade(self):
+		""" Test events on the higher levels of the wheel cascade down and fire on time """
+		sched = Scheduler(resolution=0.01, slots=8, levels=3)
+		now = time.time()
+		delays = [0.05, 0.5, 0.75, 2.0, 6.0]  # level 0, 1, 1, 2, beyond the horizon
+		for delay in delays:
+			sched.sched_time(now + delay, self.record, delay)
+		self.assertEquals(len(sched.heap), 1)
+
+		step = now
+		while step < now + 6.5:
+			step += 0.005
+			sched._run(step)
+			for delay in self.fired:
+				self.assert_(now + delay <= step < now + delay + 0.02, "%s fired at %s" % (delay, step - now))
+			del self.fired[:]
+		self.assertEquals(sched.wheel.count, 0)
+
+	def test_getByMethod(self):
+		""" Test method index and rescheduling """
+		for sched in (Scheduler(), Scheduler(resolution=0.01)):
+			now = time.time()
+			self.assertEquals(sched.getByMethod(self.record), None)
+			late = sched.sched_time(now + 2, self.record, 'late')
+			early = sched.sched_time(now + 1, self.record, 'early')
+			self.assertIs(sched.getByMethod(self.record), early)
+			sched.unsched(early)
+			self.assertIs(sched.getByMethod(self.record), late)
+			sched._run(now + 3)
+			self.assertEquals(sched.getByMethod(self.record), None)
+
+	def test_compact(self):
+		""" Test cancelled events are dropped from the heap """
+		sched = Scheduler()
+		now = time.time()
+		events = [sched.sched_time(now + ii, self.record, ii) for ii in range(1000)]
+		for event in events[:900]:
+			sched.unsched(event)
+		self.assertLess(len(sched.heap), 500)
+		sched._run(now + 2000)
+		self.assertEquals(self.fired, range(900, 1000))
+
+	def test_unschedInBatch(self):
+		""" Test unscheduling an event that fires later in the same wheel batch doesn't count it as in the heap """
+		sched = Scheduler(resolution=0.01)
+		now = time.time()
+		later = sched.sched_time(now + 0.025, self.record, 'later')
+		sched.sched_time(now + 0.021, lambda: sched.unsched(later))
+		sched._run(now + 0.05)
+		self.assertEquals(self.fired, [])
+		self.assertEquals(sched.cancelled, 0)
+
+	def test_periodic(self):
+		""" Test periodic events are rescheduled """
+		for sched in (Scheduler(), Scheduler(resolution=0.01)):
+			del self.fired[:]
+			sched.periodic(0.02, self.record, 'p')
+			start = time.time()
+			while time.time() - start < 0.11:
+				time.sleep(0.005)
+				sched.run()
+			self.assertGreaterEqual(len(self.fired), 3)
+			self.assertIsNot(sched.getByMethod(self.record), None)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -3,6 +3,7 @@
 import unittest2
 import logging
 from magi.messaging.magimessage import MAGIMessage, DefaultCodec
+from magi.messaging import magimessage
 
 class MAGIMessageTest(unittest2.TestCase):
 	"""
@@ -33,10 +34,56 @@ class MAGIMessageTest(unittest2.TestCase):
 		
 		self.assertEquals(hdrsize, len(hdr))
 
-		for k, v in msg.__dict__.iteritems():
-			if k[0] == '_':
-				continue
-			self.assertEquals(getattr(ret, k), v)
+		for k in MAGIMessage.WIREFIELDS:
+			self.assertEquals(getattr(ret, k), getattr(msg, k))
+
+	def test_pythonCodec(self):
+		""" Test that the python codec produces the same header as the C codec and decodes from buffers """
+		msg = MAGIMessage(nodes=['n1', 'n2'], groups='g1', docks='d1', src='mynode', data='xyz', sequence=5)
+		msg.msgid = 3000000000
+		saved = magimessage._codec
+		try:
+			hdr = DefaultCodec.encode(msg)
+			magimessage._codec = None
+			self.assertEquals(DefaultCodec.encode(msg), hdr)
+			ret, hdrsize = DefaultCodec.decode(buffer(hdr))
+		finally:
+			magimessage._codec = saved
+
+		self.assertEquals(hdrsize, len(hdr))
+		for k in ('msgid', 'src', 'sequence', 'dstnodes', 'dstgroups', 'dstdocks'):
+			self.assertEquals(getattr(ret, k), getattr(msg, k))
+
+	def test_destinationCache(self):
+		""" Test that destination blocks are reused but follow changes in the destinations """
+		msg = MAGIMessage(nodes=['n1'], groups='g1', docks='d1')
+		block = DefaultCodec.encodeDestinations(msg)
+		self.assert_(DefaultCodec.encodeDestinations(MAGIMessage(nodes='n1', groups=['g1'], docks='d1')) is block)
+		msg.dstgroups.add('g2')
+		ret, hdrsize = DefaultCodec.decode(DefaultCodec.encode(msg))
+		self.assertEquals(ret.dstgroups, set(['g1', 'g2']))
+
+
+	def test_lazyAndClone(self):
+		""" Test that unused containers are not allocated and clones are independent """
+		msg = MAGIMessage(nodes='n1', data='abc')
+		self.assertEquals(msg._dstgroups, None)
+		self.assertEquals(msg._appendedtoset, None)
+		self.assertEquals(msg.dstgroups, set())
+		self.assertFalse(hasattr(msg, '__dict__'))
+
+		msg._routed = set([3, 4])
+		copy = msg.clone()
+		copy.dstnodes.add('n2')
+		copy._appendedto.add(3)
+		self.assertEquals(msg.dstnodes, set(['n1']))
+		self.assertEquals(msg._appendedtoset, None)
+		self.assert_(copy.data is msg.data)
+		self.assertEquals(copy._routed, msg._routed)
+		for k in MAGIMessage.WIREFIELDS:
+			if k != 'dstnodes':
+				self.assertEquals(getattr(copy, k), getattr(msg, k))
+
 
 
 if __name__ == '__main__':
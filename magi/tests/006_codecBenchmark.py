@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import time
+from magi.messaging.magimessage import MAGIMessage, DefaultCodec
+from magi.messaging import magimessage
+
+log = logging.getLogger(__name__)
+
+class CodecBenchmark(unittest2.TestCase):
+	"""
+		Reports messages/sec for header encode and decode, with the C codec if built and the python version
+	"""
+
+	COUNT = 20000
+
+	def newMsg(self):
+		msg = MAGIMessage(nodes=['node-1', 'node-2'], groups=['control'], docks=['daemon'], contenttype=MAGIMessage.YAML)
+		msg.msgid = 1234
+		msg.src = "mynode"
+		msg.srcdock = "sourcedock"
+		msg.sequence = 98765
+		msg.timestamp = 12347890
+		msg.data = "x" * 100
+		return msg
+
+	def runCodec(self, name):
+		msg = self.newMsg()
+		start = time.time()
+		for ii in xrange(self.COUNT):
+			msg.msgid = ii
+			hdr = DefaultCodec.encode(msg)
+		encoderate = self.COUNT / (time.time() - start)
+
+		start = time.time()
+		for ii in xrange(self.COUNT):
+			DefaultCodec.decode(hdr)
+		decoderate = self.COUNT / (time.time() - start)
+
+		log.info("%-7s encode: %9.0f msgs/sec  decode: %9.0f msgs/sec", name, encoderate, decoderate)
+
+	def test_python(self):
+		""" Benchmark the pure python codec """
+		saved = magimessage._codec
+		magimessage._codec = None
+		try:
+			self.runCodec("python")
+		finally:
+			magimessage._codec = saved
+
+	def test_C(self):
+		""" Benchmark the C codec """
+		if magimessage._codec is None:
+			raise unittest2.SkipTest("magi.messaging._codec is not built")
+		self.runCodec("C")
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import sys
+import time
+from magi.messaging.magimessage import MAGIMessage, DefaultCodec
+
+log = logging.getLogger(__name__)
+
+def messageSize(msg):
+	""" Bytes held by the message object and the containers it owns, not counting shared strings """
+	size = sys.getsizeof(msg)
+	if hasattr(msg, '__dict__'):
+		size += sys.getsizeof(msg.__dict__)
+	for name in ('_dstgroups', '_dstnodes', '_dstdocks', '_appendedtoset', '_userargsdict'):
+		val = getattr(msg, name, None)
+		if val is not None:
+			size += sys.getsizeof(val)
+	return size
+
+
+class MessageBenchmark(unittest2.TestCase):
+	"""
+		Reports memory per message and allocation rate for the message types seen in high volume
+	"""
+
+	COUNT = 20000
+
+	def trigger(self):
+		return MAGIMessage(groups="control", docks="daemon", contenttype=MAGIMessage.YAML, data="event: myevent\n")
+
+	def test_memory(self):
+		""" Memory used by a received trigger message and a clone of it """
+		hdr = DefaultCodec.encode(self.trigger())
+		received, hdrsize = DefaultCodec.decode(hdr)
+		log.info("received trigger: %d bytes, clone: %d bytes", messageSize(received), messageSize(received.clone()))
+		log.info("empty message: %d bytes", messageSize(MAGIMessage()))
+
+	def test_allocation(self):
+		""" Messages created per second through the constructor, decode and clone """
+		start = time.time()
+		for ii in xrange(self.COUNT):
+			self.trigger()
+		created = self.COUNT / (time.time() - start)
+
+		hdr = DefaultCodec.encode(self.trigger())
+		start = time.time()
+		for ii in xrange(self.COUNT):
+			DefaultCodec.decode(hdr)
+		decoded = self.COUNT / (time.time() - start)
+
+		msg = self.trigger()
+		start = time.time()
+		for ii in xrange(self.COUNT):
+			msg.clone()
+		cloned = self.COUNT / (time.time() - start)
+
+		log.info("created: %9.0f msgs/sec  decoded: %9.0f msgs/sec  cloned: %9.0f msgs/sec", created, decoded, cloned)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import random
+import time
+from magi.util.scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+class SchedulerBenchmark(unittest2.TestCase):
+	"""
+		Reports schedule/cancel rates with many pending short jittered timers, like multicast NACK requests
+	"""
+
+	COUNT = 20000
+
+	def noop(self):
+		pass
+
+	def runScheduler(self, name, sched):
+		now = time.time()
+		delays = [random.uniform(0.5, 3) for ii in xrange(self.COUNT)]
+
+		start = time.time()
+		events = [sched.sched_time(now + delay, self.noop) for delay in delays]
+		schedrate = self.COUNT / (time.time() - start)
+
+		start = time.time()
+		for event in events[::2]:
+			sched.unsched(event)
+		cancelrate = (self.COUNT / 2) / (time.time() - start)
+
+		start = time.time()
+		for ii in xrange(self.COUNT / 10):
+			sched.getByMethod(self.noop)
+		lookuprate = (self.COUNT / 10) / (time.time() - start)
+
+		start = time.time()
+		step = now
+		while step < now + 3.1:
+			step += 0.01
+			sched._run(step)
+		runrate = (self.COUNT / 2) / (time.time() - start)
+
+		log.info("%-6s sched: %9.0f/sec  cancel: %9.0f/sec  getByMethod: %9.0f/sec  fire: %9.0f/sec", name, schedrate, cancelrate, lookuprate, runrate)
+
+	def test_heap(self):
+		""" Benchmark the heap only scheduler """
+		self.runScheduler("heap", Scheduler())
+
+	def test_wheel(self):
+		""" Benchmark the scheduler with a timing wheel """
+		self.runScheduler("wheel", Scheduler(resolution=0.01))
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import os
+import collections
+import time
+from magi.tests.util import TestTransport
+from magi.messaging.api import GroupRequest
+from magi.messaging.routerGroup import GroupRouter
+
+log = logging.getLogger(__name__)
+
+class TreeNode(object):
+	""" A group router with point to point links to its parent and children, sends into a shared queue """
+	def __init__(self, name, queue):
+		self.name = name
+		self.queue = queue
+		self.links = dict()  # fd -> (peer TreeNode, peer fd)
+		self.transports = { 0:TestTransport(0) }
+		self.router = GroupRouter()
+		self.router.configure(name=name, transports=self.transports, msgintf=self)
+
+	def link(self, fd, peer, peerfd):
+		self.links[fd] = (peer, peerfd)
+		self.transports[fd] = TestTransport(fd)
+
+	def send(self, msg):
+		msg.src = self.name
+		for fd in msg._routed:
+			self.queue.append((self.links[fd], msg))
+
+
+class ControlBenchmark(unittest2.TestCase):
+	"""
+		Reports group router bring-up time for a synthetic tree of nodes, with YAML and compact control messages.
+		The full COUNT node tree takes minutes so it only runs when MAGI_BENCHMARK is set in the environment.
+	"""
+
+	COUNT = 1000
+	SMALLCOUNT = 100
+	FANOUT = 4
+	GROUPS = 2  # groups joined by each node
+
+	def setUp(self):
+		logging.getLogger('magi.messaging.routerGroup').setLevel(logging.WARNING)  # quiet the per transport info
+
+	def tearDown(self):
+		logging.getLogger('magi.messaging.routerGroup').setLevel(logging.NOTSET)
+
+	def bringUp(self, name, compact, count):
+		"""
+			Every node has joined its groups before its links come up.  Links come up from the leaves toward
+			the root so group lists are merged as subtrees join, rather than every join crossing every link.
+		"""
+		GroupRouter.COMPACT = compact
+		queue = collections.deque()
+		nodes = [TreeNode("node%d" % ii, queue) for ii in range(count)]
+		for node in nodes:
+			for jj in range(self.GROUPS):
+				node.router.groupRequest(GroupRequest('join', "%s.group%d" % (node.name, jj), 'bench'))
+
+		msgcount = 0
+		size = 0
+		start = time.time()
+		for ii in range(count-1, 0, -1):
+			child = nodes[ii]
+			parent = nodes[(ii - 1) / self.FANOUT]
+			fd = (ii - 1) % self.FANOUT + 2  # 1 is the link to its own parent
+			parent.link(fd, child, 1)
+			child.link(1, parent, fd)
+			child.router.transportAdded(child.transports[1])
+			parent.router.transportAdded(parent.transports[fd])
+			while queue:
+				((peer, peerfd), msg) = queue.popleft()
+				msg._receivedon = peer.transports[peerfd]
+				peer.router.processIN([msg], 0)
+				msgcount += 1
+				size += len(msg.data)
+		elapsed = time.time() - start
+
+		# every node should be able to route to every group
+		allgroups = set(["%s.group%d" % (node.name, jj) for node in nodes for jj in range(self.GROUPS)])
+		for node in nodes:
+			self.assertEquals(set(node.router.groupIndex.filenos.keys()), allgroups)
+		log.info("%-7s %d nodes: %6.2f sec, %d messages, %d bytes", name, count, elapsed, msgcount, size)
+		return dict([(node.name, dict([(group, set(filenos)) for group, filenos in node.router.groupIndex.filenos.iteritems()]))
+					 for node in nodes])
+
+	def compare(self, count):
+		try:
+			yamlroutes = self.bringUp("yaml", False, count)
+			compactroutes = self.bringUp("compact", True, count)
+		finally:
+			GroupRouter.COMPACT = True
+		self.assertEquals(compactroutes, yamlroutes)
+
+	def test_bringUp(self):
+		""" Benchmark small tree bring-up with each control format """
+		self.compare(self.SMALLCOUNT)
+
+	@unittest2.skipUnless(os.environ.get('MAGI_BENCHMARK'), "set MAGI_BENCHMARK to run the full size tree")
+	def test_bringUpFull(self):
+		""" Benchmark full size tree bring-up with each control format """
+		self.compare(self.COUNT)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -6,8 +6,9 @@ import yaml
 import time
 from collections import defaultdict
 from magi.tests.util import TestTransport, TestMessageIntf
+from magi.messaging import control
 from magi.messaging.magimessage import MAGIMessage
-from magi.messaging.routerGroup import GroupRouter, listChecksum
+from magi.messaging.routerGroup import GroupRouter, listChecksum, listDigest
 from magi.messaging.api import GroupRequest
 
 class GroupRouteTest(unittest2.TestCase):
@@ -32,7 +33,7 @@ class GroupRouteTest(unittest2.TestCase):
 	def _checkForGroupResend(self, dst, fds):
 		for msg in self.store.outgoing:
 			if GroupRouter.DOCK in msg.dstdocks:
-				rt = yaml.load(msg.data)
+				rt = control.decode(msg.data)
 				if 'resend' in rt:
 					if msg._routed == fds and dst in msg.dstnodes:
 						return
@@ -43,7 +44,7 @@ class GroupRouteTest(unittest2.TestCase):
 	def _checkForGroupMessage(self, rtype, groups, fds):
 		for msg in self.store.outgoing:
 			if GroupRouter.DOCK in msg.dstdocks:
-				rt = yaml.load(msg.data)
+				rt = control.decode(msg.data)
 				if rtype in rt and sorted(rt[rtype]) == sorted(groups):
 					self.assert_('count' in rt, "No count value in router message %s" % rt)
 					self.assert_('checksum' in rt, "No checksum value in router message %s" % rt)
@@ -97,6 +98,19 @@ class GroupRouteTest(unittest2.TestCase):
 			for x in self.neighbors[fd].itervalues():
 				union.update(x)
 			self.assertEqual(sorted(self.router.transportGroupLists[fd].txGroups.keys()), sorted(union))
+
+		# Verify that the incremental digests match the lists
+		for fd, tgl in self.router.transportGroupLists.iteritems():
+			self.assertEqual(tgl.rxDigest, listDigest(tgl.rxGroups))
+			for nentry in tgl.srccache.itervalues():
+				self.assertEqual(nentry.digest, listDigest(nentry.nodeGroups))
+
+		# Verify that the group index matches the txGroups of every transport
+		expected = defaultdict(set)
+		for fd, tgl in self.router.transportGroupLists.iteritems():
+			for group in tgl.txGroups:
+				expected[group].add(fd)
+		self.assertEqual(self.router.groupIndex.filenos, dict(expected))
 			
 
 	def test_groupOperations(self):
@@ -191,6 +205,102 @@ class GroupRouteTest(unittest2.TestCase):
 		self._checkForGroupMessage(SET, self.router.transportGroupLists[2].rxGroups.keys(), [2])
 
 
+	def test_digest(self):
+		""" Test digest verification and dropping the older checksum once all neighbors send digests """
+		def incoming(fd, src, request):
+			msg = MAGIMessage(src=src, contenttype=MAGIMessage.YAML, docks=[GroupRouter.DOCK], data=yaml.safe_dump(request))
+			msg._receivedon = self.transports[fd]
+			self.router.processIN([msg], time.time())
+
+		def sent(fd):
+			return [control.decode(m.data) for m in self.store.outgoing if m._routed == [fd]]
+
+		incoming(1, 'n1', { 'add': ['g1', 'g2'], 'count': 2, 'digest': listDigest(['g1', 'g2']) })
+		incoming(1, 'n1', { 'del': ['g1'], 'count': 1, 'digest': listDigest(['g2']) })
+		self.assertEqual(self.router.transportGroupLists[1].txGroups.keys(), ['g2'])
+		self.assertEqual(len(sent(1)), 0)
+		self.assertEqual(sent(2)[-1]['digest'], listDigest(['g2']))
+		self.assertEqual(sent(2)[-1]['checksum'], listChecksum(['g2']))  # nothing heard on 2 yet, could be an older daemon
+		self.store.outgoing = []
+
+		# all neighbors on 1 use digests, checksum is left out
+		incoming(2, 'n2', { 'add': ['g3'], 'count': 1, 'checksum': listChecksum(['g3']) })
+		self.assertEqual(sent(1)[-1]['add'], ['g3'])
+		self.assertEqual(sent(1)[-1]['digest'], listDigest(['g3']))
+		self.assert_('checksum' not in sent(1)[-1])
+		self.store.outgoing = []
+
+		# an older neighbor shows up on 1, checksum comes back
+		incoming(1, 'n3', { 'add': ['g4'], 'count': 1, 'checksum': listChecksum(['g4']) })
+		incoming(2, 'n2', { 'add': ['g5'], 'count': 2, 'checksum': listChecksum(['g3', 'g5']) })
+		self.assertEqual(sent(1)[-1]['checksum'], listChecksum(['g3', 'g5']))
+		self.store.outgoing = []
+
+		# bad digest is rejected and asks for a resend
+		logging.disable(40) # disable error output for an expected error
+		incoming(1, 'n1', { 'add': ['g6'], 'count': 2, 'digest': listDigest(['g1', 'g6']) })
+		logging.disable(0)
+		self._checkForGroupResend('n1', [1])
+		self.assertEqual(self.router.transportGroupLists[1].srccache['n1'].nodeGroups, set(['g2']))
+		self.assertEqual(self.router.transportGroupLists[1].srccache['n1'].digest, listDigest(['g2']))
+
+
+	def test_sharedChecksum(self):
+		""" Test the checksum is always sent on shared transports, where an older daemon may not have been heard yet """
+		def incoming(fd, src, request):
+			msg = MAGIMessage(src=src, contenttype=MAGIMessage.YAML, docks=[GroupRouter.DOCK], data=yaml.safe_dump(request))
+			msg._receivedon = self.transports[fd]
+			self.router.processIN([msg], time.time())
+
+		def sent(fd):
+			return [control.decode(m.data) for m in self.store.outgoing if m._routed == [fd]]
+
+		self.transports[3] = TestTransport(3)
+		self.transports[3].shared = lambda: True
+		self.router.transportAdded(self.transports[3])
+		incoming(1, 'n1', { 'add': ['g1'], 'count': 1, 'digest': listDigest(['g1']) })
+		incoming(3, 'n3', { 'add': ['g3'], 'count': 1, 'digest': listDigest(['g3']) })
+		self.assertEqual(sent(3)[-1]['checksum'], listChecksum(['g1']))
+		self.assert_('checksum' not in sent(1)[-1])
+
+
+	def test_compact(self):
+		""" Test switching to the compact control format once all neighbors on a transport understand it """
+		def incoming(fd, src, data):
+			msg = MAGIMessage(src=src, docks=[GroupRouter.DOCK], data=data)
+			msg._receivedon = self.transports[fd]
+			self.router.processIN([msg], time.time())
+
+		def sent(fd):
+			return [m for m in self.store.outgoing if m._routed == [fd]]
+
+		incoming(1, 'n1', yaml.safe_dump({ 'add': ['g1'], 'count': 1, 'digest': listDigest(['g1']), 'compact': 1 }))
+		self.assertEqual(sent(2)[-1].contenttype, MAGIMessage.YAML)
+		self.assertEqual(control.decode(sent(2)[-1].data)['compact'], control.VERSION)
+		self.store.outgoing = []
+
+		incoming(2, 'n2', control.encode({ 'add': ['g2', 'g3'], 'count': 2, 'digest': listDigest(['g2', 'g3']) }))
+		self.assertEqual(sorted(self.router.transportGroupLists[2].txGroups.keys()), ['g2', 'g3'])
+		msg = sent(1)[-1]
+		self.assertEqual(msg.contenttype, MAGIMessage.BLOB)
+		self.assert_(control.isCompact(msg.data))
+		self.assertEqual(sorted(control.decode(msg.data)['add']), ['g2', 'g3'])
+		self.store.outgoing = []
+
+		# resend replies follow the same rule
+		incoming(2, 'n2', control.encode({ 'resend': True }))
+		self.assert_(control.isCompact(sent(2)[-1].data))
+		self.assertEqual(control.decode(sent(2)[-1].data)['set'], ['g1'])
+		self.store.outgoing = []
+
+		# an older neighbor joins transport 1, back to YAML
+		incoming(1, 'n3', yaml.safe_dump({ 'add': ['g4'], 'count': 1, 'checksum': listChecksum(['g4']) }))
+		incoming(2, 'n2', control.encode({ 'del': ['g3'], 'count': 1, 'digest': listDigest(['g2']) }))
+		msg = sent(1)[-1]
+		self.assertEqual(msg.contenttype, MAGIMessage.YAML)
+		self.assertEqual(control.decode(msg.data)['del'], ['g3'])
+
+
 	def test_GroupAckAggregation(self):
 		""" Test aggregation of group acknowledgments """
 		self.transports[3] = TestTransport(3)
@@ -331,6 +441,30 @@ class GroupRouteTest(unittest2.TestCase):
 		fds = self.router.routeMessage(msg)
 		self.assertEqual(fds, set([0]))
 
+	def test_routeCache(self):
+		""" Test cached routes are dropped when group state changes """
+		msg = MAGIMessage(groups=["mygroup", "othergroup"])
+		msg._receivedon = self.transports[1]
+		self.assertEqual(self.router.routeMessage(msg), set())
+		self.assertEqual(len(self.router.groupIndex.cache), 1)
+
+		self.router.groupRequest(GroupRequest("join", "mygroup", "default"))
+		self.assertEqual(self.router.routeMessage(msg), set([0]))
+
+		addother = { 'add': ['othergroup'], 'count': 1, 'checksum': listChecksum(['othergroup']) }
+		rtmsg = MAGIMessage(src="n2", groups=[GroupRouter.ONEHOPNODES], contenttype=MAGIMessage.YAML, docks=[GroupRouter.DOCK], data=yaml.safe_dump(addother))
+		rtmsg._receivedon = self.transports[2]
+		self.router.processIN([rtmsg], time.time())
+		fds = self.router.routeMessage(msg)
+		self.assertEqual(fds, set([0, 2]))
+		fds.add(5)  # callers get their own copy
+		self.assertEqual(self.router.routeMessage(msg), set([0, 2]))
+
+		self.router.groupRequest(GroupRequest("leave", "mygroup", "default"))
+		self.assertEqual(self.router.routeMessage(msg), set([2]))
+		self.router.transportRemoved(2, self.transports[2])
+		self.assertEqual(self.router.routeMessage(msg), set())
+
 	def test_joinFlags(self):
 		""" Make sure flags assigned to group joins and leaves keep proper groups active """
 		# no prsent
@@ -5,16 +5,20 @@ import logging
 import yaml
 import time
 from magi.tests.util import TestTransport, TestMessageIntf
+from magi.messaging import control
 from magi.messaging.magimessage import MAGIMessage
-from magi.messaging.routerNode import NodeRouter
+from magi.messaging.routerGroup import GroupRouter, NeighborGroupList
+from magi.messaging.routerNode import NodeRouter, RouteCache
+from magi.util.scheduler import Scheduler
 
 class NodeRouteTest(unittest2.TestCase):
 
 	def setUp(self):
 		self.transports = { 0:TestTransport(0), 1:TestTransport(1), 2:TestTransport(2) }
 		self.store = TestMessageIntf()
+		self.scheduler = Scheduler()
 		self.router = NodeRouter()
-		self.router.configure(name="mynode", transports=self.transports, msgintf=self.store)
+		self.router.configure(name="mynode", scheduler=self.scheduler, transports=self.transports, msgintf=self.store)
 
 	def tearDown(self):
 		self.router = None
@@ -30,6 +34,7 @@ class NodeRouteTest(unittest2.TestCase):
 
 		# Attempt to route message, should have nowhere to go
 		fds = self.router.routeMessage(msg)
+		self.scheduler._doall()  # requests and responses go out on the next tick
 		self.assertEqual(fds, set([]))
 		self._checkForMessageOnlyIn('data', yaml.safe_dump({'request':'unknown'}), [1, 2])
 
@@ -49,6 +54,7 @@ class NodeRouteTest(unittest2.TestCase):
 
 		# Attempt to route message, should have nowhere to go
 		fds = self.router.routeMessage(msg)
+		self.scheduler._doall()
 		self.assertEqual(fds, set([]))
 		self._checkForMessageOnlyIn('data', yaml.safe_dump({'request':'unknown'}), [1, 2])
 
@@ -68,6 +74,7 @@ class NodeRouteTest(unittest2.TestCase):
 		fds = self.router.routeMessage(msg1)
 		self.assertEqual(fds, set([]))
 		fds = self.router.routeMessage(msg2)
+		self.scheduler._doall()
 		self.assertEqual(fds, set([]))
 		self._checkForMessageOnlyIn('data', yaml.safe_dump({'request':'unknown'}), [1, 2])
 		self._checkMessagesInEquals(1, 1)
@@ -91,10 +98,262 @@ class NodeRouteTest(unittest2.TestCase):
 		rtmsg = MAGIMessage(src="unknown", groups=["__ALL__"], docks=[NodeRouter.DOCK], data=yaml.safe_dump({'request':'mynode'}))
 		rtmsg._receivedon = self.transports[1]
 		self.router.processIN([rtmsg], time.time())
+		self.scheduler._doall()
 		self.assertEquals(1, len(self.store.outgoing))
 		self.assertEquals(set([NodeRouter.DOCK]), self.store.outgoing[0].dstdocks)
 		self.assert_('response' in yaml.load(self.store.outgoing[0].data))
 
+	def test_floodResponse(self):
+		""" Test flooded requests for us that arrive together get one YAML response and undecodable requests are dropped """
+		logging.disable(40) # disable error output for an expected error
+		badmsg = MAGIMessage(src="bad", groups=["__ALL__"], docks=[NodeRouter.DOCK], data=control.MAGIC + '\x09')
+		badmsg._receivedon = self.transports[1]
+		self.router.processIN([badmsg], time.time())
+		logging.disable(0)
+		for src, data in (('a', control.encode({'request':'mynode'})), ('b', yaml.safe_dump({'request':'mynode'}))):
+			rtmsg = MAGIMessage(src=src, groups=["__ALL__"], docks=[NodeRouter.DOCK], data=data)
+			rtmsg._receivedon = self.transports[1]
+			self.router.processIN([rtmsg], time.time())
+		self.scheduler._doall()
+		self.assertEquals(1, len(self.store.outgoing))
+		self.assertEquals(yaml.safe_load(self.store.outgoing[0].data), {'response': True})
+
+	def test_floodRequests(self):
+		""" Test transports without hop by hop neighbors get a flooded request per node """
+		msg = MAGIMessage(nodes=["n1", "n2", "n3"])
+		msg._receivedon = self.transports[0]
+		self.router.routeMessage(msg)
+		self.scheduler._doall()
+		self.assertEquals([yaml.safe_load(out.data) for out in self.store.outgoing],
+						  [{'request': 'n1'}, {'request': 'n2'}, {'request': 'n3'}])
+		self.assertEquals([out._routed for out in self.store.outgoing], [set([1, 2])] * 3)
+
+	def hopRouter(self):
+		""" Router that knows from the group router there is a neighbor on each transport, 'a' on 1 is hop by hop """
+		self.groups = GroupRouter()
+		self.groups.configure(name="mynode", transports=self.transports, msgintf=TestMessageIntf())
+		self.router = NodeRouter(groupRouter=self.groups)
+		self.router.configure(name="mynode", scheduler=self.scheduler, transports=self.transports, msgintf=self.store)
+		for fd, neighbor in ((1, 'a'), (2, 'old')):
+			self.groups.transportAdded(self.transports[fd])
+			self.groups.transportGroupLists[fd].srccache[neighbor] = NeighborGroupList()
+		self.neighborSync(1, 'a', [])
+
+	def neighborSync(self, fd, src, routes, compact=True):
+		request = {'routes': [src] + routes, 'hops': 1}
+		if compact:
+			data = control.encode(request)
+		else:
+			data = yaml.safe_dump(request)
+		sync = MAGIMessage(src=src, groups=["__NEIGH__"], docks=[NodeRouter.DOCK], data=data)
+		sync._receivedon = self.transports[fd]
+		self.router.processIN([sync], time.time())
+
+	def sent(self, fd):
+		return [control.decode(m.data) for m in self.store.outgoing if fd in m._routed]
+
+	def test_hopRequests(self):
+		""" Test a burst to many unknown nodes is one compact request to hop by hop neighbors and floods to the others """
+		self.hopRouter()
+		msg = MAGIMessage(nodes=["n%d" % ii for ii in range(50)])
+		msg._receivedon = self.transports[0]
+		self.router.routeMessage(msg)
+		msg2 = MAGIMessage(nodes=["n3", "n99"])
+		msg2._receivedon = self.transports[0]
+		self.router.routeMessage(msg2)
+		self.assertEquals(len(self.store.outgoing), 0)
+		self.scheduler._doall()
+		self.assertEquals(len(self.sent(1)), 1)
+		self.assert_(control.isCompact([m for m in self.store.outgoing if m._routed == [1]][0].data))
+		self.assertEquals(set(self.sent(1)[0]['requests']), set(["n%d" % ii for ii in range(50)] + ["n99"]))
+		self.assertEquals(len(self.sent(2)), 51)
+		self.assert_(all(['request' in request for request in self.sent(2)]))
+		self.store.outgoing = []
+
+		# answers come back as one list of routes
+		self.neighborSync(1, 'a', ["n%d" % ii for ii in range(10)])
+		self.assertEquals(self.router.routeMessage(MAGIMessage(nodes=["n0", "n9"])), set([1]))
+		self._checkForMessageOnlyIn('dstnodes', msg.dstnodes, [1])
+
+		# until the older neighbor on 2 is gone
+		del self.groups.transportGroupLists[2].srccache['old']
+		self.neighborSync(2, 'b', [], compact=False)
+		self.store.outgoing = []
+		self.router.routeMessage(MAGIMessage(nodes=["x"]))
+		self.scheduler._doall()
+		self.assertEquals([m._routed for m in self.store.outgoing], [[1], [2]])
+		self.assertEquals(self.sent(2), [{'requests': ['x'], 'hops': 1, 'compact': control.VERSION}])  # b wants YAML
+
+	def test_hopRelay(self):
+		""" Test requests from a neighbor are answered or passed on and the answers merged on the way back """
+		self.hopRouter()
+		self.neighborSync(2, 'b', ['known'])
+		del self.groups.transportGroupLists[2].srccache['old']
+		self.store.outgoing = []
+
+		request = MAGIMessage(src="a", groups=["__NEIGH__"], docks=[NodeRouter.DOCK],
+							  data=control.encode({'requests': ['mynode', 'known', 'x', 'y'], 'hops': 1}))
+		request._receivedon = self.transports[1]
+		self.router.processIN([request], time.time())
+		self.scheduler._doall()
+		self.assertEquals(sorted(self.sent(1)[0]['routes']), ['known', 'mynode'])
+		self.assertEquals(sorted(self.sent(2)[0]['requests']), ['x', 'y'])
+		self.assertEquals(len(self.store.outgoing), 2)
+		self.store.outgoing = []
+
+		# asked again before the answer, not asked again
+		self.router.processIN([request], time.time())
+		self.neighborSync(2, 'b', ['x'])
+		self.neighborSync(2, 'b', ['y'])
+		self.scheduler._doall()
+		self.assertEquals(len(self.sent(2)), 0)
+		self.assertEquals([sorted(routes['routes']) for routes in self.sent(1)], [['known', 'mynode', 'x', 'y']])
+		self.assertEquals(self.router.asked, {})
+
+	def test_hopChain(self):
+		""" Test discovery along a line of hop by hop daemons, a - b - c - d """
+		names = ['a', 'b', 'c', 'd']
+		nodes = dict()
+		for ii, name in enumerate(names):
+			transports = { 0:TestTransport(0) }
+			if ii > 0: transports[1] = TestTransport(1)  # toward a
+			if ii < len(names) - 1: transports[2] = TestTransport(2)  # toward d
+			groups = GroupRouter()
+			groups.configure(name=name, transports=transports, msgintf=TestMessageIntf())
+			router = NodeRouter(groupRouter=groups)
+			router.configure(name=name, scheduler=Scheduler(), transports=transports, msgintf=TestMessageIntf())
+			nodes[name] = router
+		links = dict()
+		for left, right in zip(names, names[1:]):
+			links[(left, 2)] = (right, 1)
+			links[(right, 1)] = (left, 2)
+			nodes[left].groupRouter.transportAdded(nodes[left].transports[2])
+			nodes[right].groupRouter.transportAdded(nodes[right].transports[1])
+			nodes[left].groupRouter.transportGroupLists[2].srccache[right] = NeighborGroupList()
+			nodes[right].groupRouter.transportGroupLists[1].srccache[left] = NeighborGroupList()
+
+		def pump():
+			count = 0
+			while True:
+				for router in nodes.itervalues():
+					router.scheduler._run(time.time() + 1)
+				moved = [(name, msg) for name, router in nodes.iteritems() for msg in router.msgintf.outgoing]
+				if not moved:
+					return count
+				for router in nodes.itervalues():
+					router.msgintf.outgoing = []
+				for name, msg in moved:
+					for fd in msg._routed:
+						msg._appendedto.add(fd)
+						peer, peerfd = links[(name, fd)]
+						msg.src = name
+						msg._receivedon = nodes[peer].transports[peerfd]
+						if NodeRouter.DOCK in msg.dstdocks:
+							nodes[peer].processIN([msg], time.time())
+						count += 1
+
+		for name, router in nodes.iteritems():
+			for fd in router.transports.keys():
+				router.transportAdded(router.transports[fd])
+		pump()
+		for router in nodes.itervalues():  # only the neighbors were learned
+			router.nodeRouteCache = RouteCache(10, 600)
+
+		msg = MAGIMessage(nodes=["d", "c"], docks=['somedock'])
+		msg._receivedon = nodes['a'].transports[0]
+		self.assertEquals(nodes['a'].routeMessage(msg), set())
+		# requests a-b, b-c, c-d, c answers at once, d's answer comes back c-b-a, then the paused message
+		self.assertEquals(pump(), 3 + 2 + 3 + 1)
+		self.assertEquals(nodes['a'].routeMessage(msg), set([2]))
+		self.assertEquals(nodes['b'].routeMessage(msg), set([2]))
+
+	def test_routeSync(self):
+		""" Test routes are offered on new transports and learned from neighbors """
+		rtmsg = MAGIMessage(src="n1", groups=["__ALL__"], docks=[NodeRouter.DOCK], data=yaml.safe_dump({'response':True}))
+		rtmsg._receivedon = self.transports[1]
+		self.router.processIN([rtmsg], time.time())
+		self.router.transportAdded(self.transports[2])
+		self.assertEquals(len(self.store.outgoing), 1)
+		self.assertEquals(self.store.outgoing[0]._routed, [2])
+		self.assertEquals(sorted(control.decode(self.store.outgoing[0].data)['routes']), ['mynode', 'n1'])
+		self.store.outgoing = []
+
+		msg = MAGIMessage(src="thesrc", nodes=["n3"])
+		msg._receivedon = self.transports[0]
+		self.router.routeMessage(msg)
+		sync = MAGIMessage(src="n2", groups=["__NEIGH__"], docks=[NodeRouter.DOCK], data=yaml.safe_dump({'routes': ['n2', 'n3', 'n1', 'mynode']}))
+		sync._receivedon = self.transports[2]
+		self.router.processIN([sync], time.time())
+		self._checkForMessageOnlyIn('src', "thesrc", [2])
+		self.assertEquals(self.router.routeMessage(MAGIMessage(nodes=["n1", "n2", "mynode"])), set([0, 1, 2]))
+
+		# on shared transports, the neighbors already there are asked to send theirs
+		self.store.outgoing = []
+		self.transports[3] = TestTransport(3)
+		self.transports[3].shared = lambda: True
+		self.router.transportAdded(self.transports[3])
+		self.assert_(control.decode(self.store.outgoing[0].data)['reply'])
+		sync = MAGIMessage(src="n4", groups=["__NEIGH__"], docks=[NodeRouter.DOCK], data=yaml.safe_dump({'routes': ['n4'], 'hops': 1, 'reply': True}))
+		sync._receivedon = self.transports[3]
+		self.store.outgoing = []
+		self.router.processIN([sync], time.time())
+		self.assertEquals(self.store.outgoing[0]._routed, [3])
+		self.assertEquals(control.decode(self.store.outgoing[0].data), {'routes': ['mynode'], 'hops': 1, 'compact': control.VERSION})
+
+	def test_routeCache(self):
+		""" Test routes in use survive eviction and old routes expire """
+		cache = RouteCache(4, 10)
+		for ii in range(4):
+			cache.put("n%d" % ii, ii, 100)
+		for ii in range(4):
+			self.assertEquals(cache.get("n%d" % ii, 101), ii)
+		cache.get("n0", 101)
+		cache.put("n4", 4, 101)  # clears all marks, then evicts n0 as first in the clock
+		self.assertEquals(cache.evicted, 1)
+		self.assertEquals(len(cache), 4)
+
+		cache.get("n2", 102)
+		cache.put("n5", 5, 102)  # n1 wasn't used since the hand passed
+		self.assertNotIn("n1", cache)
+		self.assertEquals(cache.get("n2", 103), 2)
+
+		cache.confirm("n2", 2, 109)
+		cache.confirm("n3", 7, 109)  # different way, not a confirmation
+		self.assertEquals(cache.get("n2", 115), 2)
+		self.assertEquals(cache.get("n3", 115), None)
+		self.assertEquals(cache.expired, 1)
+		cache.put("n6", 6, 115)  # reuses the expired slot
+		self.assertEquals(cache.evicted, 2)
+		self.assertEquals(len(cache.ring), 4)
+
+		cache.removeFileno(2)
+		self.assertNotIn("n2", cache)
+
+	def test_pausedLimit(self):
+		""" Test messages waiting for routes are bounded """
+		self.router.MAXPAUSED = 3
+		self.router.MAXPAUSEDTOTAL = 5
+		for ii in range(5):
+			msg = MAGIMessage(nodes=["unknown"], data=str(ii))
+			msg._receivedon = self.transports[1]
+			self.router.routeMessage(msg)
+		self.assertEquals(len(self.router.pausedMessages['unknown']), 3)
+		for ii in range(5):
+			msg = MAGIMessage(nodes=["other%d" % ii])
+			msg._receivedon = self.transports[1]
+			self.router.routeMessage(msg)
+		self.assertEquals(self.router.pausedCount, 5)
+		self.assertEquals(self.router.stats['pauseddropped'], 5)
+
+		rtmsg = MAGIMessage(src="unknown", groups=["__ALL__"], docks=[NodeRouter.DOCK], data=yaml.safe_dump({'response':True}))
+		rtmsg._receivedon = self.transports[2]
+		self.router.processIN([rtmsg], time.time())
+		self.assertEquals(self.router.pausedCount, 2)
+		self.assertNotIn('unknown', self.router.pausedMessages)
+
+		self.router.transportRemoved(2, self.transports[2])
+		self.assertNotIn('unknown', self.router.nodeRouteCache)
+
 
 	def _checkForMessageOnlyIn(self, attr, val, queues):
 		#for fd, transport in self.transports.iteritems():
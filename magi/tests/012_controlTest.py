@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import yaml
+from magi.messaging import control
+
+
+class ControlTest(unittest2.TestCase):
+	"""
+		Testing of the compact router control message format
+	"""
+
+	def test_roundTrip(self):
+		""" Test each field type survives encoding """
+		request = { 'set': ['b', 'a', u'c'], 'count': 3, 'checksum': 0xffffffff, 'digest': 0xfedcba9876543210, 'resend': True, 'request': 'node1' }
+		decoded = control.decode(control.encode(request))
+		self.assertEquals(decoded.pop('compact'), control.VERSION)
+		request['set'] = ['a', 'b', 'c']
+		self.assertEquals(decoded, request)
+		self.assertEquals(control.decode(control.encode({ 'add': [] })), { 'add': [], 'compact': control.VERSION })
+
+	def test_deltaList(self):
+		""" Test shared prefixes are only stored once """
+		names = ["experiment.group%04d" % ii for ii in range(500)]
+		encoded = control.encodeList(reversed(names))
+		self.assertLess(len(encoded), len(''.join(names)) / 4)
+		self.assertEquals(control.decodeList(encoded), (names, len(encoded)))
+
+	def test_yamlFallback(self):
+		""" Test YAML is still decoded and unrepresentable requests are sent as YAML """
+		self.assertEquals(control.decode(yaml.safe_dump({ 'add': ['g1'], 'count': 1 })), { 'add': ['g1'], 'count': 1 })
+		(contenttype, data) = control.dump({ 'add': ['g1'], 'other': 5 }, True)
+		self.assertEquals(yaml.safe_load(data), { 'add': ['g1'], 'other': 5 })
+		(contenttype, data) = control.dump({ 'add': ['g1'] }, False)
+		self.assertFalse(control.isCompact(data))
+		(contenttype, data) = control.dump({ 'add': ['g1'] }, True)
+		self.assert_(control.isCompact(data))
+
+	def test_versions(self):
+		""" Test unknown fields are skipped, newer versions and truncated messages are rejected """
+		data = control.encode({ 'count': 1 })
+		self.assertEquals(control.decode(data + '\x7f\x02ab'), { 'count': 1, 'compact': control.VERSION })
+		self.assertRaises(control.ControlError, control.decode, control.MAGIC + chr(control.VERSION+1) + data[2:])
+		self.assertRaises(control.ControlError, control.decode, data[:-1])
+		self.assertRaises(control.ControlError, control.decode, control.encode({ 'digest': 5 })[:-2])
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -5,11 +5,13 @@ import os
 import asyncore
 import logging
 import sys
+import time
 from magi.messaging.transport import Transport
 from magi.messaging.transportTCP import TCPTransport, TCPServer
 from magi.messaging.transportSSL import SSLTransport, SSLServer
-from magi.messaging.transportMulticast import MulticastTransport
+from magi.messaging.transportMulticast import MulticastTransport, TXMessageTracker, TokenBucket
 from magi.messaging.transportPipe import InputPipe, OutputPipe
+from magi.messaging.transportStream import TXTracker, RXTracker, StreamTransport
 from magi.messaging.magimessage import MAGIMessage
 from magi.util.scheduler import Scheduler
 
@@ -73,10 +75,8 @@ class TransportTest(unittest2.TestCase):
 		return msg
 
 	def assertMessageEqual(self, msg1, msg2):
-		for k, v in msg1.__dict__.iteritems():
-			if k[0] == '_':
-				continue
-			self.assertEquals(getattr(msg2, k), v)
+		for k in MAGIMessage.WIREFIELDS:
+			self.assertEquals(getattr(msg2, k), getattr(msg1, k))
 
 
 	def runAsync(self, socketmap, rx, msg, maxcount):
@@ -152,6 +152,106 @@ class TransportTest(unittest2.TestCase):
 		rx.close()
 			
 
+	def test_TXTracker(self):
+		""" Test that small messages are coalesced and large payloads are sent without copies """
+		small = [self.newMsg() for ii in range(5)]
+		tracker = TXTracker()
+		for msg in small:
+			tracker.add(msg)
+		total = tracker.queued
+		self.assertEquals(len(tracker.getData()), total)  # one send call for all of them
+		tracker.sent(total)
+		self.assert_(tracker.isDone())
+
+		big = self.newMsg()
+		big.data = "x" * (TXTracker.COALESCE * 4)
+		tracker.add(big)
+		header = tracker.getData()
+		self.assert_(str(header).startswith(StreamTransport.PREAMBLE))
+		tracker.sent(len(header))
+		tracker.getData()
+		tracker.sent(1000)  # partial send of the payload
+		view = tracker.getData()
+		self.assert_(tracker.chunk is big.data, "payload should not be copied")
+		self.assertEquals(len(view), len(big.data) - 1000)
+		tracker.sent(len(view))
+		self.assert_(tracker.isDone())
+		self.assertRaises(IndexError, tracker.getData)
+
+
+	def test_RXTracker(self):
+		""" Test receiving of back to back messages with junk in front and a body filled through getBuffer """
+		msgs = [self.newMsg() for ii in range(3)]
+		msgs[1].data = "y" * 100000
+		stream = list()
+		for msg in msgs:
+			tracker = TXTracker(msg=msg)
+			while not tracker.isDone():
+				data = tracker.getData()
+				stream.append(str(data))
+				tracker.sent(len(data))
+		stream = "junkMAGI" + ''.join(stream)
+
+		received = list()
+		rx = RXTracker()
+		pos = 0
+		while pos < len(stream):
+			view = rx.getBuffer()
+			if view is not None:  # like recv_into, fill part of what is wanted
+				count = min(len(view), 7000, len(stream) - pos)
+				view[:count] = stream[pos:pos+count]
+				rx.received(count)
+				pos += count
+			else:
+				rx.processData(stream[pos:pos+50])
+				pos += 50
+			while rx.isDone():
+				received.append(rx.getMessage())
+				rx = RXTracker(startbuf=rx.getLeftover())
+
+		self.assertEquals(len(received), len(msgs))
+		for msg, got in zip(msgs, received):
+			self.assertMessageEqual(got, msg)
+			self.assertEquals(type(got.data), str)
+
+
+	def test_TCPBatch(self):
+		""" Test a mix of small and large messages queued at once on a TCP transport """
+		server = TCPServer('127.0.0.1', 10103)
+		tx = TCPTransport(address='127.0.0.1', port=10103)
+
+		count = 0
+		while True:
+			asyncore.poll(0.1, {server.fileno():server, tx.fileno():tx})
+			if len(server.inmessages) > 0:
+				rx = server.inmessages[0]
+				break
+			count += 1
+			self.assertLess(count, 5, 'connect failed')
+
+		sizes = [10, 20000, 5, 3000000, 7, 30]
+		for ii, size in enumerate(sizes):
+			msg = self.newMsg()
+			msg.msgid = ii
+			msg.data = chr(ord('a') + ii) * size
+			tx.outmessages.append(msg)
+
+		mymap = { rx.fileno():rx, tx.fileno():tx }
+		count = 0
+		while len(rx.inmessages) < len(sizes):
+			asyncore.poll(0.1, mymap)
+			count += 1
+			self.assertLess(count, 1000, 'batch never arrived')
+
+		for ii, size in enumerate(sizes):
+			self.assertEquals(rx.inmessages[ii].msgid, ii)
+			self.assertEquals(rx.inmessages[ii].data, chr(ord('a') + ii) * size)
+
+		tx.close()
+		rx.close()
+		server.close()
+
+
 	def test_Multicast(self):
 		""" Test encoding and decoding of a message through two Multicast transports """
 		msg = self.newMsg()
@@ -195,6 +295,45 @@ class TransportTest(unittest2.TestCase):
 		rx.close()
 
 
+	def test_MulticastBatch(self):
+		""" Test multicast packets are sent in batches, sized by MTU and paced """
+		msg = self.newMsg()
+		msg.data = "x" * 200000
+		buf = list()
+		sched = Scheduler()
+		tx = TestMulticastTransport(buf)
+		rx = TestMulticastTransport(buf)
+		tx.setScheduler(sched)
+		rx.setScheduler(sched)
+		del tx.outmessages[:]  # skip the status message
+
+		# jumbo frames, 23 packets go out in one write
+		tx.splitsize = 9000 - 28 - 7
+		tx.outmessages.append(msg)
+		tx.handle_write()
+		self.assertEquals(len(buf), 23)
+		self.assert_(max([len(pkt) for pkt in buf]) <= 9000 - 28)
+		while len(buf) > 0:
+			rx.handle_read()
+		self.assertEquals(rx.inmessages[0].data, msg.data)
+
+		# pacing stops the batch once the burst is used up and waits for the refill
+		tx.splitsize = TXMessageTracker.SPLITSIZE
+		tx.pacer = TokenBucket(100000, 10000)
+		msg.data = "y" * 100000
+		tx.outmessages.append(msg)
+		tx.handle_write()
+		self.assertEquals(len(buf), 7)
+		self.assert_(not tx.writable())
+		wait = sched.run()
+		self.assert_(0 < wait <= 0.01, wait)
+		time.sleep(wait)
+		self.assert_(tx.writable())
+
+		tx.close()
+		rx.close()
+
+
 	def test_Pipe(self):
 		""" Test encode and decoding of a message from an output pipe to an input pipe """
 		if 'ygwin' in sys.platform and sys.version_info[1] < 5:
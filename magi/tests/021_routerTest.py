@@ -44,17 +44,20 @@ class RouterTest(unittest2.TestCase):
 			# group membership information messages are sent and then clear it
 			self.router.addTransport(self.transports[key])
 			self.router.loop()
-			self.assertEquals(2, len(self.transports[key].outmessages))
+			self.assertEquals(3, len(self.transports[key].outmessages))
 			self.assertEquals(set([GroupRouter.ONEHOPNODES]), self.transports[key].outmessages[0].dstgroups)
 			self.assertEquals(set([GroupRouter.DOCK]), self.transports[key].outmessages[0].dstdocks)
 			self.assertEquals(set([GroupRouter.ONEHOPNODES]), self.transports[key].outmessages[1].dstgroups)
 			self.assertEquals(set([GroupRouter.DOCK]), self.transports[key].outmessages[1].dstdocks)
+			self.assertEquals(set([NodeRouter.DOCK]), self.transports[key].outmessages[2].dstdocks)  # route sync
 			self.transports[key].outmessages = []
 
 
 	def push(self, msg):
 		self.router.queues['PRE'].append(msg)
 		self.router.loop()
+		self.router.scheduler._doall()  # route requests go out on the next tick
+		self.router.loop()
 
 	def commonAssert(self):
 		""" Check that nothing makes it into data structures that are an unused deadend """
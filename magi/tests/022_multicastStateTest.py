@@ -4,7 +4,7 @@ import unittest2
 import logging
 import time
 from magi.messaging.magimessage import MAGIMessage, DefaultCodec
-from magi.messaging.transportMulticast import MulticastTransport, MCTHeader, TXMessageTracker
+from magi.messaging.transportMulticast import MulticastTransport, MCTHeader, TXMessageTracker, MissingRanges
 from magi.util.scheduler import Scheduler
 
 
@@ -29,7 +29,7 @@ class TransportTest(unittest2.TestCase):
 		return count
 
 
-	def addBigMessage(self, mid, count, skip):
+	def addBigMessage(self, mid, count, skip, order=None):
 		msg = MAGIMessage()
 		msg.msgid = 12345
 		msg.contenttype = MAGIMessage.NONE
@@ -38,9 +38,10 @@ class TransportTest(unittest2.TestCase):
 		msg.dstgroups = ['g1']
 		msg.data = "X" * (((TXMessageTracker.SPLITSIZE-4) * count) - len(self.msgcodec.encode(msg)))
 		tracker = TXMessageTracker(msg=msg, multicastid=mid, codec=DefaultCodec())
-		for ii in range(1,count+1):
+		for ii in order or range(1,count+1):
 			if ii not in skip:
 				self.mct.processPacket('192.168.1.1', 18808, tracker.getPart(ii))
+		return msg
 
 	def addMsg(self, msgid):
 		self.msgid += 1
@@ -121,6 +122,61 @@ class TransportTest(unittest2.TestCase):
 		self.assertEqual(0, self.countMessages(MCTHeader.PKTREQ))  # no requests
 		self.runEncoding()
 
+	def test_RangeRequest(self):
+		""" Test range requests go to sources that announce them, piece lists to older sources """
+		self.mct.processPacket('192.168.1.1', 18808, MCTHeader.PktStat(1, 123, MCTHeader.STATRANGEREQ).encode())
+		self.addBigMessage(2, 100, set(range(3, 50) + [70, 71, 95]))
+		self.sched._doall()
+		reqs = [m for m in self.mct.outmessages if m.type == MCTHeader.PKTREQRANGE]
+		self.assertEqual(1, len(reqs))
+		decoded = MCTHeader.decode(reqs[0].encode())
+		self.assertEqual(decoded.src, '192.168.1.1')
+		self.assertEqual(decoded.multicastid, 2)
+		self.assertEqual(decoded.ranges, [(3, 49), (70, 71), (95, 95)])
+
+		# a source without the flag gets a plain request with each piece
+		self.mct.processPacket('192.168.1.2', 18808, MCTHeader.PktStat(1, 123).encode())
+		self.mct.processPacket('192.168.1.2', 18808, MCTHeader.PktStat(2, 123).encode())
+		self.mct.neighbors['192.168.1.2'].neigh_dataPacket(2, 1, 10, "x" * 100)
+		self.sched._doall()
+		reqs = [m for m in self.mct.outmessages if m.type == MCTHeader.PKTREQ and m.src == '192.168.1.2']
+		self.assertEqual(1, len(reqs))
+		self.assertEqual(reqs[0].pieces, tuple(range(2, 11)))
+
+		# someone else's range request squelches ours
+		self.addBigMessage(3, 10, [4, 5, 6])
+		self.mct.processPacket('192.168.1.3', 18808, MCTHeader.PktReqRange(3, '192.168.1.1', [(4, 6)]).encode())
+		self.sched._doall()
+		self.assertEqual(0, len([m for m in self.mct.outmessages if m.type == MCTHeader.PKTREQRANGE and m.multicastid == 3]))
+
+	def test_Reassembly(self):
+		""" Test pieces arriving in any order, including the last one first, rebuild the message """
+		sent = self.addBigMessage(2, 5, [], order=[5, 3, 1, 4, 2])
+		self.assertEqual(len(self.mct.inmessages), 1)
+		self.assertEqual(self.mct.inmessages[0].data, sent.data)
+		self.assertEqual(self.mct.inmessages[0].src, "mynode")
+
+	def test_MissingRanges(self):
+		""" Test the interval set of missing pieces """
+		missing = MissingRanges(1, 100)
+		self.assertEqual(len(missing), 100)
+		for part in (1, 50, 100, 50):
+			missing.discard(part)
+		self.assertEqual(list(missing), [(2, 49), (51, 99)])
+		self.assert_(50 not in missing and 51 in missing)
+
+		missing.requested(40, 60, 10)
+		self.assertEqual(missing.stale(5, 10), [(2, 39), (61, 99)])
+		self.assertEqual(missing.stale(20, 10), [(2, 49), (51, 99)])
+		self.assertEqual(missing.stale(20, 1), [(2, 49)])  # touching ranges count as one
+		missing.requested(1, 100, 10)
+		self.assertEqual(len(missing.starts), 2)  # same request time merges back down
+		self.assert_(not missing.hasStale(5))
+		for part in range(1, 101):
+			missing.discard(part)
+		self.assert_(not missing)
+
+
 
 if __name__ == '__main__':
 	hdlr = logging.StreamHandler()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import os
+import threading
+import time
+import Queue
+from magi.messaging.reactor import Reactor
+from magi.messaging.transportTCP import TCPTransport, TCPServer
+from magi.messaging.worker import WorkerThread
+from magi.messaging.magimessage import MAGIMessage
+from magi.messaging.api import TransmitRequest
+
+
+class ReactorTest(unittest2.TestCase):
+	"""
+		Testing of the persistent poller used by the worker thread
+	"""
+
+	def setUp(self):
+		self.reactor = Reactor()
+
+	def tearDown(self):
+		self.reactor.close()
+
+	def test_wakeup(self):
+		""" Test that a wakeup from another thread interrupts a long poll """
+		timer = threading.Timer(0.1, self.reactor.wakeup)
+		timer.start()
+		start = time.time()
+		self.reactor.poll(5.0, {})
+		self.assertLess(time.time() - start, 1.0)
+
+		# pending wakeups were drained, next poll should wait the full timeout
+		start = time.time()
+		self.reactor.poll(0.2, {})
+		self.assertGreaterEqual(time.time() - start, 0.15)
+
+	def test_wakeDuringDrain(self):
+		""" Test a wakeup from another thread while the poller is draining the pipe isn't lost """
+		self.reactor.wakeup()
+		realread = os.read
+		def read(fd, size):
+			if fd == self.reactor.waker.rfd and not woken:
+				waker = threading.Thread(target=self.reactor.wakeup)
+				waker.start()
+				waker.join()
+				woken.append(True)
+			return realread(fd, size)
+		woken = []
+		os.read = read
+		try:
+			self.reactor.poll(0, {})
+		finally:
+			os.read = realread
+		self.assertTrue(woken)
+
+		# the wake above may have been read with the first, a later one must still interrupt the poll
+		self.reactor.wakeup()
+		start = time.time()
+		self.reactor.poll(1.0, {})
+		self.assertLess(time.time() - start, 0.5)
+
+	def test_dispatch(self):
+		""" Test that a message goes through TCP transports using the reactor """
+		server = TCPServer('127.0.0.1', 10111)
+		tx = TCPTransport(address='127.0.0.1', port=10111)
+
+		count = 0
+		while len(server.inmessages) == 0:
+			self.reactor.poll(0.1, {server.fileno():server, tx.fileno():tx})
+			count += 1
+			self.assertLess(count, 5, 'connect failed')
+		rx = server.inmessages[0]
+
+		mymap = { rx.fileno():rx, tx.fileno():tx }
+		tx.outmessages.append(MAGIMessage(nodes="n1", data="helloworld"))
+		count = 0
+		while len(rx.inmessages) == 0:
+			self.reactor.poll(0.1, mymap)
+			count += 1
+			self.assertLess(count, 10, 'message never arrived')
+		self.assertEquals(rx.inmessages[0].data, "helloworld")
+
+		# removed entries are dropped from the kernel registration
+		self.reactor.poll(0, {})
+		self.assertEquals(self.reactor.registered, {})
+
+		tx.close()
+		rx.close()
+		server.close()
+
+	def test_workerLatency(self):
+		""" Test that a worker thread handles user requests without waiting for a poll timeout """
+		txqueue = Queue.Queue()
+		worker = WorkerThread("mynode", txqueue, Queue.Queue())
+		worker.start()
+		try:
+			time.sleep(0.1)  # let it settle into poll
+			msg = MAGIMessage(nodes="mynode", docks="somedock", data="helloworld")
+			start = time.time()
+			txqueue.put(TransmitRequest(msg, {}))
+			worker.wakeup()
+			while not txqueue.empty():
+				time.sleep(0.001)
+				self.assertLess(time.time() - start, 1.0, 'request not handled')
+		finally:
+			worker.stop()
+			worker.join(2.0)
+		self.assertFalse(worker.isAlive())
+		self.assertIsNone(worker.reactor.waker.wfd)  # descriptors released
+		worker.wakeup()  # ignored once closed
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -76,13 +76,48 @@ class MessageProcessorTest(unittest2.TestCase):
 		ret = proc.processPRE([msg], time.time())
 		self.assertEquals([], ret)
 
-		# Fill idlist buffer, force it to clean and make sure it still works
-		for ii in range(1, 300):
+		# Slide the window well past its size and make sure it still works
+		for ii in range(1, 3000):
 			msg = MAGIMessage(src="n1")
 			msg.msgid = ii
 			ret = proc.processPRE([msg], time.time())
 			self.assertEquals([msg], ret)
-			self.assert_(len(proc.lists["n1"]) < 200, "single id list should not reach 200")
+			self.assert_(len(proc.lists["n1"]) <= IdWindow.WINDOW, "window should not track more than its size")
+
+		# Recent ids are still duplicates, ids below the window are stale
+		for ii in (2999, 2500, 1976, 1975, 10):
+			msg = MAGIMessage(src="n1")
+			msg.msgid = ii
+			self.assertEquals([], proc.processPRE([msg], time.time()))
+		self.assertEquals(proc.lists["n1"].duplicates, 3)
+		self.assertEquals(proc.lists["n1"].stale, 2)
+		self.assertEquals(proc.stats['duplicatesdropped'], 6)
+
+
+	def test_IdWindow(self):
+		""" Test duplicate window out of order arrival, wrap around and restarted sources """
+		window = IdWindow()
+		for ii in (10, 12, 11, 15, 13):
+			self.assert_(window.add(ii))
+		for ii in (10, 11, 12, 13, 15):
+			self.assert_(ii in window)
+			self.assert_(not window.add(ii))
+		self.assert_(14 not in window)
+		self.assert_(window.add(14))
+
+		# ids wrap around at 32 bits
+		window = IdWindow()
+		self.assert_(window.add(0xFFFFFFFE))
+		self.assert_(window.add(1))
+		self.assert_(window.add(0xFFFFFFFF))
+		self.assert_(not window.add(0xFFFFFFFE))
+		self.assertEquals(window.top, 1)
+
+		# source restarted with a far away counter, start over
+		self.assert_(window.add(2**30))
+		self.assert_(window.add(5))
+		self.assertEquals(window.top, 5)
+		self.assert_(not window.add(5))
 
 
 	def test_AckProcessor(self):
@@ -176,6 +211,49 @@ class MessageProcessorTest(unittest2.TestCase):
 				break
 		
 
+	def test_AckComplete(self):
+		""" Test ACK processor completion, duplicate acks and retransmit deadlines """
+		proc = AckRequirement()
+		proc.configure(name="myname", msgintf=self.store, transports=self.transports, scheduler=Scheduler())
+
+		now = time.time()
+		for ii in range(1, 101):
+			msg = MAGIMessage(nodes="n1", data="acktest")
+			msg.msgid = ii
+			msg._userargs = {'acknowledgement':True }
+			proc.processOUT([msg], now)
+		self.assertEquals(len(proc.inflight), 100)
+		self.assertEquals(len(proc.deadlines), 100)
+
+		# ack all but the last one, the second copy of each is a duplicate
+		for ii in range(1, 100):
+			ackmsg = MAGIMessage(data="%d,n1," % ii)
+			ackmsg.flags |= MAGIMessage.ISACK
+			proc.processIN([ackmsg, ackmsg], now + 0.1)
+		self.assertEquals(len(proc.inflight), 1)
+		self.assertEquals(len(self.store.status), 99)
+		self.assertEquals(self.store.status[0].status, "Ack")
+		self.assertEquals(self.store.status[0].isack, True)
+		self.assertEquals(proc.stats['ackscomplete'], 99)
+		self.assertEquals(proc.stats['ackduplicates'], 99)
+		self.assertAlmostEquals(proc.stats['ackrtt'], 0.1, places=3)
+
+		# stale deadlines are skipped, only the remaining message is retransmitted
+		time.sleep(0.6)
+		proc.checkRetransmits()
+		self.assertEquals(len(self.store.outgoing), 1)
+		self.assertEquals(self.store.outgoing[0].msgid, 100)
+		self.assertEquals(proc.stats['ackretransmits'], 1)
+		self.assertEquals(proc.deadlines, [(proc.inflight[100].nextsend, 100)])
+
+		# acks after a retransmit do not feed the round trip estimate
+		ackmsg = MAGIMessage(data="100,n1,")
+		ackmsg.flags |= MAGIMessage.ISACK
+		proc.processIN([ackmsg], time.time() + 5)
+		self.assertEquals(len(proc.inflight), 0)
+		self.assertAlmostEquals(proc.stats['ackrtt'], 0.1, places=3)
+
+
 	def test_SequenceProcessor(self):
 		""" Test Sequence Processor """
 		proc = SequenceRequirement()
@@ -4,13 +4,19 @@ import unittest2
 import logging
 import time
 import base64
+import cPickle
 import yaml
 import subprocess
 import os
 import sys
 import cStringIO
+import glob
+import shutil
 import tarfile
+import tempfile
+from magi.util.blobs import BlobCache, blobDigest, splitBlob
 from magi.util.calls import MethodCall, CallException, dispatchCall, doMessageAction
+from magi.util import calls
 from magi.daemon.daemon import Daemon
 from magi.messaging.api import MAGIMessage
 from magi.tests.util import SimpleMessaging
@@ -30,6 +36,8 @@ class DaemonTest(unittest2.TestCase):
 		# trans = [ {'address': '239.255.1.2', 'class':' MulticastTransport', 'localaddr': '127.0.0.1', 'port': '18808'} ]
 		self.d = Daemon('mynode', trans)
 		self.d.daemon = True # Helps us exit easier
+		self.blobdir = tempfile.mkdtemp()
+		self.d.blobCache = BlobCache(self.blobdir)
 		self.q = SimpleMessaging()
 		self.d.messaging = self.q
 		self.d.extAgentsThread.messaging = self.q
@@ -41,6 +49,7 @@ class DaemonTest(unittest2.TestCase):
 		self.d.join(5.0)
 		logging.disable(0)
 		subprocess.call("rm -rf %s" % (magi.modules.__path__[0] + '/testhttp*'), shell=True)
+		shutil.rmtree(self.blobdir)
 
 	def test_MethodCall(self):
 		""" Test MethodCall code """
@@ -96,6 +105,31 @@ class DaemonTest(unittest2.TestCase):
 		msg = MAGIMessage(data=yaml.safe_dump(call))
 		doMessageAction(testobj, msg, self.d.messaging)
 	
+	def test_DispatchPlan(self):
+		""" Test dispatch plans are cached per class and rebuilt when a method is replaced """
+		class tester(object):
+			def __init__(self):
+				self.got = None
+			def fixed(self, msg, name1):
+				self.got = name1
+		testobj = tester()
+		call = { 'version': 1.0, 'method': 'fixed', 'args': { 'name1': 'name1', 'ignoreme': 'extra' } }
+		dispatchCall(testobj, None, call)
+		self.assertEquals(testobj.got, 'name1')
+		plan = calls._plans[tester]['fixed']
+		dispatchCall(tester(), None, call)
+		self.assertIs(calls._plans[tester]['fixed'], plan)
+
+		def replaced(msg, **kwargs):
+			testobj.got = kwargs
+		testobj.fixed = replaced
+		dispatchCall(testobj, None, call)
+		self.assertEquals(testobj.got, { 'name1': 'name1', 'ignoreme': 'extra' })
+
+		# python tags from yaml.dump still decode
+		msg = MAGIMessage(data=yaml.dump({ 'version': 1.0, 'method': 'fixed', 'args': { 'name1': (1, 2) } }))
+		self.assertEquals(calls.loadMessageData(msg)['args']['name1'], (1, 2))
+	
 	def test_Joiner(self):
 		""" Test of join and leave requests """
 		request = {
@@ -156,6 +190,48 @@ class DaemonTest(unittest2.TestCase):
 		self.doMessages(request, 'testSocket', True)
 
 
+	def test_ExecDigest(self):
+		""" Test loading an agent by digest, fetching the code once and reusing it after that """
+		store = cStringIO.StringIO()
+		tar = tarfile.open(fileobj=store, mode='w')
+		tar.add(os.path.join(magi.tests.__path__[0], 'testThread'), arcname='.', recursive=True)
+		tar.close()
+		data = store.getvalue()
+		digest = blobDigest(data)
+		request = {
+			'version': 1.0,
+			'method': 'loadAgent',
+			'args': { 'name': 'thd', 'code': 'testhttpdigest', 'dock': 'HTTPD', 'execargs': {}, 'digest': digest }
+		}
+
+		# not cached, asks the orchestrator for the blob for the group it was loaded for
+		self.q.inject(MAGIMessage(groups='loaders', docks='daemon', data=yaml.safe_dump(request)))
+		transmitted = self.q.extract(True, 2)
+		self.assertIn('control', transmitted.msg.dstgroups)
+		call = yaml.safe_load(transmitted.msg.data)
+		self.assertEquals(call['method'], 'getBlob')
+		self.assertEquals(call['args'], {'digest': digest, 'groups': ['loaders']})
+
+		chunks = splitBlob(data, 1024)
+		for index, chunk in enumerate(chunks):
+			putBlob = {'version': 1.0, 'method': 'putBlob', 
+					   'args': {'digest': digest, 'index': index, 'count': len(chunks), 'data': chunk}}
+			self.q.inject(MAGIMessage(groups='loaders', docks='daemon', contenttype=MAGIMessage.PICKLE, data=cPickle.dumps(putBlob, 2)))
+		self._waitForListen('HTTPD')
+		self.assertTrue(self.d.blobCache.has(digest))
+		cachepath = glob.glob(os.path.join(magi.modules.__path__[0], 'testhttpdigest*'))[0]  # desktop daemons add the hostname
+		self.assertEquals(self.d.codeDigest(cachepath), digest)
+		self.assertIn('AgentLoadDone', self.q.extract(True, 2).msg.data)
+
+		# cached and extracted, loads straight away without extracting again
+		marker = os.path.join(cachepath, Daemon.CODEDIGEST)
+		os.utime(marker, (0, 0))
+		request['args']['dock'] = 'HTTPD2'
+		self.q.inject(MAGIMessage(groups='loaders', docks='daemon', data=yaml.safe_dump(request)))
+		self._waitForListen('HTTPD2')
+		self.assertIn('AgentLoadDone', self.q.extract(True, 2).msg.data)
+		self.assertEquals(os.stat(marker).st_mtime, 0)
+
 	def _waitForListen(self, dock, wait=5):
 		""" Waits until a particular dock has a listening agent, i.e. wait for process to start, hacks into daemon parts """
 		stopat = time.time() + wait
@@ -5,8 +5,9 @@ import logging
 
 from magi.tests.util import *
 from magi.messaging.api import MAGIMessage
-from magi.orchestrator.parse import AAL
+from magi.orchestrator.parse import AAL, BaseMethodCall, EventMethodCall
 from magi.orchestrator.orchestrator import Orchestrator
+from magi.util.calls import loadMessageData
 
 class AALTest(unittest2.TestCase):
     """
@@ -33,6 +34,34 @@ class AALTest(unittest2.TestCase):
         self.assertEquals(['Node2', 'Node3', 'Node4'], self.aal.getStream('branch1')[0].args['clients'])
 
 
+    def test_payloads(self):
+        """ Test calls are encoded once when parsed and decode the same in each content type """
+        for contenttype in (MAGIMessage.YAML, MAGIMessage.JSON, MAGIMessage.PICKLE):
+            aal = AAL([os.path.join(os.path.dirname(__file__), 'test.aal')], contenttype=contenttype)
+            for stream in aal.getSetupStreams() + aal.getTeardownStreams() + [aal.getStream('main')]:
+                for event in stream:
+                    if not isinstance(event, BaseMethodCall):
+                        continue
+                    first = event.getMessages()[0]
+                    second = event.getMessages()[0]
+                    self.assertEquals(first.contenttype, contenttype)
+                    self.assertIs(first.data, second.data)
+                    self.assertIsNot(first, second)
+                    self.assertEquals(loadMessageData(first), event.getCall())
+
+        # the cached payload doesn't change what is the same event
+        event = aal.getStream('main')[0]
+        same = EventMethodCall(aal.rawAAL['agents']['logger'], aal.rawAAL['eventstreams']['main'][0])
+        self.assertEquals(same, event)
+        self.assertEquals(aal.getStream('main').index(same), 0)
+
+        # calls that can't be encoded as JSON go as YAML
+        unencodable = BaseMethodCall(groups='g', docks='d', method='m', args={'nodes' : set(['n1'])}, 
+                                     contenttype=MAGIMessage.JSON)
+        msg = unencodable.getMessages()[0]
+        self.assertEquals(msg.contenttype, MAGIMessage.YAML)
+        self.assertEquals(loadMessageData(msg)['args'], {'nodes' : set(['n1'])})
+
     def _verifyMessageCount(self, count):
         self.assertEquals(self.messaging.outgoing.qsize(), count)
         for ii in range(count):
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from collections import defaultdict
-from magi.orchestrator.parse import createTrigger
+from magi.orchestrator.parse import createTrigger, TriggerIndex, TriggerList
 import logging
 import time
 import unittest2
@@ -182,6 +182,62 @@ class BranchingTest(unittest2.TestCase):
 		retVal = t4.isComplete(triggerCache)
 		self.assertEquals(retVal, False)
 
+	def test_triggerIndex(self):
+		""" Test received triggers are merged by args and waiting triggers track matching nodes """
+		index = TriggerIndex()
+		waiting = createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a1', 'nodes' : ['n1', 'n2', 'n3']})
+		anyNode = createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a1', 'count' : 2})
+		self.assertFalse(waiting.isComplete(index))
+
+		for node in ['n1', 'n2', 'other']:
+			index.add(createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a1', 'nodes' : node}))
+		index.add(createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a2', 'nodes' : 'n3'}))
+		self.assertEquals(len(index['AgentLoadDone']), 2)
+		self.assertEquals(index.matchedNodes(waiting), set(['n1', 'n2']))
+		self.assertFalse(waiting.isComplete(index))
+		self.assertTrue(anyNode.isComplete(index))
+		self.assertEquals(index.takeChanged(), set(['AgentLoadDone']))
+		self.assertEquals(index.takeChanged(), set())
+
+		index.add(createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a1', 'nodes' : ['n3', 'n4']}))
+		self.assertTrue(waiting.isComplete(index))
+
+		index.invalidate('AgentLoadDone', ['n3'])
+		self.assertFalse(waiting.isComplete(index))
+		self.assertEquals(index.matchedNodes(anyNode), set(['n1', 'n2', 'n4', 'other']))
+		self.assertEquals([entry.nodes for entry in index['AgentLoadDone'] if entry.args['agent'] == 'a2'], [])
+		index.add(createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a1', 'nodes' : 'n3'}))
+		self.assertTrue(waiting.isComplete(index))
+		index.invalidate('AgentLoadDone')
+		self.assertNotIn('AgentLoadDone', index)
+		self.assertFalse(anyNode.isComplete(index))
+		self.assertEquals(index.matchedNodes(waiting), set())
+		index.add(createTrigger({'event' : 'AgentLoadDone', 'agent' : 'a1', 'nodes' : 'n1'}))
+		self.assertEquals(index.matchedNodes(waiting), set(['n1']))
+
+		index.unwatch(TriggerList([]) + [waiting])
+		self.assertEquals(index.watchers['AgentLoadDone'].keys(), [id(anyNode)])
+
+	def test_waitingEvents(self):
+		""" Test trigger lists report the events they wait on """
+		events = TriggerList([{'event' : 'A'}, {'type' : 'AND', 'triggers' : [{'event' : 'B'}, {'event' : 'C'}]}])
+		self.assertEquals(events.getWaitingEvents(), set(['A', 'B', 'C']))
+		timed = TriggerList([{'event' : 'A'}, {'type' : 'OR', 'triggers' : [{'event' : 'B'}, {'timeout' : 1000}]}])
+		self.assertEquals(timed.getWaitingEvents(), set(['A', 'B']))
+
+	def test_deadlines(self):
+		""" Test trigger lists report when they may complete on time alone """
+		now = time.time()
+		events = TriggerList([{'event' : 'A'}, {'type' : 'AND', 'triggers' : [{'event' : 'B'}, {'timeout' : 1000}]}])
+		self.assertEquals(events.getDeadline(), None) # not active yet
+		events.activate(now)
+		self.assertEquals(events.getDeadline(), now + 1)
+		timed = TriggerList([{'timeout' : 5000}, {'type' : 'OR', 'triggers' : [{'event' : 'B'}, {'timeout' : 2000}]},
+							 {'type' : 'AND', 'triggers' : [{'timeout' : 1000}, {'timeout' : 3000}]}])
+		timed.activate(now)
+		self.assertEquals(timed.getDeadline(), now + 2)
+		self.assertEquals(TriggerList([{'event' : 'A'}]).getDeadline(), None)
+
 #	def test_selfDestruct(self):
 #
 #		args = { 'event': 'Bork! Bork! Bork!' }
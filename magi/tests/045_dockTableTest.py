@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import Queue
+from magi.daemon.threadInterface import DockTable, MessagingWrapper
+
+
+class FakeAgent(object):
+	def __init__(self, dock):
+		self.docklist = set([dock])
+
+
+class DockTableTest(unittest2.TestCase):
+	"""
+		Testing of the daemon's dock to threaded agent index
+	"""
+
+	def setUp(self):
+		self.table = DockTable()
+		self.a = FakeAgent('one')
+		self.b = FakeAgent('one')
+		self.table.add('one', self.a)
+		self.table.add('one', self.b)
+
+	def test_addDiscard(self):
+		""" Test subscribers are kept in listen order and docks disappear when empty """
+		self.table.add('one', self.a)  # second add is a no-op
+		self.assertEquals(self.table.subscribers('one'), (self.a, self.b))
+		self.assertEquals(self.table.subscribers('two'), ())
+		self.table.discard('one', self.a)
+		self.table.discard('one', self.a)
+		self.assertEquals(self.table.subscribers('one'), (self.b,))
+		self.table.discard('one', self.b)
+		self.assertNotIn('one', self.table)
+
+	def test_wrapper(self):
+		""" Test listenDock/unlistenDock through the agent messenger update the table """
+		messenger = MessagingWrapper('a', None, Queue.Queue(), self.a.docklist, self.table, self.a)
+		messenger.listenDock('two')
+		self.assertEquals(self.a.docklist, set(['one', 'two']))
+		self.assertEquals(self.table.subscribers('two'), (self.a,))
+		messenger.unlistenDock('one')
+		self.assertEquals(self.table.subscribers('one'), (self.b,))
+		self.table.removeAgent(self.a)
+		self.assertNotIn('two', self.table)
+		self.assertEquals(self.table.subscribers('one'), (self.b,))
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
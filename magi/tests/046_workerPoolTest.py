@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import threading
+import time
+import yaml
+from magi.messaging.magimessage import MAGIMessage
+from magi.tests.util import TestMessagingWrapper
+from magi.util.agent import NonBlockingDispatchAgent, agentmethod
+from magi.util.pool import WorkerPool
+
+
+class SlowAgent(NonBlockingDispatchAgent):
+
+	def __init__(self):
+		NonBlockingDispatchAgent.__init__(self)
+		self.lock = threading.Lock()
+		self.calls = list()
+
+	@agentmethod()
+	def work(self, msg, ii):
+		time.sleep(0.02)
+		with self.lock:
+			self.calls.append(ii)
+
+
+def call(method, **args):
+	return MAGIMessage(docks='slow', contenttype=MAGIMessage.YAML,
+					   data=yaml.safe_dump({'version': 1.0, 'method': method, 'args': args}))
+
+
+class WorkerPoolTest(unittest2.TestCase):
+	"""
+		Testing of the bounded worker pool used by NonBlockingDispatchAgent
+	"""
+
+	def setUp(self):
+		self.lock = threading.Lock()
+		self.active = dict()
+		self.peak = dict()
+		self.order = list()
+
+	def task(self, key, ii):
+		with self.lock:
+			self.active[key] = self.active.get(key, 0) + 1
+			self.peak[key] = max(self.peak.get(key, 0), self.active[key])
+		time.sleep(0.01)
+		with self.lock:
+			self.active[key] -= 1
+			self.order.append((key, ii))
+
+	def test_bounded(self):
+		""" Test threads stay within the limit and unkeyed tasks run concurrently """
+		pool = WorkerPool('test', 4, 100)
+		for ii in range(40):
+			pool.submit('task', None, self.task, 'all', ii)
+		self.assertTrue(pool.drain(5))
+		self.assertLessEqual(len(pool.threads), 4)
+		self.assertGreater(self.peak['all'], 1)
+		self.assertEquals(len(self.order), 40)
+		metrics = pool.metrics()
+		self.assertEquals(metrics['tasks']['task']['count'], 40)
+		self.assertGreater(metrics['tasks']['task']['maxwait'], 0)
+		self.assertTrue(pool.shutdown(1))
+		self.assertFalse(pool.submit('task', None, self.task, 'all', 41))
+
+	def test_keys(self):
+		""" Test tasks with the same key run one at a time in order """
+		pool = WorkerPool('test', 4, 100)
+		for ii in range(10):
+			pool.submit('a', 'a', self.task, 'a', ii)
+			pool.submit('b', 'b', self.task, 'b', ii)
+		pool.shutdown(5)
+		self.assertEquals(self.peak, {'a': 1, 'b': 1})
+		self.assertEquals([ii for key, ii in self.order if key == 'a'], range(10))
+		self.assertEquals([ii for key, ii in self.order if key == 'b'], range(10))
+
+	def test_queueLimit(self):
+		""" Test submit blocks while the queue is full """
+		pool = WorkerPool('test', 1, 2)
+		start = time.time()
+		for ii in range(6):
+			pool.submit('task', None, self.task, 'all', ii)
+			self.assertLessEqual(pool.queued, 2)
+		self.assertGreater(time.time() - start, 0.02)
+		pool.shutdown(5)
+		self.assertEquals(len(self.order), 6)
+
+	def test_agent(self):
+		""" Test the agent runs calls on the pool, serializes keyed methods and drains on stop """
+		agent = SlowAgent()
+		agent.name = 'slow'
+		agent.concurrencyKeys = {'work': 'work'}
+		agent.messenger = TestMessagingWrapper('slow')
+		for ii in range(10):
+			agent.messenger.rxqueue.put(call('work', ii=ii))
+		agent.messenger.rxqueue.put(call('stop'))
+		thread = threading.Thread(target=agent.run)
+		thread.start()
+		thread.join(5)
+		self.assertFalse(thread.isAlive())
+		self.assertEquals(agent.calls, range(10))
+		self.assertEquals(agent.getPoolMetrics()['tasks']['work']['count'], 10)
+		self.assertEquals(len(agent.pool.threads), 1)
+
+	def test_agentKeyFunction(self):
+		""" Test a concurrency key computed from the message only serializes calls with the same key """
+		agent = SlowAgent()
+		agent.name = 'slow'
+		agent.concurrencyKeys = {'work': lambda msg: msg.src}
+		agent.messenger = TestMessagingWrapper('slow')
+		for ii in range(10):
+			msg = call('work', ii=ii)
+			msg.src = 'node%d' % (ii % 2)
+			agent.messenger.rxqueue.put(msg)
+		agent.messenger.rxqueue.put(call('stop'))
+		thread = threading.Thread(target=agent.run)
+		thread.start()
+		thread.join(5)
+		self.assertFalse(thread.isAlive())
+		self.assertEquals([ii for ii in agent.calls if ii % 2 == 0], range(0, 10, 2))
+		self.assertEquals([ii for ii in agent.calls if ii % 2 == 1], range(1, 10, 2))
+		self.assertEquals(len(agent.pool.threads), 2)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
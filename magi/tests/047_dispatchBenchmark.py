@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+import time
+import yaml
+from magi.messaging.magimessage import MAGIMessage
+from magi.util import calls
+from magi.util.agent import agentmethod
+
+log = logging.getLogger(__name__)
+
+class Target(object):
+
+	@agentmethod()
+	def startTraffic(self, msg, interval=None, servers=None, count=0):
+		pass
+
+	@agentmethod()
+	def setConfiguration(self, msg, **kwargs):
+		pass
+
+
+class DispatchBenchmark(unittest2.TestCase):
+	"""
+		Reports calls/sec for decoding and dispatching agent method calls, with and without the cached dispatch plans
+	"""
+
+	COUNT = 5000
+
+	def newMsg(self, method):
+		call = {'version': 1.0, 'method': method, 'trigger': 'TrafficStarted',
+				'args': {'interval': '1', 'servers': ['servernode-%d' % ii for ii in range(5)], 'count': 10, 'ignored': True}}
+		return MAGIMessage(docks=['traffic'], contenttype=MAGIMessage.YAML, data=yaml.safe_dump(call))
+
+	def runDispatch(self, name, method, cached):
+		target = Target()
+		msg = self.newMsg(method)
+		data = calls.loadMessageData(msg)
+		start = time.time()
+		for ii in xrange(self.COUNT):
+			if not cached:
+				calls._plans.clear()
+			calls.dispatchCall(target, msg, data)
+		rate = self.COUNT / (time.time() - start)
+		log.info("%-16s dispatch: %9.0f calls/sec", name, rate)
+
+	def runDecode(self, name, loader, count):
+		msg = self.newMsg('startTraffic')
+		start = time.time()
+		for ii in xrange(count):
+			yaml.load(msg.data, Loader=loader)
+		rate = count / (time.time() - start)
+		log.info("%-16s decode:   %9.0f msgs/sec", name, rate)
+
+	def test_dispatch(self):
+		""" Benchmark dispatch with the plan rebuilt every call and cached """
+		self.runDispatch("uncached", 'startTraffic', False)
+		self.runDispatch("cached", 'startTraffic', True)
+		self.runDispatch("cached kwargs", 'setConfiguration', True)
+
+	def test_decode(self):
+		""" Benchmark the python and libyaml loaders """
+		self.runDecode("python", yaml.Loader, self.COUNT / 5)
+		self.runDecode(calls.SafeLoader.__name__, calls.SafeLoader, self.COUNT)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
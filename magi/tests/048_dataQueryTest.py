@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import unittest2
+import logging
+from collections import defaultdict
+import pickle
+import threading
+from magi.messaging.magimessage import MAGIMessage
+from magi.modules.dataman import dataman
+from magi.tests.util import TestMessagingWrapper
+from magi.util import database
+
+
+class DataQueryTest(unittest2.TestCase):
+	"""
+		Testing of the chunked, acknowledged data query stream, with the database replaced by a fixed record set
+	"""
+
+	def setUp(self):
+		self.records = {('a1', 'n1'): range(25), ('a1', 'n2'): [], ('a2', 'n1'): range(5)}
+		self.saved = database.iterData, database.getConnection
+		database.iterData = self.iterData
+		database.getConnection = lambda host, port: None
+		self.queries = list()
+		self.agent = dataman.DataManAgent.__new__(dataman.DataManAgent)  # skip the database setup
+		self.agent.streamAcks = dict()
+		self.agent.streamCancels = dict()
+		self.agent.workers = 8
+		self.agent.streamCondition = threading.Condition()
+		self.agent.queryLock = threading.Lock()
+		self.agent.queryStats = defaultdict(lambda: [0, 0, 0.0, 0.0])
+		self.agent.messenger = TestMessagingWrapper('dataman')
+
+	def tearDown(self):
+		database.iterData, database.getConnection = self.saved
+
+	def iterData(self, agent, filters, timestampRange, dbHost, dbPort, fields):
+		start, end = timestampRange
+		if isinstance(filters['host'], dict):  # batched query, records tagged with their node
+			self.queries.append((agent, timestampRange))
+			for node in filters['host']['$in']:
+				for record in self.records.get((agent, node), []):
+					if start <= record < end:
+						yield {'host': node, 'value': record}
+			return
+		for record in self.records.get((agent, filters['host']), []):
+			if start <= record < end:
+				yield record
+
+	def request(self):
+		msg = MAGIMessage(nodes='dataman', docks='dataman')
+		msg.src = 'client'
+		msg.srcdock = 'clientdock'
+		return msg
+
+	def nextChunk(self):
+		msg = self.agent.messenger.txqueue.get(True, 2)
+		self.assertEquals(msg.dstdocks, set(['clientdock']))
+		return pickle.loads(msg.data)['args']
+
+	def test_chunkData(self):
+		""" Test records are grouped in bounded chunks """
+		self.assertEquals(list(database.chunkData(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+		self.assertEquals(list(database.chunkData([], 3)), [])
+
+	def test_stream(self):
+		""" Test chunks are bounded, ordered, cover every agent and node, and wait for acknowledgements """
+		args = dict(queryId=7, agents=['a1', 'a2'], nodes=['n1', 'n2'], timestampChunks=[(0, 10), (10, 100)],
+					chunkSize=10, window=2)
+		thread = threading.Thread(target=self.agent.streamData, args=(self.request(),), kwargs=args)
+		thread.start()
+
+		chunks = [self.nextChunk(), self.nextChunk()]
+		self.assertRaises(Exception, self.agent.messenger.txqueue.get, True, 0.2)  # window is full
+		while not chunks[-1]['last']:
+			self.agent.ackData(self.request(), 7, chunks[-1]['seq'] - 1)
+			chunks.append(self.nextChunk())
+		thread.join(2)
+		self.assertFalse(thread.isAlive())
+		self.assertEquals(self.agent.streamAcks, dict())
+
+		self.assertEquals([c['seq'] for c in chunks], range(len(chunks)))
+		self.assertEquals([len(c['records']) for c in chunks], [10, 10, 5, 0, 5, 0, 0])
+		result = dict()
+		for c in chunks[:-1]:
+			result.setdefault((c['agent'], c['node']), []).extend(c['records'])
+		self.assertEquals(result, {('a1', 'n1'): range(25), ('a1', 'n2'): [], ('a2', 'n1'): range(5), ('a2', 'n2'): []})
+
+	def test_fetchData(self):
+		""" Test one query per agent and time range, with records split by node in time order """
+		data = self.agent.fetchData(['a1', 'a2'], ['n1', 'n2'], {}, [(0, 10), (10, 20), (20, 100)], ['value'])
+		self.assertEquals(sorted(self.queries), sorted([(agent, ts) for agent in ('a1', 'a2') for ts in [(0, 10), (10, 20), (20, 100)]]))
+		result = dict()
+		for agent, nodes in data.iteritems():
+			for node, records in nodes.iteritems():
+				result[(agent, node)] = [r['value'] for r in records]
+		self.assertEquals(result, {('a1', 'n1'): range(25), ('a1', 'n2'): [], ('a2', 'n1'): range(5), ('a2', 'n2'): []})
+		stats = self.agent.getQueryStats()
+		self.assertEquals(stats['a1']['queries'], 3)
+		self.assertEquals(stats['a1']['records'], 25)
+
+	def test_noAck(self):
+		""" Test the stream gives up when the requester stops acknowledging """
+		saved = dataman.DataManAgent.STREAM_ACK_TIMEOUT
+		dataman.DataManAgent.STREAM_ACK_TIMEOUT = 0.1
+		self.records[('a1', 'n2')] = range(25)
+		try:
+			logging.disable(40)
+			self.agent.streamData(self.request(), 8, agents=['a1'], nodes=['n1', 'n2'], chunkSize=10, window=1)
+		finally:
+			logging.disable(0)
+			dataman.DataManAgent.STREAM_ACK_TIMEOUT = saved
+		self.assertEquals(self.agent.messenger.txqueue.qsize(), 1)
+		self.assertEquals(self.agent.streamAcks, dict())
+
+	def test_cancel(self):
+		""" Test a cancelled stream stops without waiting for the acknowledgement timeout """
+		self.records[('a1', 'n2')] = range(25)
+		thread = threading.Thread(target=self.agent.streamData, args=(self.request(), 9),
+								  kwargs=dict(agents=['a1'], nodes=['n1', 'n2'], chunkSize=10, window=1))
+		thread.start()
+		self.assertEquals(self.nextChunk()['seq'], 0)
+		self.agent.ackData(self.request(), 9, -1, cancel=True)
+		thread.join(2)
+		self.assertFalse(thread.isAlive())
+		self.assertEquals(self.agent.messenger.txqueue.qsize(), 0)
+		self.assertEquals(self.agent.streamAcks, dict())
+
+		# cancelled while still queued, never starts
+		self.agent.ackData(self.request(), 10, -1, cancel=True)
+		self.agent.streamData(self.request(), 10, agents=['a1'], nodes=['n1'])
+		self.assertEquals(self.agent.messenger.txqueue.qsize(), 0)
+		self.assertEquals(self.agent.streamCancels, dict())
+
+	def test_streamKey(self):
+		""" Test streams from one requester are serialized and streams can't take every worker """
+		self.assertEquals(self.agent.streamKey(self.request()), self.agent.streamKey(self.request()))
+		keys = set()
+		for ii in range(100):
+			msg = self.request()
+			msg.src = 'client%d' % ii
+			keys.add(self.agent.streamKey(msg))
+		self.assertEquals(len(keys), self.agent.workers // 2)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import unittest2
+import copy
+import logging
+import time
+from collections import defaultdict
+from magi.orchestrator.parse import createTrigger, TriggerIndex
+
+log = logging.getLogger(__name__)
+
+class TriggerBenchmark(unittest2.TestCase):
+	"""
+		Reports triggers/sec for an N node agent load and group build trigger storm, with each trigger
+		cached and the waiting triggers checked as the orchestrator does
+	"""
+
+	NODES = 1000
+
+	def storm(self):
+		nodes = ['node-%d' % ii for ii in range(self.NODES)]
+		incoming = [createTrigger({'event': 'GroupBuildDone', 'group': 'all', 'nodes': node}) for node in nodes]
+		for agent in ('server', 'client'):
+			incoming.extend([createTrigger({'event': 'AgentLoadDone', 'agent': agent, 'nodes': node}) for node in nodes])
+		waiting = [createTrigger({'event': 'GroupBuildDone', 'group': 'all', 'nodes': nodes})]
+		waiting.extend([createTrigger({'event': 'AgentLoadDone', 'agent': agent, 'nodes': nodes}) for agent in ('server', 'client')])
+		return incoming, waiting
+
+	def test_scan(self):
+		""" Benchmark per node copies scanned on every check """
+		incoming, waiting = self.storm()
+		cache = defaultdict(list)
+		start = time.time()
+		for trigger in incoming:
+			for node in trigger.nodes:
+				nodeTrigger = copy.copy(trigger)
+				nodeTrigger.nodes = set([node])
+				cache[trigger.event].append(nodeTrigger)
+			for wait in waiting:
+				wait.isComplete(cache)
+		rate = len(incoming) / (time.time() - start)
+		self.assertTrue(all([wait.isComplete(cache) for wait in waiting]))
+		log.info("scan   %5d nodes: %9.0f triggers/sec", self.NODES, rate)
+
+	def test_index(self):
+		""" Benchmark the trigger index, checking only triggers waiting on a changed event """
+		incoming, waiting = self.storm()
+		index = TriggerIndex()
+		start = time.time()
+		for trigger in incoming:
+			index.add(trigger)
+			woken = index.takeChanged()
+			for wait in waiting:
+				if wait.event in woken:
+					wait.isComplete(index)
+		rate = len(incoming) / (time.time() - start)
+		self.assertTrue(all([wait.isComplete(index) for wait in waiting]))
+		log.info("index  %5d nodes: %9.0f triggers/sec", self.NODES, rate)
+
+	def test_invalidate(self):
+		""" Benchmark invalidating each trigger's nodes before caching it, as when overwriting cached triggers """
+		incoming, waiting = self.storm()
+		cache = defaultdict(list)
+		start = time.time()
+		for trigger in incoming:
+			active = cache[trigger.event]
+			active[:] = [cached for cached in active if not cached.nodes.issubset(trigger.nodes)]
+			for node in trigger.nodes:
+				nodeTrigger = copy.copy(trigger)
+				nodeTrigger.nodes = set([node])
+				cache[trigger.event].append(nodeTrigger)
+		listrate = len(incoming) / (time.time() - start)
+
+		index = TriggerIndex()
+		start = time.time()
+		for trigger in incoming:
+			index.invalidate(trigger.event, trigger.nodes)
+			index.add(trigger)
+		indexrate = len(incoming) / (time.time() - start)
+		# the client loads overwrite the server loads from the same nodes
+		self.assertEquals([wait.isComplete(index) for wait in waiting], [True, False, True])
+		log.info("invalidate %5d nodes: list %9.0f triggers/sec  epoch %9.0f triggers/sec", self.NODES, listrate, indexrate)
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+import unittest2
+import yaml
+
+from magi.messaging.magimessage import MAGIMessage
+from magi.orchestrator.orchestrator import Orchestrator, StreamIterator
+from magi.orchestrator.parse import Stream, TriggerIndex, TriggerList
+from magi.tests.util import SimpleMessaging
+
+
+class RecordingDisplay(object):
+	""" Stands in for the display, remembers when streams ended """
+	def __init__(self):
+		self.ended = dict()
+
+	def streamEnded(self, streamIter):
+		self.ended[streamIter.getName()] = time.time()
+
+	def __getattr__(self, name):
+		return lambda *args, **kwargs: None
+
+
+class CountingOrchestrator(Orchestrator):
+	""" Counts the stream steps """
+	def stepStream(self, streamIter):
+		self.steps += 1
+		return Orchestrator.stepStream(self, streamIter)
+
+
+class OrchestratorLoopTest(unittest2.TestCase):
+	"""
+		Testing of the orchestrator stream loop, woken by deadlines and triggers
+	"""
+
+	def setUp(self):
+		self.orch = CountingOrchestrator.__new__(CountingOrchestrator)  # skip the database and display setup
+		self.orch.messaging = SimpleMessaging()
+		self.orch.display = RecordingDisplay()
+		self.orch.triggerCache = TriggerIndex()
+		self.orch.activeTriggerCache = TriggerIndex()
+		self.orch.stopStreams = False
+		self.orch.exitOnFailure = False
+		self.orch.verbose = False
+		self.orch.record = False
+		self.orch.collection = None
+		self.orch.overWriteCachedTriggers = False
+		self.orch.steps = 0
+		self.thread = None
+
+	def tearDown(self):
+		self.orch.stop()
+		if self.thread is not None:
+			self.thread.join(Orchestrator.MAXWAIT + 1)
+
+	def start(self, streams):
+		self.orch.activeStreams = dict()
+		for name, triggers in streams.iteritems():
+			stream = Stream(name)
+			stream.append(TriggerList(triggers))
+			self.orch.activeStreams[name] = StreamIterator(name, stream)
+		self.started = time.time()
+		self.thread = threading.Thread(target=self.orch.runStreams)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def sendTrigger(self, **data):
+		self.orch.messaging.inject(MAGIMessage(groups="control", docks="control", data=yaml.dump(data)))
+
+	def waitFor(self, name, limit=2.0):
+		stopat = time.time() + limit
+		while name not in self.orch.display.ended and time.time() < stopat:
+			time.sleep(0.005)
+		self.assertIn(name, self.orch.display.ended)
+		return self.orch.display.ended[name] - self.started
+
+	def test_timeout(self):
+		""" Test timeouts fire once they pass, well before the longest wait """
+		self.start({ 'short' : [{'timeout' : 50.0}], 'long' : [{'timeout' : 250.0}],
+					 'waiting' : [{'event' : 'never', 'nodes' : ['n1']}] })
+		shortEnd = self.waitFor('short')
+		longEnd = self.waitFor('long')
+		self.assertGreaterEqual(shortEnd, 0.05)
+		self.assertGreaterEqual(longEnd, 0.25)
+		self.assertLess(longEnd, 1.0)  # MAXWAIT is 3 seconds
+		self.assertLess(shortEnd, longEnd)
+
+	def test_conjunction(self):
+		""" Test a stream waiting on an event and a timeout completes when the later of the two arrives """
+		self.start({ 'both' : [{'type' : 'AND', 'triggers' : [{'event' : 'A', 'nodes' : ['n1']}, {'timeout' : 50.0}]}] })
+		time.sleep(0.1)
+		self.assertNotIn('both', self.orch.display.ended)
+		sent = time.time() - self.started
+		self.sendTrigger(event='A', nodes=['n1'])
+		self.assertLess(self.waitFor('both') - sent, 1.0)
+
+	def test_wakeOnlyWaiting(self):
+		""" Test a trigger only steps the streams waiting on its event """
+		streams = dict([('s%d' % ii, [{'event' : 'E%d' % ii, 'nodes' : ['n1']}]) for ii in range(1000)])
+		self.start(streams)
+		time.sleep(0.1)
+		self.assertEquals(self.orch.steps, 1000)
+
+		self.sendTrigger(event='E7', nodes=['n1'])
+		self.waitFor('s7')
+		self.assertEquals(self.orch.steps, 1002)  # complete the trigger, then end the stream
+		self.assertEquals(len(self.orch.display.ended), 1)
+
+
+if __name__ == '__main__':
+	import signal
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import base64
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest2
+import yaml
+
+from magi.messaging.magimessage import MAGIMessage
+from magi.orchestrator.parse import AAL, BaseMethodCall
+
+log = logging.getLogger(__name__)
+
+class PayloadBenchmark(unittest2.TestCase):
+	"""
+		Reports orchestrator startup time for a large AAL, and the cost of sending its events with the cached
+		payloads and with the call encoded on every send
+	"""
+
+	AGENTS = 8
+	TARSIZE = 256 * 1024
+	EVENTS = 500
+	ROUNDS = 3  # group build retries and restarts send the setup calls again
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.aalfile = os.path.join(self.tmpdir, 'large.aal')
+		nodes = ['node-%d' % ii for ii in range(100)]
+		aal = { 'streamstarts': ['main'], 'groups': { 'all': nodes }, 'agents': dict(), 'eventstreams': { 'main': [] } }
+		for ii in range(self.AGENTS):
+			aal['agents']['agent%d' % ii] = { 'group': 'all', 'tardata': base64.b64encode(os.urandom(self.TARSIZE)),
+											  'execargs': { 'interval': 5, 'servers': nodes[:10] } }
+		for ii in range(self.EVENTS):
+			aal['eventstreams']['main'].append({ 'type': 'event', 'agent': 'agent%d' % (ii % self.AGENTS),
+												 'method': 'setConfiguration', 'trigger': 'configured%d' % ii,
+												 'args': { 'interval': ii, 'servers': nodes[:10] } })
+		with open(self.aalfile, 'w') as fd:
+			yaml.dump(aal, fd, Dumper=yaml.CDumper if hasattr(yaml, 'CDumper') else yaml.Dumper)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def calls(self, aal):
+		streams = aal.getSetupStreams() + [aal.getStream('main')]
+		return [event for stream in streams for event in stream if isinstance(event, BaseMethodCall)]
+
+	def test_startup(self):
+		""" Benchmark parsing a large AAL in each content type """
+		for name, contenttype in (('yaml', MAGIMessage.YAML), ('json', MAGIMessage.JSON), ('pickle', MAGIMessage.PICKLE)):
+			start = time.time()
+			aal = AAL([self.aalfile], contenttype=contenttype)
+			size = sum([len(event.getMessages()[0].data) for event in self.calls(aal)])
+			log.info("%-8s startup: %6.3f sec, %9d payload bytes", name, time.time() - start, size)
+
+	def test_send(self):
+		""" Benchmark sending the events with the cached payloads and re-encoding them """
+		events = self.calls(AAL([self.aalfile]))
+		times = []
+		for cached in (True, False):
+			start = time.time()
+			for ii in range(self.ROUNDS):
+				for event in events:
+					if cached:
+						event.getMessages()
+					else:
+						# what every send used to do
+						MAGIMessage(groups=event.groups, nodes=event.nodes, docks=event.docks, contenttype=MAGIMessage.YAML,
+									data=yaml.dump(event.getCall(), width=10000))
+			times.append(time.time() - start)
+			log.info("%-8s send: %9.0f msgs/sec", 'cached' if cached else 'encoded', self.ROUNDS * len(events) / times[-1])
+		self.assertLess(times[0], times[1])
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import base64
+import cPickle
+import logging
+import os
+import shutil
+import tempfile
+import unittest2
+import yaml
+
+from magi.orchestrator.orchestrator import Orchestrator
+from magi.orchestrator.parse import AAL, LoadAgentCall, UnloadAgentCall
+from magi.tests.util import SimpleMessaging
+from magi.util.blobs import BlobCache, BlobError, BlobFetch, blobDigest, splitBlob
+
+
+class BlobTest(unittest2.TestCase):
+	"""
+		Testing of the content addressed agent code store
+	"""
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.cache = BlobCache(os.path.join(self.tmpdir, 'blobs'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_cache(self):
+		""" Test blobs are stored and found by digest """
+		data = os.urandom(1000)
+		digest = blobDigest(data)
+		self.assertFalse(self.cache.has(digest))
+		self.assertEquals(self.cache.put(data), digest)
+		self.assertTrue(self.cache.has(digest))
+		self.assertEquals(self.cache.get(digest), data)
+		self.assertEquals(self.cache.put(data, digest), digest)  # already there
+		self.assertEquals(os.listdir(self.cache.directory), [digest])
+
+	def test_badDigest(self):
+		""" Test data that doesn't match its digest and digests that aren't digests are refused """
+		self.assertRaises(BlobError, self.cache.put, 'data', blobDigest('other'))
+		self.assertFalse(os.path.exists(self.cache.directory))
+		for digest in ('../../etc/passwd', blobDigest('x').upper(), None):
+			self.assertRaises(BlobError, self.cache.has, digest)
+
+	def test_chunks(self):
+		""" Test a blob split in chunks comes back together in any order """
+		data = os.urandom(10000)
+		chunks = splitBlob(data, 3000)
+		self.assertEquals([len(c) for c in chunks], [3000, 3000, 3000, 1000])
+		self.assertEquals(splitBlob(''), [''])
+
+		fetch = BlobFetch(blobDigest(data))
+		self.assertFalse(fetch.add(3, len(chunks), chunks[3]))
+		self.assertFalse(fetch.add(1, 2, 'split differently'))  # starts over
+		for index in (2, 0, 3):
+			self.assertFalse(fetch.add(index, len(chunks), chunks[index]))
+		self.assertFalse(fetch.add(7, len(chunks), 'out of range'))
+		self.assertTrue(fetch.add(1, len(chunks), chunks[1]))
+		self.assertEquals(fetch.data(), data)
+
+	def writeAAL(self, tardata):
+		aalfile = os.path.join(self.tmpdir, 'code.aal')
+		with open(aalfile, 'w') as fd:
+			yaml.safe_dump({ 'streamstarts': ['main'], 'groups': { 'clients': ['n1', 'n2'] },
+							 'agents': { 'client': { 'group': 'clients', 'tardata': base64.b64encode(tardata), 'execargs': {} } },
+							 'eventstreams': { 'main': [] } }, fd)
+		return aalfile
+
+	def test_aalDigests(self):
+		""" Test loads send the digest of the agent code, the orchestrator keeps the code """
+		tardata = os.urandom(5000)
+		aalfile = self.writeAAL(tardata)
+		aal = AAL([aalfile])
+		load = [event for event in aal.getStream('loadAgentStream') if isinstance(event, LoadAgentCall)][0]
+		self.assertEquals(load.args['digest'], blobDigest(tardata))
+		self.assertNotIn('tardata', load.args)
+		self.assertEquals(aal.blobs, { blobDigest(tardata): tardata })
+		unload = [event for event in aal.getStream('unloadAgentStream') if isinstance(event, UnloadAgentCall)][0]
+		self.assertNotIn('digest', unload.args)
+
+		aal = AAL([aalfile], inlineCode=True)
+		load = [event for event in aal.getStream('loadAgentStream') if isinstance(event, LoadAgentCall)][0]
+		self.assertEquals(base64.b64decode(load.args['tardata']), tardata)
+		self.assertEquals(aal.blobs, {})
+
+	def test_getBlob(self):
+		""" Test the orchestrator sends a blob once for all the requests that arrive together """
+		tardata = os.urandom(600 * 1024)
+		digest = blobDigest(tardata)
+		orch = Orchestrator.__new__(Orchestrator)  # skip the database and display setup
+		orch.messaging = SimpleMessaging()
+		orch.aal = AAL([self.writeAAL(tardata)])
+		orch.blobsSent = dict()
+
+		for ii in range(10):
+			self.assertTrue(orch.getBlob(digest, groups=['clients']))
+		self.assertFalse(orch.getBlob(blobDigest('unknown'), groups=['clients']))
+		chunks = []
+		while not orch.messaging.outgoing.empty():
+			msg = orch.messaging.extract().msg
+			self.assertEquals(msg.dstgroups, set(['clients']))
+			chunks.append(cPickle.loads(msg.data)['args'])
+		self.assertEquals([chunk['index'] for chunk in chunks], [0, 1, 2])
+		fetch = BlobFetch(digest)
+		for chunk in chunks:
+			fetch.add(chunk['index'], chunk['count'], chunk['data'])
+		self.assertEquals(fetch.data(), tardata)
+
+		# a retry from one node is sent to just that node
+		self.assertTrue(orch.getBlob(digest, nodes=['n2']))
+		self.assertEquals(orch.messaging.outgoing.qsize(), 3)
+		self.assertEquals(orch.messaging.extract().msg.dstnodes, set(['n2']))
+
+
+if __name__ == '__main__':
+	hdlr = logging.StreamHandler()
+	hdlr.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%m-%d %H:%M:%S'))
+	root = logging.getLogger()
+	root.handlers = []
+	root.addHandler(hdlr)
+	root.setLevel(logging.INFO)
+	unittest2.main(verbosity=2)
@@ -14,10 +14,11 @@ import threading
 import time
 
 from magi.messaging.magimessage import MAGIMessage
-from magi.util.calls import doMessageAction
+from magi.util.calls import doMessageAction, loadMessageData
 from magi.util.execl import spawn, execAndRead
 from magi.util.distributions import *
 from magi.util import config, database
+from magi.util.pool import WorkerPool
 
 log = logging.getLogger(__name__)
 
@@ -128,24 +129,69 @@ class NonBlockingDispatchAgent(Agent):
     """
         Provides dispatch code for an agent that only responds/reacts
         to incoming messages, asynchronously.
+        Calls run on a bounded pool of worker threads.  Calls to methods
+        that share a key in concurrencyKeys run one at a time, in the order
+        received.  A key may also be a function of the message, so calls are
+        only serialized with others from, say, the same requester.  A stop call waits for the queued calls to finish first.
+        workers, maxQueued and concurrencyKeys can be set through the agent
+        configuration.
     """
+
+    WORKERS = 8
+    MAXQUEUED = 256
+    DRAINTIMEOUT = 30  # seconds stop waits for queued calls
+
     def __init__(self):
         log.debug('In init of the root NonBlockingDispatchAgent')
         Agent.__init__(self)
+        self.workers = NonBlockingDispatchAgent.WORKERS
+        self.maxQueued = NonBlockingDispatchAgent.MAXQUEUED
+        self.concurrencyKeys = dict()  # method name -> key, methods with the same key are serialized
+        self.pool = None
 
     def run(self):
         """ Called by daemon in the agent's thread to perform
         the thread main"""
         log.debug('In run of the root NonBlockingDispatchAgent')
-        while not self.done:
-            try:
-                msg = self.messenger.next(block=True)
-                if isinstance(msg, MAGIMessage):
-                    thr = threading.Thread(target=doMessageAction, 
-                                           args=(self, msg, self.messenger))
-                    thr.start()
-            except Queue.Empty:
-                pass
+        self.pool = WorkerPool(self.name or 'agent', self.workers, self.maxQueued)
+        try:
+            while not self.done:
+                try:
+                    msg = self.messenger.next(block=True)
+                    if isinstance(msg, MAGIMessage):
+                        self.dispatch(msg)
+                except Queue.Empty:
+                    pass
+        finally:
+            self.pool.shutdown(NonBlockingDispatchAgent.DRAINTIMEOUT)
+
+    def dispatch(self, msg):
+        try:
+            data = loadMessageData(msg)
+        except Exception, e:
+            log.error("Dropping message %s that could not be decoded: %s", msg, e)
+            return
+        method = None
+        if isinstance(data, dict):
+            method = data.get('method')
+        if method == 'stop':
+            log.info('Waiting for queued calls before stopping')
+            if not self.pool.drain(NonBlockingDispatchAgent.DRAINTIMEOUT):
+                log.warning('Queued calls did not finish in %d seconds, stopping anyway',
+                            NonBlockingDispatchAgent.DRAINTIMEOUT)
+            doMessageAction(self, msg, self.messenger, data)
+            return
+        key = self.concurrencyKeys.get(method)
+        if callable(key):
+            key = key(msg)
+        self.pool.submit(method, key, doMessageAction, self, msg, self.messenger, data)
+
+    @agentmethod()
+    def getPoolMetrics(self, msg=None):
+        """ Queue wait and run times per method, see WorkerPool.metrics """
+        if self.pool is None:
+            return None
+        return self.pool.metrics()
 
 
 class ReportingDispatchAgent(DispatchAgent):
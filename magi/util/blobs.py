@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+# Copyright (C) 2012 University of Southern California
+# This software is licensed under the GPLv3 license, included in
+# ./GPLv3-LICENSE.txt in the source distribution
+
+"""
+	Content addressed storage for agent code.  The orchestrator names each agent tarball by the SHA1 of its
+	contents and only sends that digest in loadAgent.  Daemons keep the tarballs they have seen in a BlobCache
+	and ask for the ones they are missing, which arrive as numbered chunks.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+log = logging.getLogger(__name__)
+
+BLOB_CHUNK_SIZE = 256 * 1024
+DIGEST = re.compile('^[0-9a-f]{40}$')
+
+
+class BlobError(Exception):
+	pass
+
+
+def blobDigest(data):
+	return hashlib.sha1(data).hexdigest()
+
+def splitBlob(data, chunkSize=BLOB_CHUNK_SIZE):
+	""" The chunks to send data in, always at least one """
+	return [data[ii:ii+chunkSize] for ii in xrange(0, len(data), chunkSize)] or ['']
+
+
+class BlobCache(object):
+	"""
+		Blobs stored in a directory, one file per blob named by its digest.  Files are written under a
+		temporary name and renamed, so readers, or other daemons sharing the directory, never see part of one.
+	"""
+
+	def __init__(self, directory):
+		self.directory = directory
+
+	def path(self, digest):
+		if not isinstance(digest, basestring) or not DIGEST.match(digest):
+			raise BlobError("invalid blob digest %r" % (digest,))
+		return os.path.join(self.directory, digest)
+
+	def has(self, digest):
+		return os.path.exists(self.path(digest))
+
+	def get(self, digest):
+		with open(self.path(digest), 'rb') as fp:
+			return fp.read()
+
+	def put(self, data, digest=None):
+		""" Store data, checking it matches digest if one is given.  Returns the digest """
+		actual = blobDigest(data)
+		if digest is not None and digest != actual:
+			raise BlobError("blob data doesn't match digest %s" % digest)
+		path = self.path(actual)
+		if os.path.exists(path):
+			return actual
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.' + actual)
+		try:
+			with os.fdopen(fd, 'wb') as fp:
+				fp.write(data)
+			os.rename(tmpname, path)
+		except:
+			if os.path.exists(tmpname):
+				os.remove(tmpname)
+			raise
+		log.debug("Stored blob %s, %d bytes", actual, len(data))
+		return actual
+
+
+class BlobFetch(object):
+	""" A blob this node asked for, the chunks received so far and the calls waiting for it """
+
+	def __init__(self, digest):
+		self.digest = digest
+		self.chunks = dict()
+		self.count = None
+		self.requested = 0
+		self.tries = 0
+		self.waiting = list()
+
+	def add(self, index, count, data):
+		""" Returns True once every chunk has arrived """
+		if self.count != count:
+			self.chunks = dict()  # sender split it differently, start over
+			self.count = count
+		if 0 <= index < count:
+			self.chunks[index] = data
+		return len(self.chunks) == self.count
+
+	def data(self):
+		return ''.join([self.chunks[ii] for ii in xrange(self.count)])
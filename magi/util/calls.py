@@ -1,6 +1,7 @@
 
 import yaml
 import cPickle
+import json
 import logging
 import inspect
 import traceback
@@ -11,6 +12,11 @@ from magi.messaging.magimessage import MAGIMessage
 
 log = logging.getLogger(__name__)
 
+try:
+	from yaml import CSafeLoader as SafeLoader, CLoader as Loader, CDumper as Dumper
+except ImportError:
+	from yaml import SafeLoader, Loader, Dumper
+
 class CallException(Exception):
 	""" Marker for exceptions thrown during parsing of method call """
 	pass
@@ -55,31 +61,57 @@ class MethodCall(object):
 		return None
 
 
+class DispatchPlan(object):
+	""" What dispatchCall needs to know about a method, built once per class and method name """
+	__slots__ = ['func', 'spec', 'accepted', 'keywords']
+
+	def __init__(self, meth):
+		self.func = getattr(meth, 'im_func', meth)
+		self.spec = inspect.getargspec(meth)
+		self.accepted = frozenset(self.spec.args)
+		self.keywords = self.spec.keywords is not None
+
+_plans = dict()  # class -> method name -> DispatchPlan
+
+def getPlan(obj, name, meth):
+	""" Cached DispatchPlan for obj.name, rebuilt if the method was replaced """
+	plans = _plans.get(obj.__class__)
+	if plans is None:
+		plans = _plans.setdefault(obj.__class__, dict())
+	plan = plans.get(name)
+	if plan is None or plan.func is not getattr(meth, 'im_func', meth):
+		plan = DispatchPlan(meth)
+		plans[name] = plan
+	return plan
+
 def dispatchCall(obj, msg, data):
 	""" 
 		Pull out the method and args from standard YAML method call in the given (parsed) yaml message and then call that method
 	"""
 	try:
 		call = None
+		spec = None
 		call = MethodCall(data)
 		meth = getattr(obj, call.method)
-		spec = inspect.getargspec(meth)
-
-		for k in call.args.keys():
-			if k not in spec.args and spec.keywords is None:
-				del call.args[k]
-			if k == 'msg':
-				del call.args[k]
-				log.error("Can't use 'msg' as an argument name")
-
-		return meth(msg, **call.args)
+		plan = getPlan(obj, call.method, meth)
+		spec = plan.spec
+
+		args = call.args
+		if 'msg' in args:
+			del args['msg']
+			log.error("Can't use 'msg' as an argument name")
+		if not plan.keywords and not plan.accepted.issuperset(args):
+			for k in [k for k in args if k not in plan.accepted]:
+				del args[k]
+
+		return meth(msg, **args)
 		
 	except Exception, e:
 		(fname, lineno, fn, text) = traceback.extract_tb(sys.exc_info()[2])[-1]
 		if fname != __file__ and fname+'c' != __file__:  # not caused by our meth call, don't hide the real traceback
 			raise
 
-		if isinstance(e, TypeError):
+		if isinstance(e, TypeError) and spec is not None:
 			if spec.defaults is None:
 				defaultslen = "None"
 			else:
@@ -96,23 +128,61 @@ def dispatchCall(obj, msg, data):
 
 		# TODO: should we send an error message back now or just send to logs for retrieval?
 
-def doMessageAction(obj, msg, messaging=None):
+def _toStr(value):
+	""" JSON decodes all strings as unicode, callers expect str """
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	if isinstance(value, list):
+		return [_toStr(v) for v in value]
+	if isinstance(value, dict):
+		return dict([(_toStr(k), _toStr(v)) for k, v in value.iteritems()])
+	return value
+
+def dumpMessageData(call, contenttype=MAGIMessage.YAML):
+	""" 
+		Returns (contenttype, data) for a method call, YAML if the call can't be encoded as asked.
+		Agents not written in python only read YAML.
+	"""
+	try:
+		if contenttype == MAGIMessage.PICKLE:
+			return contenttype, cPickle.dumps(call, cPickle.HIGHEST_PROTOCOL)
+		if contenttype == MAGIMessage.JSON:
+			return contenttype, json.dumps(call, separators=(',', ':'))
+	except (TypeError, ValueError, cPickle.PicklingError), e:
+		log.warning("Sending %s call as YAML: %s", call.get('method'), e)
+	#width set to 10000 for not breaking arg dict into multiple lines
+	#because the custom yaml parsing code in c agent library requires that
+	#pyyaml by default breaks down content of more than a certain length 
+	return MAGIMessage.YAML, yaml.dump(call, width=10000, Dumper=Dumper)
+
+def loadMessageData(msg):
+	""" Deserialize the method call carried by a message """
+	log.debug("Content type: %d", msg.contenttype)
+	if msg.contenttype == MAGIMessage.PICKLE:
+		log.debug("Content type: Pickle")
+		return cPickle.loads(msg.data)
+	if msg.contenttype == MAGIMessage.JSON:
+		return _toStr(json.loads(msg.data))
+	# Default data type is YAML
+	try:
+		return yaml.load(msg.data, Loader=SafeLoader)
+	except yaml.constructor.ConstructorError:
+		# python specific tags from senders using yaml.dump rather than safe_dump
+		return yaml.load(msg.data, Loader=Loader)
+
+def doMessageAction(obj, msg, messaging=None, data=None):
 	"""
 		The function takes a message, and demuxxes it. Based on the content of the message it 
 		may take a number of actions. That number is currently one: invoke dispatchCall
 		which calls a function on "this" object whatever it is. 
+		data is the already deserialized message content, if the caller has it.
 	"""
 	
 	log.debug("In doMessageAction %s %s", str(obj), str(msg))
-	log.debug("Content type: %d", msg.contenttype)
 	
 	#First deserialize the message and then switch on the action. 
-	if msg.contenttype == MAGIMessage.PICKLE:
-		log.debug("Content type: Pickle")
-		data = cPickle.loads(msg.data)
-	else:
-		# Default data type is YAML
-		data = yaml.load(msg.data)
+	if data is None:
+		data = loadMessageData(msg)
 		
 	if 'method' in data:
 		try: 
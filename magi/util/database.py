@@ -17,6 +17,10 @@ LOG_COLLECTION_NAME = 'logs'
 # TODO: timeout should be dependent on machine type 
 TIMEOUT = 900
 
+# records fetched per database round trip, and sent per data message 
+QUERY_BATCH_SIZE = 1000
+QUERY_CHUNK_SIZE = 1000
+
 if 'collectionHosts' not in locals():
     collectionHosts = defaultdict(set)
     
@@ -195,14 +199,28 @@ def isDBRunning(host='localhost', port=DATABASE_SERVER_PORT):
                               port=port)
 
 def getData(agentName, filters=None, timestampRange=None,
-             dbHost='localhost', dbPort=DATABASE_SERVER_PORT):
+             dbHost='localhost', dbPort=DATABASE_SERVER_PORT, fields=None):
     """
         Function to retrieve data from the local database, 
         based on a given query
     """
     functionName = getData.__name__
     helpers.entrylog(log, functionName, locals())
-        
+    
+    result = list(iterData(agentName, filters, timestampRange, 
+                           dbHost, dbPort, fields))
+    
+    helpers.exitlog(log, functionName)
+    return result
+
+def iterData(agentName, filters=None, timestampRange=None,
+             dbHost='localhost', dbPort=DATABASE_SERVER_PORT, fields=None,
+             batchSize=QUERY_BATCH_SIZE):
+    """
+        Generator over the records matching a given query, fetched from
+        the database batchSize records at a time. fields, if given, is 
+        the list of record fields to return.
+    """
     if filters == None:
         filters_copy = dict()
     else:
@@ -215,16 +233,25 @@ def getData(agentName, filters=None, timestampRange=None,
     collection = getCollection(agentName=agentName, 
                                dbHost=dbHost, 
                                dbPort=dbPort)
-    cursor = collection.findAll(filters_copy)
-    
-    result = []
-    
-    while True:
-        try:
-            result.append(cursor.next())
-        except StopIteration:
-            break
+    if fields:
+        cursor = collection.findAll(filters_copy, list(fields))
+    else:
+        cursor = collection.findAll(filters_copy)
+    cursor.batch_size(batchSize)
     
-    helpers.exitlog(log, functionName)
-    return result
+    for record in cursor:
+        yield record
+
+def chunkData(records, chunkSize=QUERY_CHUNK_SIZE):
+    """
+        Groups an iterable of records into lists of at most chunkSize records
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
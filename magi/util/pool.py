@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+# Copyright (C) 2012 University of Southern California
+# This software is licensed under the GPLv3 license, included in
+# ./GPLv3-LICENSE.txt in the source distribution
+
+from collections import defaultdict, deque
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Task(object):
+	__slots__ = ['name', 'key', 'func', 'args', 'queued']
+
+	def __init__(self, name, key, func, args):
+		self.name = name
+		self.key = key
+		self.func = func
+		self.args = args
+		self.queued = time.time()
+
+
+class WorkerPool(object):
+	"""
+		A bounded set of worker threads fed from a queue.  Tasks with the same concurrency key run one at a
+		time in submit order, tasks without a key run as workers are free.  Threads are started as work
+		arrives, up to 'workers'.  submit blocks while 'maxqueued' tasks are waiting.
+		Per task name, stats keeps [count, total queue wait, max queue wait, total run time, max run time].
+	"""
+
+	def __init__(self, name, workers, maxqueued):
+		self.name = name
+		self.workers = max(1, workers)
+		self.maxqueued = max(1, maxqueued)
+		self.lock = threading.Lock()
+		self.changed = threading.Condition(self.lock)  # signalled whenever the queue or the running set changes
+		self.ready = deque()  # tasks that can run now
+		self.waiting = dict()  # key -> deque of tasks behind the running task with that key
+		self.busykeys = set()
+		self.queued = 0  # tasks in ready and waiting
+		self.running = 0
+		self.idle = 0
+		self.threads = list()
+		self.stopping = False
+		self.stats = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0.0])
+
+	def submit(self, name, key, func, *args):
+		""" Queue func(*args), waiting for room if the queue is full.  Returns False if the pool is stopped """
+		task = Task(name, key, func, args)
+		with self.lock:
+			while self.queued >= self.maxqueued and not self.stopping:
+				self.changed.wait()
+			if self.stopping:
+				return False
+			self.queued += 1
+			if key is None or key not in self.busykeys:
+				if key is not None:
+					self.busykeys.add(key)
+				self.ready.append(task)
+				if self.idle < len(self.ready) and len(self.threads) < self.workers:
+					thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, len(self.threads)))
+					thread.daemon = True
+					self.threads.append(thread)
+					thread.start()
+			else:
+				self.waiting.setdefault(key, deque()).append(task)  # started when the running task finishes
+			self.changed.notify_all()
+		return True
+
+	def _work(self):
+		self.lock.acquire()
+		try:
+			while True:
+				while not self.ready and not self.stopping:
+					self.idle += 1
+					self.changed.wait()
+					self.idle -= 1
+				if not self.ready:
+					return
+				task = self.ready.popleft()
+				self.queued -= 1
+				self.running += 1
+				self.changed.notify_all()
+				self.lock.release()
+
+				start = time.time()
+				try:
+					task.func(*task.args)
+				except Exception, e:
+					log.error("%s task %s threw an exception %s", self.name, task.name, e, exc_info=1)
+				end = time.time()
+
+				self.lock.acquire()
+				self.running -= 1
+				self._record(task, start, end)
+				if task.key is not None:
+					behind = self.waiting.get(task.key)
+					if behind:
+						self.ready.append(behind.popleft())
+						if not behind:
+							del self.waiting[task.key]
+					else:
+						self.busykeys.discard(task.key)
+				self.changed.notify_all()
+		finally:
+			self.lock.release()
+
+	def _record(self, task, start, end):
+		stat = self.stats[task.name]
+		wait = start - task.queued
+		run = end - start
+		stat[0] += 1
+		stat[1] += wait
+		stat[2] = max(stat[2], wait)
+		stat[3] += run
+		stat[4] = max(stat[4], run)
+
+	def metrics(self):
+		""" Per task name count, average and max queue wait and run times, plus the current pool state """
+		with self.lock:
+			result = dict()
+			for name, (count, wait, maxwait, run, maxrun) in self.stats.iteritems():
+				result[name] = { 'count': count, 'wait': wait / count, 'maxwait': maxwait,
+								 'run': run / count, 'maxrun': maxrun }
+			return { 'tasks': result, 'queued': self.queued, 'running': self.running, 'threads': len(self.threads) }
+
+	def drain(self, timeout=None):
+		""" Wait until everything queued so far has run, returns False on timeout """
+		stopat = None
+		if timeout is not None:
+			stopat = time.time() + timeout
+		with self.lock:
+			while self.queued or self.running:
+				if stopat is None:
+					self.changed.wait()
+				else:
+					left = stopat - time.time()
+					if left <= 0:
+						return False
+					self.changed.wait(left)
+			return True
+
+	def shutdown(self, timeout=None):
+		""" Drain the queue and stop the worker threads """
+		drained = self.drain(timeout)
+		with self.lock:
+			self.stopping = True
+			self.changed.notify_all()
+		for thread in self.threads:
+			if thread is not threading.current_thread():
+				thread.join(timeout)
+		return drained
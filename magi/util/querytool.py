@@ -4,6 +4,7 @@ from magi.messaging import api
 from magi.messaging.magimessage import MAGIMessage
 from magi.testbed import testbed
 import Queue
+import itertools
 import logging
 import random
 import time
@@ -12,15 +13,26 @@ import pickle
 
 log = logging.getLogger(__name__)
     
-def getData(agents, nodes=None, filters=dict(), timestampChunks=None, bridge='127.0.0.1', msgdest=testbed.nodename, timeout=30):
+def getData(agents, nodes=None, filters=dict(), timestampChunks=None, bridge='127.0.0.1', msgdest=testbed.nodename, timeout=30, 
+            fields=None, stream=True):
     """
-        Function to fetch data
+        Function to fetch data. The result maps agent -> node -> records.
+        By default the data is streamed in chunks and assembled as it
+        arrives, raising IOError if the stream stalls, stream=False asks 
+        for it as a single message.
     """
     functionName = getData.__name__
     entrylog(functionName, locals())
     
     if not agents:
         raise AttributeError("Cannot query for an empty set of agents.")
+    
+    if stream:
+        result = dict()
+        for agent, node, records in streamData(agents, nodes, filters, timestampChunks, bridge, msgdest, timeout, fields):
+            result.setdefault(agent, dict()).setdefault(node, []).extend(records)
+        exitlog(functionName)
+        return result
         
     messenger = getMessenger(bridge, 18808)
 
@@ -32,7 +44,8 @@ def getData(agents, nodes=None, filters=dict(), timestampChunks=None, bridge='12
         "agents": agents,
         "nodes": nodes,
         "filters": filters,
-        "timestampChunks": timestampChunks
+        "timestampChunks": timestampChunks,
+        "fields": fields
     }
     call = {'version': 1.0, 'method': 'getData', 'args': args} 
     msg = MAGIMessage(nodes=msgdest, docks='dataman', contenttype=MAGIMessage.YAML, data=yaml.dump(call))
@@ -72,8 +85,78 @@ def getData(agents, nodes=None, filters=dict(), timestampChunks=None, bridge='12
     exitlog(functionName)
     return result
 
+def streamData(agents, nodes=None, filters=dict(), timestampChunks=None, bridge='127.0.0.1', msgdest=testbed.nodename, timeout=30, 
+               fields=None, chunkSize=None):
+    """
+        Generator over the (agent, node, records) chunks of a data query, 
+        in order. Records only hold the given fields, if any. Each chunk is 
+        acknowledged as it is handed out, which lets the data manager send 
+        more. Raises IOError if no chunk arrives for timeout seconds. If the 
+        generator is closed or abandoned early, the query is cancelled.
+    """
+    functionName = streamData.__name__
+    entrylog(functionName, locals())
+    
+    if not agents:
+        raise AttributeError("Cannot query for an empty set of agents.")
+        
+    messenger = getMessenger(bridge, 18808)
+    
+    queryId = next(queryIds)
+    args = {
+        "queryId": queryId,
+        "agents": agents,
+        "nodes": nodes,
+        "filters": filters,
+        "timestampChunks": timestampChunks,
+        "fields": fields
+    }
+    if chunkSize:
+        args['chunkSize'] = chunkSize
+    call = {'version': 1.0, 'method': 'streamData', 'args': args} 
+    messenger.send(MAGIMessage(nodes=msgdest, docks='dataman', contenttype=MAGIMessage.YAML, data=yaml.dump(call)))
+    log.info("Data stream query %d sent", queryId)
+    
+    expected = 0
+    pending = dict() # chunks that arrived ahead of the expected one
+    stop = time.time() + timeout
+    finished = False
+    try:
+        while True:
+            if expected in pending:
+                chunk = pending.pop(expected)
+                call = {'version': 1.0, 'method': 'ackData', 'args': {'queryId': queryId, 'seq': expected}}
+                messenger.send(MAGIMessage(nodes=msgdest, docks='dataman', contenttype=MAGIMessage.YAML, data=yaml.dump(call)))
+                if chunk['last']:
+                    finished = True
+                    break
+                expected += 1
+                stop = time.time() + timeout
+                yield chunk['agent'], chunk['node'], chunk['records']
+                continue
+            
+            if time.time() > stop:
+                raise IOError("Timed out waiting for chunk %d of data query %d from %s" %(expected, queryId, msgdest))
+            try:
+                msg = messenger.nextMessage(True, timeout=0.2)
+            except Queue.Empty:
+                continue
+            if msg.contenttype != MAGIMessage.PICKLE:
+                continue
+            data = pickle.loads(msg.data)
+            if data.get('method') == 'putDataChunk' and data['args']['queryId'] == queryId:
+                pending[data['args']['seq']] = data['args']
+    finally:
+        if not finished:
+            call = {'version': 1.0, 'method': 'ackData', 'args': {'queryId': queryId, 'seq': -1, 'cancel': True}}
+            messenger.send(MAGIMessage(nodes=msgdest, docks='dataman', contenttype=MAGIMessage.YAML, data=yaml.dump(call)))
+            log.info("Data stream query %d cancelled", queryId)
+        
+    exitlog(functionName)
+
 msgrCache = dict()
 srcdock = "dataclient" + str(int(random.random() * 10000))
+queryIds = itertools.count()
 
 def getMessenger(node, port):
     global msgrCache
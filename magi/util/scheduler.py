@@ -4,81 +4,282 @@
 # We don't want a main loop, but we do want to know when the next event should fire
 # Also add option to remove by method pointer
 
-from magi.util.Collection import namedtuple
 import heapq
+import itertools
 import time
 import sys
 import logging
 
 log = logging.getLogger(__name__)
-
-Event = namedtuple('Event', 'time, nextdelay, method, args')
 debug = False
 
+
+class Event(object):
+	"""
+		A scheduled call.  Unscheduled events are only marked as no longer pending, they are skipped when
+		they come up or dropped when the heap is compacted.
+	"""
+	__slots__ = ['time', 'nextdelay', 'method', 'args', 'seq', 'pending', 'inwheel', 'inheap']
+
+	def __init__(self, time, nextdelay, method, args, seq):
+		self.time = time
+		self.nextdelay = nextdelay
+		self.method = method
+		self.args = args
+		self.seq = seq
+		self.pending = True
+		self.inwheel = False
+		self.inheap = False
+
+	def __repr__(self):
+		return "Event(time=%r, nextdelay=%r, method=%r, args=%r)" % (self.time, self.nextdelay, self.method, self.args)
+
+
+class TimingWheel(object):
+	"""
+		Hierarchical timing wheel for short timers.  Level 0 has one bucket per 'resolution' seconds, each
+		higher level has buckets 'slots' times larger than the level below.  Events are cascaded down a
+		level when the wheel below wraps around.  Events never fire early but may fire up to 'resolution'
+		seconds late.  Unscheduled events are left in their bucket and dropped when the bucket comes up.
+	"""
+
+	def __init__(self, resolution, slots, levels):
+		self.resolution = resolution
+		self.slots = slots
+		self.sizes = [slots ** ii for ii in range(levels + 1)]  # ticks per bucket at each level, last is the horizon
+		self.buckets = [[list() for jj in range(slots)] for ii in range(levels)]
+		self.tick = 0
+		self.count = 0  # live events in the wheel
+
+	def add(self, event):
+		""" Place the event in a bucket, returns False if it is already due or past the horizon """
+		if self.count == 0:  # nothing pending, resync with the current time
+			self.tick = int(time.time() / self.resolution)
+		due = -int(-event.time // self.resolution)  # round up, never fire early
+		delta = due - self.tick
+		if delta <= 0 or delta >= self.sizes[-1]:
+			return False
+		self.place(event, due, delta)
+		self.count += 1
+		event.inwheel = True
+		return True
+
+	def place(self, event, due, delta):
+		level = 0
+		while delta >= self.sizes[level+1]:
+			level += 1
+		self.buckets[level][(due // self.sizes[level]) % self.slots].append(event)
+
+	def remove(self, event):
+		""" Event was unscheduled, it stays in its bucket until that comes up """
+		self.count -= 1
+
+	def advance(self, now):
+		""" Move the wheel up to time 'now' and return the events that are due in time order """
+		fired = list()
+		target = int(now / self.resolution)
+		while self.count > 0 and self.tick < target:
+			self.tick += 1
+			for level in range(len(self.buckets)-1, 0, -1):  # cascade from the top so a tick can drop several levels
+				size = self.sizes[level]
+				if self.tick % size:
+					continue
+				bucket = self.buckets[level][(self.tick // size) % self.slots]
+				if not bucket:
+					continue
+				self.buckets[level][(self.tick // size) % self.slots] = list()
+				for event in bucket:
+					if not event.pending:
+						continue
+					due = -int(-event.time // self.resolution)
+					if due <= self.tick:
+						fired.append(event)
+						self.count -= 1
+					else:
+						self.place(event, due, due - self.tick)
+
+			index = self.tick % self.slots
+			bucket = self.buckets[0][index]
+			if bucket:
+				self.buckets[0][index] = list()
+				for event in bucket:
+					if event.pending:
+						fired.append(event)
+						self.count -= 1
+
+		for event in fired:
+			event.inwheel = False
+		fired.sort(key=lambda e: e.time)
+		return fired
+
+	def nextTime(self):
+		"""
+			Time of the next nonempty bucket in this rotation of level 0, otherwise the time of the next
+			cascade.  None if the wheel is empty.
+		"""
+		if self.count == 0:
+			return None
+		level0 = self.buckets[0]
+		for ii in range(1, self.slots):
+			if level0[(self.tick + ii) % self.slots]:
+				return (self.tick + ii) * self.resolution
+		return (self.tick // self.slots + 1) * self.slots * self.resolution
+
+	def events(self):
+		for level in self.buckets:
+			for bucket in level:
+				for event in bucket:
+					if event.pending:
+						yield event
+
+	def clear(self):
+		for level in self.buckets:
+			for ii in range(self.slots):
+				level[ii] = list()
+		self.count = 0
+
+
 class Scheduler(object):
 	"""
-		Only passes messages if the current time is greater the msg.time header.  If the time header
-		doesn't exist, they are passed right away
+		Calls methods at scheduled times.  Events are kept in a heap ordered by time and indexed by method.
+		Unscheduling marks the event as no longer pending rather than searching the heap, the heap is
+		rebuilt when dead entries make up most of it.
+		If 'resolution' is given, events due within the wheel horizon are kept in a TimingWheel instead,
+		which makes scheduling and cancelling many short timers constant time at the cost of firing up to
+		'resolution' seconds late.
 	"""
 
-	def __init__(self):
-		self.heap = list()  # Contains messages order by scheduled time value
+	COMPACTMIN = 64  # don't bother compacting smaller heaps
+
+	def __init__(self, resolution=None, slots=64, levels=3):
+		self.heap = list()  # Contains (time, seq, event) ordered by scheduled time value
+		self.seq = itertools.count()  # keeps equal times in schedule order and events out of comparisons
+		self.methods = dict()  # method -> [live count, heap of (time, seq, event)] for events using that method
+		self.cancelled = 0  # unscheduled events still in the heap
+		self.wheel = None
+		if resolution is not None:
+			self.wheel = TimingWheel(resolution, slots, levels)
 
 	def sched_time(self, when, method, *args):
 		""" Request that at time 'when', we call 'method(args)', returns the scheduled event """
-		event = Event(when, 0, method, args)
-		heapq.heappush(self.heap, event)
-		return event
+		return self._add(Event(when, 0, method, args, next(self.seq)))
 
 	def sched_relative(self, delay, method, *args):
 		""" Request that at time 'now + delay', we call 'method(args)', returns the scheduled event """
-		event = Event(time.time() + delay, 0, method, args)
-		heapq.heappush(self.heap, event)
-		return event
+		return self._add(Event(time.time() + delay, 0, method, args, next(self.seq)))
 
 	def periodic(self, delay, method, *args):
 		""" Request that at time 'now + delay', and every delay seconds there after we call 'method(args)', returns the scheduled event """
-		event = Event(time.time() + delay, delay, method, args)
-		heapq.heappush(self.heap, event)
+		return self._add(Event(time.time() + delay, delay, method, args, next(self.seq)))
+
+	def _add(self, event):
+		entry = (event.time, event.seq, event)
+		index = self.methods.get(event.method)
+		if index is None:
+			self.methods[event.method] = [1, [entry]]
+		else:
+			index[0] += 1
+			heapq.heappush(index[1], entry)
+		if self.wheel is None or not self.wheel.add(event):
+			heapq.heappush(self.heap, entry)
+			event.inheap = True
 		return event
 
+	def _unindex(self, event):
+		""" Event fired or was unscheduled, dead entries in the method heap are skipped or compacted """
+		event.pending = False
+		index = self.methods[event.method]
+		index[0] -= 1
+		if index[0] == 0:
+			del self.methods[event.method]
+		elif len(index[1]) > Scheduler.COMPACTMIN and index[0] * 2 < len(index[1]):
+			index[1] = [entry for entry in index[1] if entry[2].pending]
+			heapq.heapify(index[1])
+
 	def getByMethod(self, method):
-		""" Get the first event that is using the given method """
-		for event in self.heap:
-			if event.method == method:
-				return event
-		return None
+		""" Get the earliest event that is using the given method """
+		index = self.methods.get(method)
+		if index is None:
+			return None
+		events = index[1]
+		while not events[0][2].pending:
+			heapq.heappop(events)
+		return events[0][2]
 
 	def unsched(self, event):
 		""" Call to unschedule an event that hasn't fired yet.  Argument is the event returned by sched_* """
-		try:
-			self.heap.remove(event)
+		if not event.pending:
+			return  # not in the schedule
+		self._unindex(event)
+		if event.inwheel:
+			self.wheel.remove(event)
+			return
+		if not event.inheap:
+			return  # taken from the wheel to fire in this batch
+		self.cancelled += 1
+		if self.cancelled > Scheduler.COMPACTMIN and self.cancelled * 2 > len(self.heap):
+			self.heap = [entry for entry in self.heap if entry[2].pending]
 			heapq.heapify(self.heap)
-		except ValueError:  # not in the schedule
-			pass
+			self.cancelled = 0
 
 	def run(self):
 		""" Fire any events are ready to go, return the time until the next event when nothing else ready """
 		return self._run(time.time())
 
+	def _fire(self, event):
+		self._unindex(event)
+		event.method(*event.args)
+		if event.nextdelay > 0:  # periodic call, reschedule
+			self.periodic(event.nextdelay, event.method, *event.args)
+
 	def _run(self, totime=sys.maxint):
 		""" Fire all scheduled events up to given time regardless of the real time """
-		while len(self.heap) > 0:
-			if self.heap[0].time > totime:
+		if self.wheel is not None:
+			for event in self.wheel.advance(totime):
+				if event.pending:  # may be unscheduled by an earlier event in the same batch
+					self._fire(event)
+
+		heap = self.heap
+		while len(heap) > 0:
+			event = heap[0][2]
+			if not event.pending:
+				heapq.heappop(heap)
+				self.cancelled -= 1
+				continue
+			if event.time > totime:
 				break
-			event = heapq.heappop(self.heap)
-			event.method(*event.args)
-			if event.nextdelay > 0:  # periodic call, reschedule
-				self.periodic(event.nextdelay, event.method, *event.args)
-		
-		if len(self.heap) > 0:
-			return self.heap[0].time - totime
-		return sys.maxint
+			heapq.heappop(heap)
+			event.inheap = False
+			self._fire(event)
+
+		nexttime = None
+		if len(heap) > 0:
+			nexttime = heap[0][0]
+		if self.wheel is not None:
+			wheeltime = self.wheel.nextTime()
+			if wheeltime is not None and (nexttime is None or wheeltime < nexttime):
+				nexttime = wheeltime
+		if nexttime is None:
+			return sys.maxint
+		return nexttime - totime
+
+	def _pendingEvents(self):
+		events = [entry[2] for entry in self.heap if entry[2].pending]
+		if self.wheel is not None:
+			events.extend(self.wheel.events())
+		return events
 
 	def _doall(self):
 		""" some events encode new events, this lets us run all the events in the queue while ignoring new ones, used for testing """
-		for event in self.heap[:]:
+		events = self._pendingEvents()
+		events.sort(key=lambda e: e.time)
+		for event in events:
 			event.method(*event.args)
+		for event in events + self._pendingEvents():
+			event.pending = False
 		self.heap = list()
-
+		self.methods = dict()
+		self.cancelled = 0
+		if self.wheel is not None:
+			self.wheel.clear()
 
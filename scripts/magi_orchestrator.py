@@ -15,6 +15,9 @@ import signal
 import subprocess
 import time
 
+# --payload values
+PAYLOADTYPES = { 'yaml' : api.MAGIMessage.YAML, 'json' : api.MAGIMessage.JSON, 'pickle' : api.MAGIMessage.PICKLE }
+
 def sigusr1_handler(signum, name):
     '''Set the flag in the Orchestrator module that causes current
     state to be printed to stdout when we get signal USR1.'''
@@ -83,6 +86,19 @@ if __name__ == '__main__':
                               "in the given AAL, use the timeout given (in "
                               "milliseconds) when waiting for group "
                               "formation to complete.")
+    optparser.add_option("--payload",
+                         dest="payload",
+                         type="choice", choices=['yaml', 'json', 'pickle'],
+                         default='yaml',
+                         help="Encoding for the method calls sent to agents, "
+                              "one of yaml, json or pickle. Agents not written "
+                              "in python only read yaml. Default is yaml.")
+    optparser.add_option("--inlinecode",
+                         dest="inlinecode",
+                         help="Send agent code inside the loadAgent calls "
+                              "rather than by digest, for older daemons.",
+                         default=False,
+                         action="store_true")
     optparser.add_option("--nocolor",
                          dest="nocolor",
                          help="If given, do not use color in output.",
@@ -167,7 +183,8 @@ if __name__ == '__main__':
             exit(1)
 
     try:
-        aal = AAL(options.events, dagdisplay=options.display, groupBuildTimeout=options.groupBuildTimeout)
+        aal = AAL(options.events, dagdisplay=options.display, groupBuildTimeout=options.groupBuildTimeout,
+                  contenttype=PAYLOADTYPES[options.payload], inlineCode=options.inlinecode)
         #aal = AAL(options.events, groupBuildTimeout=options.groupBuildTimeout)
     except AALParseError as e:
         logging.critical('Unable to parse events file: %s', str(e))
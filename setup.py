@@ -2,7 +2,9 @@
 
 from distutils.cmd import Command
 from distutils.command.build_py import build_py
-from distutils.core import setup
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+from distutils.core import setup, Extension
 from magi import __version__, __author__
 import os
 import subprocess
@@ -69,6 +71,20 @@ class build_py_X(build_py):
     def find_data_files (self, package, src_dir):
         ret = build_py.find_data_files(self, package, src_dir)
         return ret
+
+class build_ext_optional(build_ext):
+    # C extensions are only accelerators, don't fail the install if they can't be compiled
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError, e:
+            print "Not building C extensions: ", e
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError), e:
+            print "Unable to build %s, the python version will be used: %s" % (ext.name, e)
     
 #try:
     #os.unlink('MANIFEST') # remove autogenerated thing by sdist
@@ -87,9 +103,11 @@ setup(name='MAGI',
 	packages=['magi', 'magi.daemon', 'magi.messaging', 'magi.testbed', 'magi.db', 'magi.modules', 
               'magi.util', 'magi.orchestrator', 'magi.tests', 'magi.modules.dataman'],
 	package_data={'magi.modules.dataman': ['*.idl'], 'magi.tests': ['*.pem', '*.aal', '*/*']},
+	# optional C version of the message header codec, DefaultCodec falls back to python if it doesn't build
+	ext_modules=[Extension('magi.messaging._codec', ['magi/messaging/_codecmodule.c'])],
 	scripts=['scripts/magi_daemon.py', 'tools/magi_orchestrator.py', 'tools/magi_status.py', 'tools/magi_graph.py' ],
 	license="GPLV3",
-	cmdclass={'toshare':ToShare, 'build_py':build_py_X},
+	cmdclass={'toshare':ToShare, 'build_py':build_py_X, 'build_ext':build_ext_optional},
 )
 
 
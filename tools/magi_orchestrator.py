@@ -19,6 +19,9 @@ import time
 lastSignalRcvd = 0
 orch = None
 
+# --payload values
+PAYLOADTYPES = { 'yaml' : api.MAGIMessage.YAML, 'json' : api.MAGIMessage.JSON, 'pickle' : api.MAGIMessage.PICKLE }
+
 def signal_handler(signum, frame):
     '''Set the flag in the Orchestrator module that causes current
     state to be printed to stdout when we get signal SIGINT.'''
@@ -109,6 +112,21 @@ if __name__ == '__main__':
                               "milliseconds) when waiting for group "
                               "formation to complete.")
     
+    optparser.add_option("--payload",
+                         dest="payload",
+                         type="choice", choices=['yaml', 'json', 'pickle'],
+                         default='yaml',
+                         help="Encoding for the method calls sent to agents, "
+                              "one of yaml, json or pickle. Agents not written "
+                              "in python only read yaml. Default is yaml.")
+    
+    optparser.add_option("--inlinecode",
+                         dest="inlinecode",
+                         help="Send agent code inside the loadAgent calls "
+                              "rather than by digest, for older daemons.",
+                         default=False,
+                         action="store_true")
+    
     optparser.add_option("--nocolor",
                          dest="nocolor",
                          help="If given, do not use color in output.",
@@ -194,7 +212,8 @@ if __name__ == '__main__':
             exit(1)
 
     try:
-        aal = AAL(options.events, dagdisplay=options.display, groupBuildTimeout=options.groupBuildTimeout)
+        aal = AAL(options.events, dagdisplay=options.display, groupBuildTimeout=options.groupBuildTimeout,
+                  contenttype=PAYLOADTYPES[options.payload], inlineCode=options.inlinecode)
     except AALParseError as e:
         logging.critical('Unable to parse events file: %s', str(e))
         exit(2)